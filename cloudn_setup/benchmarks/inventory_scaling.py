@@ -0,0 +1,165 @@
+"""
+Scaling benchmark for the vmware inventory layer, run against the in-process
+vSphere simulator (vmware/simulator.py) instead of real ESXi hosts.
+
+For every inventory size it reports wall time, vSphere round trips and
+logins of:
+  - load_yaml:     initialize_inventory parsing the yaml (also reports the
+                   memory held by the loaded inventory)
+  - load_cached:   initialize_inventory from the cached parse
+  - refresh_cold:  first refresh_inventory_state (sessions opened)
+  - refresh_warm:  second refresh_inventory_state (sessions reused)
+  - allocate:      --operations allocate_vm calls, one owner each
+  - tag:           releasing those VMs (annotation rewrite, or custom fields
+                   with --tag_backend custom_fields)
+  - revert:        reverting those VMs to their golden snapshot, one by one
+  - recycle:       reverting the same VMs with Inventory.recycle_vms
+
+Run from the cloudn_setup directory:
+    python3 benchmarks/inventory_scaling.py --sizes 1x10,10x50,20x200 --latency 0.002
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+SETUP_DIRECTORY = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(SETUP_DIRECTORY))
+
+import yaml
+
+from vmware.inventory import Inventory
+from vmware.simulator import VsphereSimulator
+from vmware.tags import TAG_BACKENDS
+import vmware.utils as utils
+
+SNAPSHOT_NAME = 'golden'
+
+
+def parse_sizes(value):
+    """ Returns [(hosts, vms_per_host)] from "1x10,10x50" """
+    sizes = list()
+    for item in value.split(','):
+        hosts, vms = item.lower().split('x')
+        sizes.append((int(hosts), int(vms)))
+    return sizes
+
+
+def measure(sim, func):
+    """ Runs func and returns its wall time and the simulator calls it made """
+    sim.reset_stats()
+    sessions = dict(utils.session_manager.stats)
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    stats = sim.snapshot_stats()
+    return {
+        'wall_s': elapsed,
+        'round_trips': stats['round_trips'],
+        'logins': stats['logins'],
+        'session_reuses': utils.session_manager.stats['reuses'] - sessions['reuses'],
+        'calls': stats['calls'],
+    }
+
+
+def measure_load(inventory_file, workers, tag_backend):
+    """ Loads the inventory and returns its wall time and the memory it holds """
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        inv = Inventory(refresh_workers=workers, tag_backend=tag_backend)
+        inv.initialize_inventory(inventory_file)
+        elapsed = time.perf_counter() - start
+        memory, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return inv, {'wall_s': elapsed, 'round_trips': 0, 'logins': 0, 'memory_kb': memory / 1024.0}
+
+
+def run_size(hosts, vms_per_host, operations, latency, workers, tag_backend, task_seconds=0.0):
+    sim = VsphereSimulator(latency=latency, task_durations={
+        'RevertToSnapshot_Task': task_seconds, 'PowerOnVM_Task': task_seconds})
+    spec = sim.build(hosts, vms_per_host, snapshots=(SNAPSHOT_NAME,))
+    with tempfile.TemporaryDirectory() as tmp_dir, sim:
+        inventory_file = os.path.join(tmp_dir, 'inventory.yaml')
+        with open(inventory_file, 'w') as f:
+            yaml.safe_dump(spec, f)
+        _, load_yaml = measure_load(inventory_file, workers, tag_backend)
+        inv, load_cached = measure_load(inventory_file, workers, tag_backend)
+
+        leased = list()
+        results = {
+            'load_yaml': load_yaml,
+            'load_cached': load_cached,
+            'refresh_cold': measure(sim, inv.refresh_inventory_state),
+            'refresh_warm': measure(sim, inv.refresh_inventory_state),
+            'allocate': measure(sim, lambda: leased.extend(
+                inv.allocate_vm('bench-{}'.format(i)) for i in range(operations))),
+            'tag': measure(sim, lambda: [vm.release() for vm in leased]),
+            'revert': measure(sim, lambda: [
+                utils.revert_vm_to_snapshot(vm, SNAPSHOT_NAME) for vm in leased]),
+            'recycle': measure(sim, lambda: inv.recycle_vms(
+                SNAPSHOT_NAME, vms=leased, max_concurrent=workers)),
+        }
+    return results
+
+
+def format_results(rows):
+    lines = ["{:>6} {:>6} {:<14} {:>10} {:>12} {:>7} {:>12}".format(
+        'hosts', 'vms', 'operation', 'wall (s)', 'round trips', 'logins', 'memory (KB)')]
+    for row in rows:
+        for operation, result in row['results'].items():
+            memory = result.get('memory_kb')
+            lines.append("{:>6} {:>6} {:<14} {:>10.3f} {:>12} {:>7} {:>12}".format(
+                row['hosts'], row['vms'], operation, result['wall_s'],
+                result['round_trips'], result['logins'],
+                '-' if memory is None else '{:.0f}'.format(memory)))
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='vmware inventory scaling benchmark')
+    parser.add_argument('--sizes', type=parse_sizes, default=parse_sizes('1x10,4x50,10x100'),
+                        help='comma separated HOSTSxVMS_PER_HOST inventory sizes')
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='seconds each simulated vSphere round trip takes')
+    parser.add_argument('--task_seconds', type=float, default=0.0,
+                        help='seconds each simulated revert and power-on task takes')
+    parser.add_argument('--operations', type=int, default=5,
+                        help='VMs allocated, tagged and reverted per size')
+    parser.add_argument('--workers', type=int, default=8, help='refresh_workers of the inventory')
+    parser.add_argument('--tag_backend', default='annotation', choices=sorted(TAG_BACKENDS),
+                        help='vmware.tags backend the VM state is stored with')
+    parser.add_argument('--output', help='JSONL file the result is appended to')
+    parser.add_argument('--label', help='release or commit the result belongs to')
+    args = parser.parse_args()
+
+    rows = list()
+    for hosts, vms_per_host in args.sizes:
+        rows.append({
+            'hosts': hosts,
+            'vms': hosts * vms_per_host,
+            'results': run_size(hosts, vms_per_host, args.operations, args.latency, args.workers,
+                                args.tag_backend, args.task_seconds),
+        })
+    print(format_results(rows))
+
+    result = {
+        'label': args.label,
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'latency_s': args.latency,
+        'task_s': args.task_seconds,
+        'operations': args.operations,
+        'tag_backend': args.tag_backend,
+        'sizes': rows,
+    }
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(result) + '\n')
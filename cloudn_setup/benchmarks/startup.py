@@ -0,0 +1,129 @@
+"""
+Startup benchmark for the get_vcn.py external data program.
+
+Measures, in fresh interpreters:
+  - cold import time of vmware.inventory
+  - time to first byte on stdout of get_vcn.py answering from a warm state
+    cache, and whether pyVmomi had to be imported for it
+
+Run from the cloudn_setup directory:
+    python3 benchmarks/startup.py --runs 10 --output startup_history.jsonl
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+SETUP_DIRECTORY = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(SETUP_DIRECTORY))
+
+from vmware.inventory import Inventory
+from vmware.state_cache import StateCache
+
+BENCH_OWNER = "startup-benchmark"
+
+IMPORT_SNIPPET = """
+import sys, time
+t = time.perf_counter()
+import vmware.inventory
+print(time.perf_counter() - t)
+print('pyVmomi' in sys.modules)
+"""
+
+
+def measure_cold_import(runs):
+    """ Returns the import times of vmware.inventory in fresh interpreters """
+    samples = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, "-c", IMPORT_SNIPPET], cwd=str(SETUP_DIRECTORY))
+        elapsed, pyvmomi_loaded = output.decode().split()
+        samples.append(float(elapsed))
+    return samples, pyvmomi_loaded == "True"
+
+
+def warm_cache(cache_file):
+    """ Writes a state cache in which one VM is leased to BENCH_OWNER """
+    inv = Inventory()
+    inv.initialize_inventory()
+    cache = StateCache(path=cache_file)
+    for host in inv.hosts:
+        vms = [vm for vm in inv.vms if vm.host is host]
+        entries = dict()
+        for i, vm in enumerate(vms):
+            state = {'power_state': 'poweredOn', 'in_ci_use': False, 'lease_expiry': None}
+            if host is inv.hosts[0] and i == 0:
+                state['in_ci_use'] = BENCH_OWNER
+            entries[vm.name] = {'id': None, 'change_version': None, 'state': state}
+        cache.store_host(host.name, entries)
+
+
+def measure_first_byte(cache_file, runs):
+    """
+    Returns the times from spawning get_vcn.py until its first stdout byte,
+    and whether every run answered with the leased VM
+    """
+    query = json.dumps({
+        'controller_hostname': BENCH_OWNER,
+        'cache_file': cache_file,
+        'cache_ttl': '3600',
+    }).encode()
+    samples = []
+    answered = True
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            [sys.executable, "get_vcn.py"], cwd=str(SETUP_DIRECTORY),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        proc.stdin.write(query)
+        proc.stdin.close()
+        first = proc.stdout.read(1)
+        samples.append(time.perf_counter() - start)
+        rest = proc.stdout.read()
+        proc.wait()
+        answered = answered and proc.returncode == 0 and bool(first + rest)
+    return samples, answered
+
+
+def summarize(samples):
+    return {
+        'min': min(samples),
+        'median': statistics.median(samples),
+        'max': max(samples),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='get_vcn.py startup benchmark')
+    parser.add_argument('--runs', type=int, default=10, help='runs per measurement')
+    parser.add_argument('--output', help='JSONL file the result is appended to')
+    parser.add_argument('--label', help='release or commit the result belongs to')
+    args = parser.parse_args()
+
+    import_samples, pyvmomi_on_import = measure_cold_import(args.runs)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_file = os.path.join(tmp_dir, 'state.json')
+        warm_cache(cache_file)
+        ttfb_samples, answered = measure_first_byte(cache_file, args.runs)
+
+    result = {
+        'label': args.label,
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'runs': args.runs,
+        'cold_import_s': summarize(import_samples),
+        'pyvmomi_imported_on_import': pyvmomi_on_import,
+        'time_to_first_byte_s': summarize(ttfb_samples),
+        'answered_from_cache': answered,
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(result) + '\n')
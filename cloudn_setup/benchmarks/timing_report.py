@@ -0,0 +1,95 @@
+"""
+Report and regression check over the timing history that cloudn_setup.py
+and smoke_test.py append every run to.
+
+  report: per software version, the percentiles of every phase duration
+  check:  compares a candidate version with a baseline version and exits
+          with status 1 if any phase regressed past the thresholds
+
+Run from the cloudn_setup directory:
+    python3 benchmarks/timing_report.py report --history ../timing_history.jsonl
+    python3 benchmarks/timing_report.py check --history ../timing_history.jsonl \
+        --script smoke_test --max_increase 60
+"""
+import argparse
+import json
+from pathlib import Path
+import sys
+
+
+SETUP_DIRECTORY = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(SETUP_DIRECTORY))
+
+from common.timing_history import (DEFAULT_PERCENTILES, TimingHistory, find_regressions,
+                                   summarize, versions_in_order)
+
+
+def format_summary(summary, percentiles):
+    columns = ['p{}'.format(pct) for pct in percentiles] + ['max']
+    lines = list()
+    for version, phases in summary.items():
+        lines.append("version {}".format(version))
+        lines.append("  {:<32} {:>6} ".format('phase', 'runs') +
+                     " ".join("{:>9}".format(column) for column in columns))
+        for name, stats in phases.items():
+            lines.append("  {:<32} {:>6} ".format(name, stats['count']) +
+                         " ".join("{:>9.1f}".format(stats[column]) for column in columns))
+    return "\n".join(lines)
+
+
+def format_comparisons(comparisons, baseline, candidate, pct):
+    lines = ["p{} {} -> {}".format(pct, baseline, candidate),
+             "  {:<32} {:>9} {:>9} {:>9} {:>7}".format(
+                 'phase', 'baseline', 'candidate', 'delta', 'ratio')]
+    for entry in comparisons:
+        lines.append("  {:<32} {:>9.1f} {:>9.1f} {:>+9.1f} {:>+6.0%}{}".format(
+            entry['phase'], entry['baseline'], entry['candidate'], entry['increase'],
+            entry['ratio'], '  REGRESSION' if entry['regression'] else ''))
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Phase timing history report')
+    parser.add_argument('command', choices=['report', 'check'])
+    parser.add_argument('--history', help='timing history file')
+    parser.add_argument('--script', help='only runs of this script (cloudn_setup, smoke_test)')
+    parser.add_argument('--device', help='only runs against this device')
+    parser.add_argument('--json', action='store_true', help='print JSON instead of a table')
+    parser.add_argument('--baseline', help='check: baseline version (default: the one before candidate)')
+    parser.add_argument('--candidate', help='check: version under test (default: the latest)')
+    parser.add_argument('--percentile', type=int, default=50,
+                        help='check: percentile compared between versions')
+    parser.add_argument('--max_increase', type=float, default=30,
+                        help='check: seconds a phase may get slower')
+    parser.add_argument('--max_ratio', type=float, default=0.2,
+                        help='check: fraction of the baseline a phase may get slower')
+    parser.add_argument('--min_samples', type=int, default=1,
+                        help='check: runs needed per version to compare a phase')
+    args = parser.parse_args()
+
+    records = TimingHistory(args.history).load(script=args.script, device=args.device)
+    if not records:
+        sys.exit("No timing records found")
+
+    if args.command == 'report':
+        summary = summarize(records)
+        print(json.dumps(summary, indent=2) if args.json
+              else format_summary(summary, DEFAULT_PERCENTILES))
+        sys.exit(0)
+
+    versions = versions_in_order(records)
+    candidate = args.candidate or versions[-1]
+    if candidate not in versions:
+        sys.exit("No runs of candidate version {}".format(candidate))
+    baseline = args.baseline
+    if baseline is None:
+        if versions.index(candidate) == 0:
+            sys.exit("No version before {} to compare with".format(candidate))
+        baseline = versions[versions.index(candidate) - 1]
+
+    comparisons = find_regressions(
+        records, baseline, candidate, pct=args.percentile, max_increase=args.max_increase,
+        max_ratio=args.max_ratio, min_samples=args.min_samples)
+    print(json.dumps(comparisons, indent=2) if args.json
+          else format_comparisons(comparisons, baseline, candidate, args.percentile))
+    sys.exit(1 if any(entry['regression'] for entry in comparisons) else 0)
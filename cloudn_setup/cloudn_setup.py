@@ -5,7 +5,13 @@ import requests
 import sys
 import time
 
-from vmware.inventory import Inventory
+from common.api_client import (ApiError, cid_cache, get_client, is_invalid_cid_response,
+                               log_metrics)
+from common.polling import Poller
+from common.timing_history import TimingHistory, TimingRun
+from common.tracing import tracer
+from vmware.inventory import Inventory, LeaseConflictError
+from vmware.state_cache import StateCache
 import vmware.utils as utils
 
 logging.basicConfig(
@@ -18,96 +24,192 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-def get_cid_url(hostame, username, passwd):
-    api_url = 'https://{}/v1/api'.format(hostame)
-    backend_url = 'https://{}/v1/backend1'.format(hostame)
+# Seconds the CloudN is given to answer again after a reset or an upgrade
+RESET_READY_TIMEOUT = 600
+UPGRADE_READY_TIMEOUT = 1200
+# Suffix of upgrade targets meaning the latest build of a release, e.g. "6.7-patch"
+PATCH_SUFFIX = '-patch'
 
-    payload = {
-        "action": "login",
-        "username": username,
-        "password": passwd
-    }
+def login(hostame, username, passwd):
+    """ Logs in to a controller or CloudN and returns its shared API client """
+    client = get_client(hostame)
+    cid = client.login(username, passwd)
+    logger.info("{} CID = {}".format(hostame, cid))
+    return client
 
-    response = requests.get(api_url, params=payload, verify=False)
-    logger.info("response: %s" % response.json())
-
-    if response.status_code not in range(200, 207) or not response.json().get('return'):
-        raise RuntimeError("Cannot acquire CID.")
-    else:
-        cid = response.json().get('CID')
-
-    logger.info("CloudN CID = {}".format(cid))
-    return (cid, api_url, backend_url)
-
-
-def register(CID, URL, controller_hostname, controller_username, controller_passwd, cloudn_name):
-    payload = {'action': 'register_caag_with_controller',
-               'CID': CID,
-               'controller_ip_or_fqdn': controller_hostname,
-               'username': controller_username,
-               'password': controller_passwd,
-               'gateway_name': cloudn_name
-               }
-
-    response = requests.post(URL, data=payload, verify=False)
-    if response.status_code not in range(200, 207) or not response.json().get('return'):
-        raise RuntimeError(
-            "CloudN Register to Controller Failure. {}".format(response.json()))
-
-    logger.info('RESULT: {}'.format(response.json().get('results')))
 
+def register(client, controller_hostname, controller_username, controller_passwd, cloudn_name):
+    try:
+        rsp_dict = client.call('register_caag_with_controller',
+                               controller_ip_or_fqdn=controller_hostname,
+                               username=controller_username,
+                               password=controller_passwd,
+                               gateway_name=cloudn_name)
+    except ApiError as e:
+        raise RuntimeError("CloudN Register to Controller Failure. {}".format(e))
 
-def upgrade(hostame, username, passwd, version):
-    cid ,api_url, backend_url = get_cid_url(hostame, username, passwd)
+    logger.info('RESULT: {}'.format(rsp_dict.get('results')))
 
-    payload_upgrade = {'action': 'upgrade',
-               'CID': cid,
-               'version': version,
-               }
 
+def get_version_info(hostame, username, passwd):
+    client = login(hostame, username, passwd)
     try:
-        requests.post(api_url, data=payload_upgrade, verify=False, timeout=5)
+        rsp_dict = client.call('list_version_info', timeout=30)
+    except ApiError as e:
+        raise RuntimeError("Get Version FAIL, {}".format(e))
+    return rsp_dict.get("results")
+
+
+def version_reached(current_version, target_version=None, previous_version=None):
+    """
+    Checks whether current_version (e.g. "UserConnect-6.8.1148") matches
+    target_version (e.g. "6.8", "6.8.1148" or "6.8-patch", any build of
+    6.8). Without a usable target, any version different from
+    previous_version counts as reached.
+    """
+    if not current_version:
+        return False
+    if not target_version or target_version == 'latest':
+        return previous_version is None or current_version != previous_version
+    if target_version.endswith(PATCH_SUFFIX):
+        target_version = target_version[:-len(PATCH_SUFFIX)]
+    number = current_version.split('-')[-1]
+    return number == target_version or number.startswith(target_version + '.')
+
+
+def wait_for_cloudn_restart(hostame, timeout, cid=None, previous_version=None,
+                            initial_interval=2, max_interval=15):
+    """
+    Polls list_version_info until there is a sign that the CloudN restarted:
+    it stops answering or answers with an HTTP error, it rejects cid (the
+    CID of the session from before the restart), or it reports a version
+    other than previous_version. Readiness probes started before that could
+    be answered by the device as it was before the reset or upgrade.
+    Returns a description of the sign, or raises TimeoutError.
+    """
+    client = get_client(hostame)
+
+    def probe():
+        params = {'CID': cid} if cid else {}
+        try:
+            response = client.request('list_version_info', timeout=10, **params)
+        except requests.exceptions.RequestException as e:
+            return "unreachable ({})".format(e.__class__.__name__)
+        if response.status_code >= 500:
+            return "HTTP {}".format(response.status_code)
+        if cid and is_invalid_cid_response(response):
+            return "previous CID rejected"
+        try:
+            current_version = (response.json().get("results") or {}).get("current_version")
+        except (ValueError, AttributeError):
+            return None
+        if previous_version and current_version and current_version != previous_version:
+            return "version changed to {}".format(current_version)
+        return None
+
+    poller = Poller(deadline=timeout, initial_interval=initial_interval,
+                    max_interval=max_interval, jitter=0.5)
+    sign = poller.run(probe)
+    if not sign:
+        raise TimeoutError("CloudN {} showed no sign of restarting after {} seconds".format(
+            hostame, timeout))
+    logger.info("CloudN {} is restarting: {}".format(hostame, sign))
+    return sign
+
+
+def wait_for_cloudn_ready(hostame, username, passwd, timeout, target_version=None,
+                          previous_version=None, initial_interval=5, max_interval=60):
+    """
+    Polls login plus list_version_info with exponential backoff and jitter
+    until the CloudN answers and reports the target version (see
+    version_reached). Returns the version info, or raises TimeoutError once
+    timeout seconds have passed.
+    """
+    def probe():
+        try:
+            version_info = get_version_info(hostame, username, passwd)
+        except (requests.exceptions.RequestException, RuntimeError, ValueError) as e:
+            logger.info("CloudN {} not ready: {}".format(hostame, e))
+            return None
+        current_version = version_info.get("current_version")
+        if version_reached(current_version, target_version, previous_version):
+            return version_info
+        logger.info("CloudN {} reports version {}, waiting for {}".format(
+            hostame, current_version, target_version or "a new version"))
+        return None
+
+    poller = Poller(deadline=timeout, initial_interval=initial_interval,
+                    max_interval=max_interval, jitter=0.5)
+    version_info = poller.run(probe)
+    if not version_info:
+        raise TimeoutError("CloudN {} not ready with version {} after {} seconds".format(
+            hostame, target_version or "any", timeout))
+    logger.info("CloudN {} ready with version {} after {} attempts".format(
+        hostame, version_info.get("current_version"), len(poller.attempts)))
+    return version_info
+
+
+def upgrade(hostame, username, passwd, version, timeout=UPGRADE_READY_TIMEOUT):
+    previous_version = get_version_info(hostame, username, passwd).get("current_version")
+    client = get_client(hostame)
+    deadline = time.monotonic() + timeout
+    upgrade_cid = client.cid
 
-    except requests.exceptions.ReadTimeout: 
+    try:
+        client.call('upgrade', timeout=5, version=version)
+    except requests.exceptions.ReadTimeout:
+        # the upgrade started before the CloudN answered
         pass
-    time.sleep(420)
-
-    # logout
-    requests.post(api_url, data={'action': 'logout', 'CID': cid}, verify=False)
-    time.sleep(10)
-    cid ,api_url, backend_url = get_cid_url(hostame, username, passwd)
-    payload_get_ver = {'action': 'list_version_info', 'CID':cid}
-    response = requests.post(api_url, data=payload_get_ver, verify=False)
-    if response.status_code not in range(200, 207) or not response.json().get('return'):
-        raise RuntimeError("Get Version FAIL, {}".format(response.json()))
-    upgrade_version = response.json().get("results").get("current_version").split('.')[-1]
+    except ApiError as e:
+        raise RuntimeError("CloudN Upgrade Failure. {}".format(e))
+
+    # a "-patch" target may still move to a newer build of the running release
+    if version_reached(previous_version, version) and not version.endswith(PATCH_SUFFIX):
+        logger.info("CloudN {} already runs {}".format(hostame, previous_version))
+    else:
+        # the device still reports previous_version until the upgrade restarts it
+        wait_for_cloudn_restart(hostame, timeout, cid=upgrade_cid,
+                                previous_version=previous_version)
+        client.logout()
+
+    version_info = wait_for_cloudn_ready(
+        hostame, username, passwd, max(deadline - time.monotonic(), 1),
+        target_version=version, previous_version=previous_version)
+    upgrade_version = version_info.get("current_version").split('.')[-1]
 
     logger.info(upgrade_version)
 
     logger.info('Upgrade successfully.')
+    return version_info.get("current_version")
 
 
-def reset_caag(CID, URL):
-    payload = {'action': 'reset_caag_to_cloudn_factory_state_by_cloudn',
-               'CID': CID}
-    response = requests.post(URL, data=payload, verify=False)
-    if response.status_code not in range(200, 207) or not response.json().get('return'):
-        raise RuntimeError("CaaG Reset Failure. {}".format(response.json()))
-    logger.info('RESULT: {}'.format(response.json().get('results')))
+def reset_caag(client):
+    try:
+        rsp_dict = client.call('reset_caag_to_cloudn_factory_state_by_cloudn')
+    except ApiError as e:
+        raise RuntimeError("CaaG Reset Failure. {}".format(e))
+    logger.info('RESULT: {}'.format(rsp_dict.get('results')))
 
 
 def reset_caag_from_controller(controller_hostname, controller_username, controller_passwd, cloudn_name):
 
-    cid ,api_url, backend_url = get_cid_url(controller_hostname, controller_username, controller_passwd)
+    client = login(controller_hostname, controller_username, controller_passwd)
 
-    payload = {'action': 'reset_managed_cloudn_to_factory_state',
-               'CID': cid,
-               'device_name': cloudn_name}
-    response = requests.post(api_url, data=payload, verify=False)
-    if response.status_code not in range(200, 207) or not response.json().get('return'):
+    try:
+        rsp_dict = client.call('reset_managed_cloudn_to_factory_state',
+                               device_name=cloudn_name)
+    except ApiError as e:
         raise RuntimeError(
-            "CaaG Reset From Controller Failure. {}".format(response.json()))
-    logger.info('RESULT: {}'.format(response.json().get('results')))
+            "CaaG Reset From Controller Failure. {}".format(e))
+    logger.info('RESULT: {}'.format(rsp_dict.get('results')))
+
+
+def set_vcn_tags(vcn, **values):
+    """ Records state values on the vCloudN VM; a failing write never fails the run """
+    try:
+        vcn.set_tags(**values)
+    except Exception as e:
+        logger.warning("Cannot tag %s with %s: %s", vcn.name, values, e)
 
 
 if __name__ == '__main__':
@@ -123,6 +225,21 @@ if __name__ == '__main__':
         '--vcn_snapname', help='vcn snapshot name', required=False)
     parser.add_argument(
         '--version', help='CloudN upgrade Version', required=False)
+    parser.add_argument(
+        '--reset_timeout', help='seconds to wait for CloudN after reset',
+        type=int, default=RESET_READY_TIMEOUT, required=False)
+    parser.add_argument(
+        '--upgrade_timeout', help='seconds to wait for CloudN after upgrade',
+        type=int, default=UPGRADE_READY_TIMEOUT, required=False)
+    parser.add_argument(
+        '--cid_cache', help='file CIDs are cached in across runs', required=False)
+    parser.add_argument(
+        '--state_cache', help='VM state cache file shared with get_vcn.py', required=False)
+    parser.add_argument(
+        '--timing_history', help='file the step durations are appended to, "" to disable',
+        required=False)
+    parser.add_argument(
+        '--trace_file', help='file a Chrome trace of the run is written to', required=False)
     parser.add_argument('--cntrl_hostname',
                         help='controller hostname', required=True)
     parser.add_argument('--cntrl_username',
@@ -133,6 +250,10 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     logger.info('Input arguments: {}'.format(args))
+    if args.cid_cache:
+        cid_cache.path = args.cid_cache
+    if args.trace_file:
+        tracer.enable(args.trace_file)
     op_code = args.op_code
     hostame = args.cn_hostame
     username = args.cn_username
@@ -145,70 +266,99 @@ if __name__ == '__main__':
     upgrade_version = args.version
 
 
-    # relase VCN's marking
-    if op_code == '0':
-        logger.info("step 1: First time login cloudn")
-        cid ,api_url, backend_url = get_cid_url(hostame, username, passwd)
-        logger.info("step 2: Reset CaaG")
-        reset_caag(CID=cid, URL=api_url)
-
-        logger.info("step 3: Reset CaaG from Controller")
-        reset_caag_from_controller(controller_hostname=controller_hostname, controller_username=controller_username,
-                                   controller_passwd=controller_passwd, cloudn_name=cloudn_name)
-
-        logger.info('step 4: Release vCloudN from Exsi')
-        inv = Inventory()
-        inv.initialize_inventory()
-        inv.refresh_inventory_state()
-        vcn = inv.get_inventory_object('vm', cloudn_name)
-
-        # set cloudn state to False
-        vcn.state.in_ci_use = False
-        vcn.update_tags()
-        logger.info(vcn.state.__dict__)
-
-        # revert vcn to golden Img
-        try:
-            if vcn_snapshot_name == "":
-                vcn_snapshot_name = None
-            utils.revert_vm_to_snapshot(vcn, vcn_snapshot_name)
-
-        except Exception as e:
-            raise Exception(e)
-
-    # registration VCN and mark it in using.
-    elif op_code == '1':
-        logger.info("step 1: First time login cloudn")
-        cid ,api_url, backend_url = get_cid_url(hostame, username, passwd)
-
-        logger.info("step 2: set vcloudn state to occupied")
-        try:
-            inv = Inventory()
+    timing = TimingRun(
+        'cloudn_setup', device=cloudn_name, version=upgrade_version,
+        history=TimingHistory(args.timing_history) if args.timing_history != "" else None)
+    result = "FAIL"
+    try:
+        # relase VCN's marking
+        if op_code == '0':
+            logger.info("step 1: First time login cloudn")
+            with timing.phase('login'):
+                cloudn = login(hostame, username, passwd)
+            logger.info("step 2: Reset CaaG")
+            with timing.phase('reset'):
+                reset_caag(cloudn)
+
+            logger.info("step 3: Reset CaaG from Controller")
+            with timing.phase('reset_from_controller'):
+                reset_caag_from_controller(controller_hostname=controller_hostname, controller_username=controller_username,
+                                           controller_passwd=controller_passwd, cloudn_name=cloudn_name)
+
+            logger.info('step 4: Release vCloudN from Exsi')
+            inv = Inventory(state_cache=StateCache(path=args.state_cache))
             inv.initialize_inventory()
-            inv.refresh_inventory_state()
+            inv.refresh_inventory_state(max_age=0)
             vcn = inv.get_inventory_object('vm', cloudn_name)
-            # set cloudn state to controller hostname
-            vcn.state.in_ci_use = controller_hostname
-            vcn.update_tags()
-            logger.info(vcn.state.__dict__)
-        except Exception as e:
-            raise Exception(e)
-
-        logger.info("step 3: Reset CaaG")
-        reset_caag(CID=cid, URL=api_url)
-        time.sleep(90)
-
-        logger.info("step 3: Upgrade CloudN")
-        upgrade(hostame, username, passwd, version=upgrade_version)
-
-        cid ,api_url, backend_url = get_cid_url(hostame, username, passwd)
-        logger.info("step 4: Register CloudN to Controller")
-        register(
-            CID=cid, URL=api_url,
-            controller_hostname=controller_hostname,
-            controller_username=controller_username,
-            controller_passwd=controller_passwd,
-            cloudn_name=cloudn_name)
-
-        logger.info("Congratulation! CloudN register to Controller is set!!")
-
+            logger.info(vcn.state.as_dict())
+
+            # revert vcn to golden Img, still leased so nobody is handed it meanwhile
+            reverted = False
+            try:
+                if vcn_snapshot_name == "":
+                    vcn_snapshot_name = None
+                with timing.phase('revert_snapshot'):
+                    reverted = utils.revert_vm_to_snapshot(vcn, vcn_snapshot_name)
+
+            except Exception as e:
+                raise Exception(e)
+            finally:
+                # release the lease on the cloudn
+                values = dict(last_reset=time.time()) if reverted else dict()
+                if not vcn.release_reverted(controller_hostname, **values):
+                    logger.warning("vCloudN {} was leased by someone else during the revert, "
+                                   "leaving it leased".format(vcn.name))
+
+        # registration VCN and mark it in using.
+        elif op_code == '1':
+            logger.info("step 1: First time login cloudn")
+            with timing.phase('login'):
+                cloudn = login(hostame, username, passwd)
+
+            logger.info("step 2: set vcloudn state to occupied")
+            try:
+                inv = Inventory(state_cache=StateCache(path=args.state_cache))
+                inv.initialize_inventory()
+                inv.refresh_inventory_state(max_age=0)
+                vcn = inv.get_inventory_object('vm', cloudn_name)
+                if not vcn.can_claim(controller_hostname):
+                    raise LeaseConflictError("{} is leased to {} until {}".format(
+                        vcn.name, vcn.state.in_ci_use, vcn.state.lease_expiry or "released"))
+                # lease the cloudn to the controller until it is released
+                vcn.claim(controller_hostname, lease_seconds=None)
+                logger.info(vcn.state.as_dict())
+            except Exception as e:
+                raise Exception(e)
+
+            logger.info("step 3: Reset CaaG")
+            with timing.phase('reset_until_ready'):
+                deadline = time.monotonic() + args.reset_timeout
+                reset_cid = cloudn.cid
+                reset_caag(cloudn)
+                # probe for readiness only once the reset took the device down
+                wait_for_cloudn_restart(hostame, args.reset_timeout, cid=reset_cid)
+                wait_for_cloudn_ready(hostame, username, passwd,
+                                      max(deadline - time.monotonic(), 1))
+
+            logger.info("step 3: Upgrade CloudN")
+            with timing.phase('upgrade'):
+                timing.version = upgrade(hostame, username, passwd, version=upgrade_version,
+                                         timeout=args.upgrade_timeout)
+            set_vcn_tags(vcn, software_version=timing.version)
+
+            cloudn = login(hostame, username, passwd)
+            logger.info("step 4: Register CloudN to Controller")
+            with timing.phase('register'):
+                register(
+                    cloudn,
+                    controller_hostname=controller_hostname,
+                    controller_username=controller_username,
+                    controller_passwd=controller_passwd,
+                    cloudn_name=cloudn_name)
+
+            logger.info("Congratulation! CloudN register to Controller is set!!")
+        result = "PASS"
+    finally:
+        timing.save(result)
+
+    log_metrics()
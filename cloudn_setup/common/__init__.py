@@ -0,0 +1 @@
+""" Helpers shared by cloudn_setup.py and smoke_test.py """
@@ -0,0 +1,236 @@
+from collections import defaultdict
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common.cid_cache import CidCache
+from common.tracing import tracer
+
+requests.packages.urllib3.disable_warnings()
+
+
+logger = logging.getLogger(__name__)
+
+# (connect, read) timeout in seconds applied to every call unless overridden
+DEFAULT_TIMEOUT = (10, 120)
+# Max number of keep-alive connections kept per endpoint
+DEFAULT_POOL_SIZE = 10
+# "http" points the clients at a plain HTTP endpoint such as common.api_standin
+API_SCHEME = os.environ.get("AVX_API_SCHEME", "https")
+# File every response is appended to, for replay by common.api_standin
+TRANSCRIPT_FILE = os.environ.get("AVX_API_TRANSCRIPT")
+_transcript_lock = threading.Lock()
+
+
+class ApiError(RuntimeError):
+    """ Raised when an API call fails or returns "return": false """
+
+    def __init__(self, message, response=None):
+        super(ApiError, self).__init__(message)
+        self.response = response
+
+
+def is_invalid_cid_response(response):
+    """ Checks whether the server rejected the call because of the CID """
+    try:
+        rsp_dict = response.json()
+    except ValueError:
+        return False
+    if not isinstance(rsp_dict, dict) or rsp_dict.get("return") is not False:
+        return False
+    reason = str(rsp_dict.get("reason", "")).lower()
+    return "cid" in reason and ("invalid" in reason or "expire" in reason)
+
+
+def record_transcript(action, response, elapsed):
+    """ Appends a response to TRANSCRIPT_FILE """
+    try:
+        body = response.json()
+    except ValueError:
+        body = response.text
+    line = json.dumps({"action": action, "status": response.status_code,
+                       "body": body, "elapsed": elapsed})
+    with _transcript_lock:
+        with open(TRANSCRIPT_FILE, "a") as f:
+            f.write(line + "\n")
+
+
+class AviatrixApiClient():
+    """
+    Client for the /v1/api action protocol of an Aviatrix controller or
+    CloudN. All calls go through one pooled requests.Session, so the TCP and
+    TLS sessions are kept alive across calls, every call has a timeout, and
+    the latency of each call is recorded per action.
+
+    Logins reuse a valid CID from cid_cache. A call rejected for an invalid
+    or expired CID logs in again once and is replayed with the new CID.
+    """
+
+    def __init__(self, hostname, api_version="v1", timeout=DEFAULT_TIMEOUT,
+                 pool_size=DEFAULT_POOL_SIZE, cid_cache=None):
+        self.hostname = hostname
+        self.cid_cache = cid_cache or CidCache()
+        self._credentials = None
+        self._login_lock = threading.Lock()
+        self.api_url = "{}://{}/{}/api".format(API_SCHEME, hostname, api_version)
+        self.backend_url = "{}://{}/{}/backend1".format(API_SCHEME, hostname, api_version)
+        self.timeout = timeout
+        self.cid = None
+
+        self.session = requests.Session()
+        self.session.verify = False
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._latencies = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def request(self, action, method="post", timeout=None, **params):
+        """
+        Sends an action and returns the raw response. The CID of the client is
+        added unless params already has one, and renewed once if the server
+        rejects it.
+        """
+        cid = self.cid
+        if not cid or "CID" in params:
+            return self._send(action, method, timeout, params)
+
+        response = self._send(action, method, timeout, dict(params, CID=cid))
+        if self._credentials is None or not is_invalid_cid_response(response):
+            return response
+        logger.info("%s rejected the CID for %s, logging in again", self.hostname, action)
+        cid = self._relogin(cid)
+        return self._send(action, method, timeout, dict(params, CID=cid))
+
+    def _relogin(self, stale_cid):
+        """ Logs in again unless another thread already replaced stale_cid """
+        with self._login_lock:
+            if self.cid == stale_cid:
+                username, password = self._credentials
+                self.cid_cache.invalidate(self.hostname, username, stale_cid)
+                self.login(username, password, use_cache=False)
+            return self.cid
+
+    def _send(self, action, method, timeout, params):
+        payload = {"action": action}
+        payload.update(params)
+
+        start = time.monotonic()
+        response = None
+        try:
+            with tracer.span(action, category='api', host=self.hostname, method=method):
+                if method == "get":
+                    response = self.session.get(
+                        self.api_url, params=payload, timeout=timeout or self.timeout)
+                else:
+                    response = self.session.post(
+                        self.api_url, data=payload, timeout=timeout or self.timeout)
+            return response
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self._latencies[action].append(elapsed)
+            logger.debug("%s %s took %.3f s", self.hostname, action, elapsed)
+            if TRANSCRIPT_FILE and response is not None:
+                record_transcript(action, response, elapsed)
+
+    def call(self, action, method="post", timeout=None, check=True, **params):
+        """
+        Sends an action and returns the decoded response. Raises ApiError on a
+        non-2xx status, or if check is set and the response has "return": false.
+        """
+        response = self.request(action, method=method, timeout=timeout, **params)
+        return self._check(action, response, check)
+
+    def _check(self, action, response, check=True):
+        """ Decodes a response, raising ApiError as described in call() """
+        if response.status_code not in range(200, 207):
+            raise ApiError("{} {} returned HTTP {}".format(
+                self.hostname, action, response.status_code), response)
+        rsp_dict = response.json()
+        if check and not rsp_dict.get("return"):
+            raise ApiError("{} {} failed: {}".format(
+                self.hostname, action, rsp_dict), response)
+        return rsp_dict
+
+    def login(self, username, password, use_cache=True):
+        """
+        Returns a CID for the user, which is then added to every call. A
+        cached CID is reused unless use_cache is False.
+        """
+        self._credentials = (username, password)
+        if use_cache:
+            cid = self.cid_cache.get(self.hostname, username)
+            if cid:
+                self.cid = cid
+                return cid
+
+        # sent without the CID, which concurrent calls keep using until
+        # the new one has arrived
+        try:
+            rsp_dict = self._check("login", self._send(
+                "login", "get", None, {"username": username, "password": password}))
+        except ApiError as e:
+            raise RuntimeError("Cannot acquire CID. {}".format(e))
+        self.cid = rsp_dict.get("CID")
+        self.cid_cache.put(self.hostname, username, self.cid)
+        return self.cid
+
+    def logout(self):
+        if not self.cid:
+            return
+        cid = self.cid
+        try:
+            self._send("logout", "post", 5, {"CID": cid})
+        except requests.exceptions.RequestException as e:
+            logger.debug("Logout from %s failed: %s", self.hostname, e)
+        if self._credentials is not None:
+            self.cid_cache.invalidate(self.hostname, self._credentials[0], cid)
+        self.cid = None
+
+    def metrics(self):
+        """ Returns call count and latency statistics per action """
+        with self._lock:
+            latencies = {action: list(values) for action, values in self._latencies.items()}
+        return {action: {
+            "count": len(values),
+            "total": sum(values),
+            "avg": sum(values) / len(values),
+            "max": max(values),
+        } for action, values in latencies.items()}
+
+    def close(self):
+        self.session.close()
+
+
+# CID cache shared by the clients of get_client; set its path (or the
+# AVX_CID_CACHE_FILE environment variable) to share CIDs across processes
+cid_cache = CidCache(path=os.environ.get("AVX_CID_CACHE_FILE"))
+
+_clients = dict()
+_clients_lock = threading.Lock()
+
+
+def get_client(hostname):
+    """ Returns the client shared by every caller of the endpoint """
+    with _clients_lock:
+        client = _clients.get(hostname)
+        if client is None:
+            client = _clients[hostname] = AviatrixApiClient(hostname, cid_cache=cid_cache)
+        return client
+
+
+def log_metrics():
+    """ Logs the latency statistics of every shared client """
+    with _clients_lock:
+        clients = list(_clients.values())
+    for client in clients:
+        for action, stats in sorted(client.metrics().items()):
+            logger.info("%s %s: %d calls, avg %.3f s, max %.3f s", client.hostname,
+                        action, stats["count"], stats["avg"], stats["max"])
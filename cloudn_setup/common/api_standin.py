@@ -0,0 +1,406 @@
+"""
+Offline stand-in for the /v1/api action protocol of an Aviatrix controller
+or CloudN, so cloudn_setup.py and smoke_test.py can run (and be timed)
+without live devices. Point the scripts at it with AVX_API_SCHEME=http (or
+run it with TLS) and a host:port hostname.
+
+Behaviour comes from a scenario (JSON or YAML), all keys optional:
+
+    seed: 1                       # makes latency and error injection repeatable
+    cid_ttl: 600                  # seconds an issued CID stays valid
+    latency:                      # seconds, a number or [min, max], per action
+      default: 0.02
+      list_version_info: [0.1, 0.4]
+    errors:                       # per action or default
+      list_gateway_upgrade_status: {rate: 0.1, status: 502}
+      run_site2cloud_diag: {rate: 0.05, reason: "Diag is busy"}
+      login: {rate: 0.01, delay: 30}
+    device:                       # list_version_info results
+      current_version: UserConnect-6.8.1148
+      kernel_version: 5.4.0-1045-aws
+    gateways:                     # list_gateway_upgrade_status entries by name
+      cloudn-1: {vpc_state: up, update_status: complete}
+    events:                       # state timelines started by an action
+      upgrade_selected_gateway:
+        gateways:                 # applied to the gateways in gateway_list
+          - [0, {update_status: in_progress}]
+          - [90, {update_status: complete}]
+      upgrade:
+        device:
+          - [0, {unavailable: true}]   # answers 502 while rebooting
+          - [120, {unavailable: false}]
+    transcript: recorded.jsonl    # responses replayed in order per action
+
+A transcript is a JSONL file as written by AviatrixApiClient when
+AVX_API_TRANSCRIPT is set: {"action", "status", "body", "elapsed"} per line.
+Replayed actions answer with their recorded bodies in order, the last one
+repeating, after the recorded latency unless latency overrides it.
+
+Run standalone from the cloudn_setup directory:
+    python3 -m common.api_standin --port 8443 --scenario scenario.yaml
+GET /standin/stats returns the request counts and latencies per action.
+"""
+import argparse
+import copy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import random
+import ssl
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DEVICE = {
+    'current_version': 'UserConnect-6.8.1148',
+    'previous_version': 'UserConnect-6.7.1376',
+    'kernel_version': '5.4.0-1045-aws',
+    'unavailable': False,
+}
+DEFAULT_GATEWAY = {'vpc_state': 'up', 'update_status': 'complete'}
+
+
+def load_scenario(path):
+    """ Returns the scenario dict of a JSON or YAML file """
+    with open(path, 'r') as f:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml
+            return yaml.safe_load(f) or dict()
+        return json.load(f)
+
+
+def load_transcript(path):
+    """ Returns the recorded responses of a transcript file, in order per action """
+    responses = dict()
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                responses.setdefault(entry['action'], []).append(entry)
+    return responses
+
+
+class Timeline():
+    """ State changes applied at offsets (seconds) from the moment an event fired """
+
+    def __init__(self, steps, started):
+        self.steps = sorted(steps, key=lambda step: step[0])
+        self.started = started
+
+    def apply(self, state, now):
+        elapsed = now - self.started
+        for offset, changes in self.steps:
+            if offset > elapsed:
+                break
+            state.update(changes)
+        return state
+
+
+class StandInState():
+    """ Device and gateway state of the stand-in, as changed by events """
+
+    def __init__(self, scenario):
+        self.lock = threading.Lock()
+        self.device = dict(DEFAULT_DEVICE, **scenario.get('device', {}))
+        self.gateways = {name: dict(DEFAULT_GATEWAY, **(info or {}))
+                         for name, info in scenario.get('gateways', {}).items()}
+        self.events = scenario.get('events', {})
+        self.device_timelines = list()
+        self.gateway_timelines = dict()
+        self.cid_ttl = scenario.get('cid_ttl')
+        self.cids = dict()
+
+    def fire(self, action, params):
+        """ Starts the timelines the scenario attaches to action """
+        event = self.events.get(action)
+        if not event:
+            return
+        now = time.monotonic()
+        with self.lock:
+            if 'device' in event:
+                self.device_timelines.append(Timeline(event['device'], now))
+            if 'gateways' in event:
+                names = [name for name in str(params.get('gateway_list', '')).split(',') if name]
+                for name in names or list(self.gateways):
+                    self.gateway_timelines.setdefault(name, []).append(
+                        Timeline(event['gateways'], now))
+
+    def current_device(self):
+        now = time.monotonic()
+        with self.lock:
+            state = dict(self.device)
+            for timeline in self.device_timelines:
+                timeline.apply(state, now)
+        return state
+
+    def current_gateways(self):
+        now = time.monotonic()
+        with self.lock:
+            gateways = dict()
+            for name, base in self.gateways.items():
+                state = dict(base, name=name)
+                for timeline in self.gateway_timelines.get(name, []):
+                    timeline.apply(state, now)
+                gateways[name] = state
+        return gateways
+
+    def issue_cid(self):
+        cid = uuid.uuid4().hex
+        with self.lock:
+            self.cids[cid] = time.monotonic()
+        return cid
+
+    def cid_valid(self, cid):
+        with self.lock:
+            issued = self.cids.get(cid)
+        if issued is None:
+            return False
+        return self.cid_ttl is None or time.monotonic() - issued < self.cid_ttl
+
+
+def next_version(current, requested=None):
+    """ Returns the version an upgrade to requested (e.g. "6.9", "latest") ends at """
+    prefix, _, number = current.rpartition('-')
+    if requested and requested.endswith('-patch'):
+        # latest build of the release: the next build, or the first one
+        release = requested[:-len('-patch')]
+        if not number.startswith(release + '.'):
+            return '{}-{}.1'.format(prefix, release) if prefix else release + '.1'
+    elif requested and requested != 'latest':
+        if number == requested or number.startswith(requested + '.'):
+            return current
+        return '{}-{}'.format(prefix, requested) if prefix else requested
+    parts = number.split('.')
+    parts[-1] = str(int(parts[-1]) + 1) if parts[-1].isdigit() else parts[-1] + '1'
+    return '{}-{}'.format(prefix, '.'.join(parts)) if prefix else '.'.join(parts)
+
+
+class ApiStandIn():
+    """
+    Threaded HTTP(S) server answering the actions the scripts use. Every
+    request is counted per action with its server-side latency; stats()
+    returns the counters.
+    """
+
+    def __init__(self, scenario=None, host='127.0.0.1', port=0, certfile=None, keyfile=None):
+        self.scenario = copy.deepcopy(scenario or dict())
+        self.state = StandInState(self.scenario)
+        self.random = random.Random(self.scenario.get('seed'))
+        self.transcript = dict()
+        if self.scenario.get('transcript'):
+            self.transcript = load_transcript(self.scenario['transcript'])
+        self._replayed = dict()
+        self._stats_lock = threading.Lock()
+        self._stats = dict()
+
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.scheme = 'http'
+        if certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+            self.scheme = 'https'
+        self._thread = None
+
+    @property
+    def hostname(self):
+        """ host:port to give the scripts as controller or CloudN hostname """
+        host, port = self.server.server_address[:2]
+        return '{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name='api-standin', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stats(self):
+        """ Returns {'requests': n, 'actions': {action: {'count', 'errors', 'latency_total'}}} """
+        with self._stats_lock:
+            actions = copy.deepcopy(self._stats)
+        return {'requests': sum(entry['count'] for entry in actions.values()),
+                'actions': actions}
+
+    def _count(self, action, latency, error):
+        with self._stats_lock:
+            entry = self._stats.setdefault(
+                action, {'count': 0, 'errors': 0, 'latency_total': 0.0})
+            entry['count'] += 1
+            entry['errors'] += int(error)
+            entry['latency_total'] += latency
+
+    def _latency(self, action, recorded=None):
+        latency = self.scenario.get('latency', {})
+        value = latency.get(action, recorded if recorded is not None else latency.get('default', 0))
+        if isinstance(value, (list, tuple)):
+            return self.random.uniform(*value)
+        return value or 0
+
+    def _injected_error(self, action):
+        errors = self.scenario.get('errors', {})
+        error = errors.get(action, errors.get('default'))
+        if error and self.random.random() < error.get('rate', 1.0):
+            return error
+        return None
+
+    def _replay(self, action):
+        responses = self.transcript.get(action)
+        if not responses:
+            return None
+        with self._stats_lock:
+            index = self._replayed.get(action, 0)
+            self._replayed[action] = index + 1
+        return responses[min(index, len(responses) - 1)]
+
+    def handle(self, action, params):
+        """ Returns (HTTP status, response body dict or text) of an action """
+        start = time.monotonic()
+        status, body, error = self._dispatch(action, params)
+        self._count(action, time.monotonic() - start, error)
+        return status, body
+
+    def _dispatch(self, action, params):
+        recorded = self._replay(action)
+        time.sleep(self._latency(action, recorded.get('elapsed') if recorded else None))
+
+        injected = self._injected_error(action)
+        if injected:
+            time.sleep(injected.get('delay', 0))
+            if 'status' in injected:
+                return injected['status'], 'Injected error', True
+            if 'reason' in injected:
+                return 200, {'return': False, 'reason': injected['reason']}, True
+
+        if self.state.current_device().get('unavailable'):
+            return 502, 'Bad Gateway', True
+
+        if recorded:
+            return recorded.get('status', 200), recorded.get('body'), False
+
+        if action != 'login' and not self.state.cid_valid(params.get('CID')):
+            return 200, {'return': False, 'reason': 'CID is invalid or expired.'}, True
+
+        handler = getattr(self, 'action_' + action, None)
+        if handler is None and action.startswith('reset_'):
+            handler = self.action_reset
+        if handler is None:
+            return 200, {'return': False, 'reason': 'Unknown action {}'.format(action)}, True
+        body = handler(params)
+        self.state.fire(action, params)
+        return 200, body, not body.get('return')
+
+    def action_login(self, params):
+        return {'return': True, 'CID': self.state.issue_cid(), 'results': 'User login successful'}
+
+    def action_logout(self, params):
+        with self.state.lock:
+            self.state.cids.pop(params.get('CID'), None)
+        return {'return': True, 'results': 'User logged out'}
+
+    def action_list_version_info(self, params):
+        device = self.state.current_device()
+        device.pop('unavailable', None)
+        return {'return': True, 'results': device}
+
+    def action_list_gateway_upgrade_status(self, params):
+        return {'return': True, 'results': {'gw_info': list(self.state.current_gateways().values())}}
+
+    def action_upgrade_selected_gateway(self, params):
+        names = [name for name in str(params.get('gateway_list', '')).split(',') if name]
+        with self.state.lock:
+            for name in names:
+                self.state.gateways.setdefault(name, dict(DEFAULT_GATEWAY))
+        return {'return': True, 'results': 'Upgrade of {} started'.format(', '.join(names))}
+
+    def action_upgrade(self, params):
+        with self.state.lock:
+            device = self.state.device
+            device['previous_version'] = device['current_version']
+            device['current_version'] = next_version(device['current_version'], params.get('version'))
+        return {'return': True, 'results': 'Upgrade started'}
+
+    def action_run_site2cloud_diag(self, params):
+        return {'return': True, 'results': '{} is UP'.format(params.get('connection_name'))}
+
+    def action_register_caag_with_controller(self, params):
+        return {'return': True, 'results': 'CloudN registered with {}'.format(
+            params.get('controller_ip_or_fqdn'))}
+
+    def action_reset(self, params):
+        # a reset restarts the services, ending every session
+        with self.state.lock:
+            self.state.cids.clear()
+        return {'return': True, 'results': 'Reset started'}
+
+    def _handler_class(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                logger.debug("%s %s", self.address_string(), format % args)
+
+            def _reply(self, status, body):
+                data = (json.dumps(body) if isinstance(body, (dict, list)) else str(body)).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json' if isinstance(body, (dict, list))
+                                 else 'text/plain')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _serve(self, params):
+                path = urlsplit(self.path).path
+                if path == '/standin/stats':
+                    return self._reply(200, standin.stats())
+                if not path.endswith(('/api', '/backend1')):
+                    return self._reply(404, 'Not Found')
+                params = {key: values[-1] for key, values in params.items()}
+                self._reply(*standin.handle(params.get('action', ''), params))
+
+            def do_GET(self):
+                self._serve(parse_qs(urlsplit(self.path).query))
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                self._serve(parse_qs(self.rfile.read(length).decode()))
+
+        return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline controller/CloudN API stand-in')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8443, help='port to listen on')
+    parser.add_argument('--scenario', help='JSON or YAML scenario file')
+    parser.add_argument('--certfile', help='serve HTTPS with this certificate')
+    parser.add_argument('--keyfile', help='private key of --certfile')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    standin = ApiStandIn(load_scenario(args.scenario) if args.scenario else None,
+                         host=args.host, port=args.port,
+                         certfile=args.certfile, keyfile=args.keyfile)
+    logger.info("Serving on %s://%s", standin.scheme, standin.hostname)
+    try:
+        standin.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(standin.stats(), indent=2))
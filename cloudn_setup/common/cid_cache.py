@@ -0,0 +1,107 @@
+import fcntl
+import json
+import logging
+import os
+from contextlib import contextmanager
+import tempfile
+import threading
+import time
+
+
+# Seconds a cached CID is reused before logging in again
+DEFAULT_CID_TTL = 1800
+
+logger = logging.getLogger(__name__)
+
+
+class CidCache():
+    """
+    CIDs keyed by host and username, kept in memory and, if a path is given,
+    in a JSON file readable only by the current user so other processes of
+    the same flow can reuse them. Entries expire after ttl seconds; a CID
+    rejected by the server should be dropped with invalidate().
+    """
+
+    def __init__(self, path=None, ttl=DEFAULT_CID_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._entries = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(host, username):
+        return "{}|{}".format(host, username)
+
+    @contextmanager
+    def _locked_file(self):
+        fd = os.open(self.path + ".lock", os.O_WRONLY | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _read_file(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return dict()
+        except ValueError as e:
+            logger.warning("Ignoring corrupt CID cache %s: %s", self.path, e)
+            return dict()
+
+    def _write_file(self, entries):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            # mkstemp creates the file with mode 0600
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def _update_file(self, key, entry):
+        with self._locked_file():
+            entries = self._read_file()
+            entries[key] = entry
+            self._write_file(entries)
+
+    def get(self, host, username):
+        """ Returns the cached CID, or None if there is no unexpired one """
+        key = self._key(host, username)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None and self.path:
+            entry = self._read_file().get(key)
+        if entry is None or time.time() - entry["created"] > self.ttl:
+            return None
+        with self._lock:
+            self._entries[key] = entry
+        return entry["cid"]
+
+    def put(self, host, username, cid):
+        key = self._key(host, username)
+        entry = {"cid": cid, "created": time.time()}
+        with self._lock:
+            self._entries[key] = entry
+        if self.path:
+            self._update_file(key, entry)
+
+    def invalidate(self, host, username, cid=None):
+        """ Drops the cached CID, only if it is still cid when cid is given """
+        key = self._key(host, username)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (cid is None or entry["cid"] == cid):
+                del self._entries[key]
+        if self.path:
+            with self._locked_file():
+                entries = self._read_file()
+                entry = entries.get(key)
+                if entry is not None and (cid is None or entry["cid"] == cid):
+                    del entries[key]
+                    self._write_file(entries)
@@ -0,0 +1,144 @@
+from collections import namedtuple
+import ipaddress
+import logging
+import re
+
+from common.timing_history import percentile
+
+
+logger = logging.getLogger(__name__)
+
+# Targets a CIDR may expand to, so a typo like /8 does not ping millions of hosts
+MAX_TARGETS = 1024
+DEFAULT_COUNT = 20
+# Milliseconds between two pings to the same target
+DEFAULT_PERIOD = 100
+
+PingStats = namedtuple('PingStats', [
+    'target', 'sent', 'received', 'loss', 'min', 'avg', 'p99', 'jitter', 'rtts'])
+
+RESULT_RE = re.compile(r"^(\S+)\s+:\s+((?:[\d.]+|-)(?:\s+(?:[\d.]+|-))*)\s*$")
+
+
+def parse_targets(spec, max_targets=MAX_TARGETS):
+    """
+    Returns the targets of a comma or space separated list of IP
+    addresses, hostnames and CIDRs; a CIDR stands for all of its hosts
+    """
+    targets = list()
+    for item in re.split(r"[,\s]+", spec or ""):
+        if not item:
+            continue
+        if '/' in item:
+            network = ipaddress.ip_network(item, strict=False)
+            hosts = [network.network_address] if network.num_addresses == 1 else network.hosts()
+            for host in hosts:
+                targets.append(str(host))
+                if len(targets) > max_targets:
+                    break
+        else:
+            targets.append(item)
+        if len(targets) > max_targets:
+            raise ValueError("{} expands to more than {} targets".format(spec, max_targets))
+    if not targets:
+        raise ValueError("No ping targets in {!r}".format(spec))
+    return list(dict.fromkeys(targets))
+
+
+def build_command(targets, count=DEFAULT_COUNT, period=DEFAULT_PERIOD):
+    """
+    Returns the fping command sending count pings, period ms apart, to every
+    target at once and printing every RTT per target (-C)
+    """
+    return "fping -C {} -q -i 1 -p {} {}".format(count, period, " ".join(targets))
+
+
+def parse_output(output):
+    """
+    Parses the per-target lines of fping -C, e.g.
+        10.0.0.1 : 0.52 0.48 - 0.50
+    where - is a lost ping, into PingStats keyed by target. RTTs are in ms.
+    """
+    results = dict()
+    for line in output.splitlines():
+        match = RESULT_RE.match(line.strip())
+        if not match:
+            continue
+        target, samples = match.group(1), match.group(2).split()
+        rtts = [float(sample) for sample in samples if sample != '-']
+        diffs = [abs(b - a) for a, b in zip(rtts, rtts[1:])]
+        results[target] = PingStats(
+            target=target,
+            sent=len(samples),
+            received=len(rtts),
+            loss=1 - len(rtts) / len(samples),
+            min=min(rtts) if rtts else None,
+            avg=sum(rtts) / len(rtts) if rtts else None,
+            p99=percentile(rtts, 99),
+            jitter=sum(diffs) / len(diffs) if diffs else (0.0 if rtts else None),
+            rtts=rtts)
+    return results
+
+
+class Slo():
+    """
+    Data-plane thresholds every target has to meet. loss is a fraction,
+    the RTT and jitter limits are in ms; None leaves a limit unchecked.
+    A target that answered no ping at all always violates the SLO.
+    """
+
+    def __init__(self, max_loss=None, max_avg=None, max_p99=None, max_jitter=None):
+        self.max_loss = max_loss
+        self.max_avg = max_avg
+        self.max_p99 = max_p99
+        self.max_jitter = max_jitter
+
+    def violations(self, stats):
+        """ Returns the SLO violations of one target's PingStats as strings """
+        if not stats.received:
+            return ['unreachable']
+        violations = list()
+        for name, value, limit in (('loss', stats.loss, self.max_loss),
+                                   ('avg', stats.avg, self.max_avg),
+                                   ('p99', stats.p99, self.max_p99),
+                                   ('jitter', stats.jitter, self.max_jitter)):
+            if limit is not None and value > limit:
+                violations.append('{} {:.3g} > {:.3g}'.format(name, value, limit))
+        return violations
+
+
+def run_matrix(connection, targets, count=DEFAULT_COUNT, period=DEFAULT_PERIOD, slo=None):
+    """
+    Pings all targets from the host behind a common.ssh_pool connection and
+    returns {target: {stats..., 'violations': [...]}}. A target fping did
+    not report on is counted as unreachable.
+    """
+    slo = slo or Slo()
+    command = build_command(targets, count=count, period=period)
+    # every target is pinged in parallel, so a burst takes about count periods
+    timeout = 60 + count * period / 1000.0
+    result = connection.run(command, timeout=timeout)
+    # fping prints the -C summary on stderr
+    parsed = parse_output(result.stderr + "\n" + result.stdout)
+    matrix = dict()
+    for target in targets:
+        stats = parsed.get(target) or PingStats(
+            target, count, 0, 1.0, None, None, None, None, [])
+        entry = stats._asdict()
+        entry['violations'] = slo.violations(stats)
+        matrix[target] = entry
+    return matrix
+
+
+def format_matrix(matrix):
+    """ Returns the results of run_matrix as a printable table """
+    def ms(value):
+        return '-' if value is None else '{:.2f}'.format(value)
+
+    lines = ["{:<20} {:>6} {:>8} {:>8} {:>8} {:>8}  {}".format(
+        'target', 'loss', 'min', 'avg', 'p99', 'jitter', 'violations')]
+    for target, entry in matrix.items():
+        lines.append("{:<20} {:>5.0%} {:>8} {:>8} {:>8} {:>8}  {}".format(
+            target, entry['loss'], ms(entry['min']), ms(entry['avg']), ms(entry['p99']),
+            ms(entry['jitter']), ', '.join(entry['violations'])))
+    return "\n".join(lines)
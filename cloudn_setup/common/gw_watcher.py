@@ -0,0 +1,132 @@
+import logging
+import threading
+import time
+
+import requests
+
+from common.polling import NonRetryableError
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two list_gateway_upgrade_status polls of a controller
+DEFAULT_POLL_INTERVAL = 5
+
+
+def gateway_ready(gw_info):
+    """ Default wait condition: the gateway is up and its upgrade is complete """
+    return gw_info['vpc_state'] == 'up' and gw_info['update_status'] == 'complete'
+
+
+class GatewayStatusWatcher():
+    """
+    Polls list_gateway_upgrade_status of a controller once per interval on a
+    background thread and indexes the results by gateway name, so any number
+    of waiters share a single poll. The thread runs only while at least one
+    waiter is subscribed, so the request rate stays flat however many
+    gateways are waited for.
+    """
+
+    def __init__(self, client, interval=DEFAULT_POLL_INTERVAL):
+        self.client = client
+        self.interval = interval
+        self.polls = 0
+        self._cond = threading.Condition()
+        self._waiters = 0
+        self._thread = None
+        self._in_flight = False
+        self._generation = 0
+        self._statuses = dict()
+        self._error = None
+
+    def _poll(self):
+        """ Returns the gateway statuses keyed by name, raises on a failed call """
+        response = self.client.request(
+            'list_gateway_upgrade_status', method='get', timeout=5)
+        if response.status_code not in range(200, 207):
+            raise RuntimeError("HTTP status code not 200")
+        rsp_dict = response.json()
+        if not rsp_dict['return']:
+            raise RuntimeError(rsp_dict)
+        return {gw_info['name']: gw_info for gw_info in rsp_dict['results']['gw_info']}
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._waiters:
+                    self._thread = None
+                    return
+                self._in_flight = True
+
+            statuses, error = None, None
+            try:
+                statuses = self._poll()
+            except requests.exceptions.Timeout as e:
+                logger.debug("list_gateway_upgrade_status timed out: %s", e)
+            except Exception as e:
+                error = e
+
+            with self._cond:
+                self.polls += 1
+                self._in_flight = False
+                # a timed out poll is retried, waiters only see polls with an outcome
+                if statuses is not None or error is not None:
+                    if statuses is not None:
+                        self._statuses = statuses
+                    self._error = error
+                    self._generation += 1
+                    self._cond.notify_all()
+            time.sleep(self.interval)
+
+    def wait_for(self, name, predicate=gateway_ready, deadline=300, cancel_event=None):
+        """
+        Blocks until the status of gateway name satisfies predicate, only
+        looking at polls started after the call. Returns True, or False once
+        deadline seconds have passed or cancel_event is set. Raises
+        NonRetryableError if the gateway is not known to the controller and
+        RuntimeError if the controller rejects the poll.
+        """
+        deadline_at = time.monotonic() + deadline
+        with self._cond:
+            self._waiters += 1
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='gw-watcher', daemon=True)
+                self._thread.start()
+            generation = self._generation + (1 if self._in_flight else 0)
+
+        try:
+            with self._cond:
+                while True:
+                    if self._generation > generation:
+                        generation = self._generation
+                        if self._error is not None:
+                            raise RuntimeError(self._error)
+                        gw_info = self._statuses.get(name)
+                        if gw_info is None:
+                            raise NonRetryableError('{} not exists in the data'.format(name))
+                        logger.debug('{} : VPA_state: {}, update_status: {}'.format(
+                            name, gw_info['vpc_state'], gw_info['update_status']))
+                        if predicate(gw_info):
+                            return True
+                    remaining = deadline_at - time.monotonic()
+                    if remaining <= 0 or (cancel_event is not None and cancel_event.is_set()):
+                        return False
+                    # wake up regularly to notice a cancellation
+                    self._cond.wait(min(remaining, 1))
+        finally:
+            with self._cond:
+                self._waiters -= 1
+
+
+_watchers = dict()
+_watchers_lock = threading.Lock()
+
+
+def get_watcher(client):
+    """ Returns the watcher shared by every waiter on the controller of client """
+    with _watchers_lock:
+        watcher = _watchers.get(client.hostname)
+        if watcher is None:
+            watcher = _watchers[client.hostname] = GatewayStatusWatcher(client)
+        return watcher
@@ -0,0 +1,194 @@
+from collections import namedtuple
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 5201
+DEFAULT_STREAMS = 4
+DEFAULT_DURATION = 10
+# Seconds an iperf3 server is given to start listening
+SERVER_START_TIMEOUT = 5
+
+ThroughputResult = namedtuple('ThroughputResult', [
+    'length',        # bytes per read/write (TCP) or datagram (UDP), None for the iperf3 default
+    'streams',
+    'duration',
+    'sent_bps',
+    'goodput_bps',   # bits per second received by the server
+    'retransmits',
+    'cpu_local',     # client host CPU utilization in percent
+    'cpu_remote',    # server host CPU utilization in percent
+])
+
+
+class IperfServer():
+    """
+    One-off iperf3 server daemon on the host behind a common.ssh_pool
+    connection. It serves a single test and exits; stop() kills it if the
+    test never came. The pidfile is unique to the server, so stop() never
+    kills the server of another run.
+    """
+
+    def __init__(self, connection, port=DEFAULT_PORT):
+        self.connection = connection
+        self.port = port
+        self.pidfile = '/tmp/iperf3-{}-{}.pid'.format(port, uuid.uuid4().hex[:8])
+
+    def start(self, timeout=SERVER_START_TIMEOUT):
+        result = self.connection.run('iperf3 -s -1 -D -p {} --pidfile {}'.format(
+            self.port, self.pidfile), timeout=30)
+        if result.exit_status != 0:
+            raise RuntimeError('Cannot start iperf3 server on {}: {}'.format(
+                self.connection.host, result.stderr.strip() or result.stdout.strip()))
+        # the daemon forks before it binds, and exits if the port is taken
+        check = ('pid=$(cat {} 2>/dev/null) && kill -0 $pid && '
+                 'ss -Hltnp "sport = :{}" | grep -q "pid=$pid,"').format(self.pidfile, self.port)
+        deadline = time.monotonic() + timeout
+        while self.connection.run(check, timeout=30).exit_status != 0:
+            if time.monotonic() > deadline:
+                self.stop()
+                raise RuntimeError('iperf3 server on {} is not listening on port {}'.format(
+                    self.connection.host, self.port))
+            time.sleep(0.2)
+
+    def stop(self):
+        self.connection.run('test -f {0} && kill $(cat {0}) 2>/dev/null; rm -f {0}'.format(
+            self.pidfile), timeout=30)
+
+
+_server_locks = dict()
+_server_locks_lock = threading.Lock()
+
+
+def server_lock(host):
+    """ Returns the lock serializing the iperf3 tests against a server host """
+    with _server_locks_lock:
+        return _server_locks.setdefault(host, threading.Lock())
+
+
+def build_client_command(server, port=DEFAULT_PORT, streams=DEFAULT_STREAMS,
+                         duration=DEFAULT_DURATION, length=None):
+    command = 'iperf3 -c {} -p {} -P {} -t {} -J'.format(server, port, streams, duration)
+    if length:
+        command += ' -l {}'.format(length)
+    return command
+
+
+def parse_result(output, length=None):
+    """ Parses the iperf3 -J output of a TCP test into a ThroughputResult """
+    try:
+        data = json.loads(output)
+    except ValueError:
+        raise RuntimeError('iperf3 output is not JSON: {!r}'.format(output[:200]))
+    if data.get('error'):
+        raise RuntimeError('iperf3 failed: {}'.format(data['error']))
+    end = data['end']
+    start = data.get('start', {}).get('test_start', {})
+    cpu = end.get('cpu_utilization_percent', {})
+    return ThroughputResult(
+        length=length,
+        streams=start.get('num_streams'),
+        duration=end['sum_sent'].get('seconds', start.get('duration')),
+        sent_bps=end['sum_sent']['bits_per_second'],
+        goodput_bps=end['sum_received']['bits_per_second'],
+        retransmits=end['sum_sent'].get('retransmits'),
+        cpu_local=cpu.get('host_total'),
+        cpu_remote=cpu.get('remote_total'))
+
+
+def run_throughput(client, server, server_ip, streams=DEFAULT_STREAMS,
+                   duration=DEFAULT_DURATION, lengths=(None,), port=DEFAULT_PORT):
+    """
+    Runs one iperf3 test per length from the client connection to an
+    iperf3 server started on the server connection and listening on
+    server_ip, and returns the ThroughputResults. Tests against the same
+    server host run one at a time, e.g. for the devices of a fleet run.
+    """
+    results = list()
+    for length in lengths:
+        with server_lock(server.host):
+            iperf_server = IperfServer(server, port=port)
+            iperf_server.start()
+            try:
+                output = client.run(
+                    build_client_command(server_ip, port=port, streams=streams,
+                                         duration=duration, length=length),
+                    timeout=duration + 60)
+            finally:
+                iperf_server.stop()
+        result = parse_result(output.stdout, length=length)
+        logger.info('iperf3 {} -> {} length {} x{}: goodput {:.1f} Mbit/s, retransmits {}, '
+                    'cpu {}/{} %'.format(client.host, server_ip, length or 'default', streams,
+                                         result.goodput_bps / 1e6, result.retransmits,
+                                         result.cpu_local, result.cpu_remote))
+        results.append(result)
+    return results
+
+
+class ThroughputBaseline():
+    """
+    JSON file with the throughput results of every software version, so a
+    release can be compared with the one before it:
+        {version: {'updated': ts, 'results': {length: ThroughputResult dict}}}
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return dict()
+
+    def reference_version(self, version):
+        """ Returns the most recently stored version other than version """
+        others = [(entry.get('updated', 0), name) for name, entry in self.load().items()
+                  if name != version]
+        return max(others)[1] if others else None
+
+    def store(self, version, results):
+        data = self.load()
+        data[version] = {
+            'updated': time.time(),
+            'results': {str(result.length): result._asdict() for result in results},
+        }
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def compare(self, version, results, tolerance=0.1):
+        """
+        Compares goodput with the results stored for version, per length.
+        :return: list of dicts with the baseline and current goodput and a
+                 'regression' flag set on drops larger than tolerance
+        """
+        reference = self.load().get(version, {}).get('results', {})
+        comparisons = list()
+        for result in results:
+            before = reference.get(str(result.length))
+            if not before:
+                continue
+            change = (result.goodput_bps - before['goodput_bps']) / before['goodput_bps']
+            comparisons.append({
+                'length': result.length,
+                'baseline_bps': before['goodput_bps'],
+                'goodput_bps': result.goodput_bps,
+                'change': change,
+                'regression': change < -tolerance,
+            })
+        return comparisons
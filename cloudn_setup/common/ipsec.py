@@ -0,0 +1,238 @@
+from collections import namedtuple
+import logging
+import re
+import time
+
+
+logger = logging.getLogger(__name__)
+
+TunnelRecord = namedtuple('TunnelRecord', [
+    'name',       # tunnel identifier, unique per device
+    'peer',       # remote IPsec endpoint
+    'state',      # state as reported by the IKE daemon
+    'up',         # True if the tunnel carries traffic
+    'installed',  # seconds since the SA was installed, None if unknown
+    'bytes_in',
+    'bytes_out',
+    'spi',        # SPI of the current SA, changes on every rekey
+])
+
+
+class IpsecCollector():
+    """
+    Fetches the full SA state of an IKE daemon with a single SSH command and
+    parses it into TunnelRecords. Subclasses set name and command, implement
+    parse() and define how many tunnels must be up for an expected count.
+    """
+    name = None
+    command = None
+
+    def collect(self, connection):
+        """ Returns the tunnels of the device behind a common.ssh_pool connection """
+        result = connection.run(self.command)
+        return self.parse(result.stdout)
+
+    def parse(self, output):
+        raise NotImplementedError
+
+    def required(self, expected):
+        return expected
+
+
+class StrongSwanCollector(IpsecCollector):
+    """ strongSwan (swanctl) collector, one record per CHILD_SA """
+    name = 'strongswan'
+    command = 'sudo swanctl --list-sas'
+
+    IKE_RE = re.compile(r"^(\S+): #\d+, (\w+), IKEv\d")
+    REMOTE_RE = re.compile(r"^\s+remote\s+'[^']*' @ ([^\[\s]+)")
+    CHILD_RE = re.compile(r"^\s+(\S+): #\d+, reqid \d+, (\w+),")
+    INSTALLED_RE = re.compile(r"^\s+installed (\d+)s ago")
+    TRAFFIC_RE = re.compile(r"^\s+(in|out)\s+([0-9a-f]+)\S*,\s+(\d+) bytes")
+
+    def required(self, expected):
+        # a couple of tunnels may be rekeying at any time
+        return expected - 2
+
+    def parse(self, output):
+        records = list()
+        ike_name, ike_state, peer, child = None, None, None, None
+
+        def flush_ike():
+            # an IKE_SA without any CHILD_SA still counts as a tunnel that is down
+            if ike_name is not None and not any(r.name.startswith(ike_name + '/') for r in records):
+                records.append(TunnelRecord(
+                    name='{}/'.format(ike_name), peer=peer, state=ike_state, up=False,
+                    installed=None, bytes_in=0, bytes_out=0, spi=None))
+
+        def flush():
+            if child is not None:
+                records.append(TunnelRecord(
+                    name='{}/{}'.format(ike_name, child['name']), peer=peer,
+                    state=child['state'], up=child['state'] == 'INSTALLED',
+                    installed=child['installed'], bytes_in=child['in'],
+                    bytes_out=child['out'], spi=child['spi']))
+
+        for line in output.splitlines():
+            match = self.IKE_RE.match(line)
+            if match:
+                flush()
+                flush_ike()
+                ike_name, ike_state, peer, child = match.group(1), match.group(2), None, None
+                continue
+            match = self.CHILD_RE.match(line)
+            if match:
+                flush()
+                child = {'name': match.group(1), 'state': match.group(2),
+                         'installed': None, 'in': 0, 'out': 0, 'spi': None}
+                continue
+            if child is None:
+                match = self.REMOTE_RE.match(line)
+                if match:
+                    peer = match.group(1)
+                continue
+            match = self.INSTALLED_RE.match(line)
+            if match:
+                child['installed'] = int(match.group(1))
+                continue
+            match = self.TRAFFIC_RE.match(line)
+            if match:
+                direction, spi, count = match.groups()
+                child[direction] = int(count)
+                if direction == 'in':
+                    child['spi'] = spi
+        flush()
+        flush_ike()
+        return records
+
+
+class RacoonCollector(IpsecCollector):
+    """
+    racoon collector, one record per ISAKMP SA. Phase 1 state comes from
+    racoonctl; SA age and byte counters of the matching ESP SAs from setkey.
+    """
+    name = 'racoon'
+    SEPARATOR = '%%SETKEY%%'
+    command = "sudo racoonctl -ll ss isakmp; echo '{}'; sudo setkey -D".format(SEPARATOR)
+
+    SA_HEADER_RE = re.compile(r"^(\S+) (\S+)$")
+    SPI_RE = re.compile(r"\bspi=\d+\((0x[0-9a-f]+)\)")
+    AGE_RE = re.compile(r"\bdiff: (\d+)\(s\)")
+    BYTES_RE = re.compile(r"^\s*current: (\d+)\(bytes\)")
+
+    def required(self, expected):
+        # established tunnels need to reach 90%
+        return expected * 0.9
+
+    def _parse_setkey(self, output):
+        """ Returns the ESP SAs as a dict keyed by (src, dst) """
+        sas = dict()
+        current = None
+        for line in output.splitlines():
+            match = self.SA_HEADER_RE.match(line)
+            if match:
+                current = sas.setdefault(match.groups(), {'age': None, 'bytes': 0, 'spi': None})
+                continue
+            if current is None:
+                continue
+            match = self.SPI_RE.search(line)
+            if match:
+                current['spi'] = match.group(1)
+            match = self.AGE_RE.search(line)
+            if match:
+                current['age'] = int(match.group(1))
+            match = self.BYTES_RE.match(line)
+            if match:
+                current['bytes'] = int(match.group(1))
+        return sas
+
+    def parse(self, output):
+        isakmp, _, setkey = output.partition(self.SEPARATOR)
+        esp_sas = self._parse_setkey(setkey)
+        records = list()
+        for line in isakmp.splitlines():
+            fields = line.split()
+            if len(fields) < 9 or fields[0] == 'Destination':
+                continue
+            peer = fields[0].rsplit('.', 1)[0]
+            try:
+                phase2 = int(fields[-1])
+            except ValueError:
+                continue
+            outbound = next((sa for (src, dst), sa in esp_sas.items() if dst == peer), {})
+            inbound = next((sa for (src, dst), sa in esp_sas.items() if src == peer), {})
+            records.append(TunnelRecord(
+                name=peer, peer=peer, state='ST{}'.format(fields[2]), up=phase2 > 0,
+                installed=outbound.get('age'), bytes_in=inbound.get('bytes', 0),
+                bytes_out=outbound.get('bytes', 0), spi=outbound.get('spi')))
+        return records
+
+
+COLLECTORS = {
+    RacoonCollector.name: RacoonCollector,
+    StrongSwanCollector.name: StrongSwanCollector,
+}
+
+
+def select_collector(kernel_version):
+    """
+    Returns the collector for a CloudN kernel version: racoon up to the 4.x
+    kernels, strongSwan from 5.x on
+    """
+    match = re.search(r"(\d+)\.(\d+)", kernel_version or "")
+    if not match:
+        raise ValueError("Cannot parse kernel version {!r}".format(kernel_version))
+    major = int(match.group(1))
+    return COLLECTORS['racoon' if major < 5 else 'strongswan']()
+
+
+class TunnelConvergenceTracker():
+    """
+    Follows the tunnels of a device across samples: when each tunnel was
+    first seen up (relative to the tracker start), how often its SA was
+    rekeyed, and which tunnels are down or missing in the latest sample
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.samples = 0
+        self.first_up = dict()
+        self.rekeys = dict()
+        # last record of every tunnel ever seen, and the latest sample alone
+        self.last = dict()
+        self.latest = dict()
+
+    def update(self, records):
+        now = time.monotonic() - self.start
+        self.samples += 1
+        self.latest = {record.name: record for record in records}
+        for record in records:
+            previous = self.last.get(record.name)
+            if previous is not None and previous.spi and record.spi and previous.spi != record.spi:
+                self.rekeys[record.name] = self.rekeys.get(record.name, 0) + 1
+            if record.up and record.name not in self.first_up:
+                self.first_up[record.name] = now
+            self.last[record.name] = record
+
+    def up_count(self):
+        """ Tunnels up in the latest sample """
+        return sum(1 for record in self.latest.values() if record.up)
+
+    def stragglers(self):
+        """ Tunnels ever seen that are down or missing in the latest sample """
+        return sorted(name for name in self.last
+                      if name not in self.latest or not self.latest[name].up)
+
+    def report(self):
+        convergence = sorted(self.first_up.values())
+        return {
+            'samples': self.samples,
+            'seen': len(self.last),
+            'up': self.up_count(),
+            'converged': dict(self.first_up),
+            'convergence_max': convergence[-1] if convergence else None,
+            'convergence_median': convergence[len(convergence) // 2] if convergence else None,
+            'stragglers': self.stragglers(),
+            'rekeys': dict(self.rekeys),
+            'tunnels': {name: record._asdict() for name, record in self.last.items()},
+        }
@@ -0,0 +1,104 @@
+import logging
+import random
+import threading
+import time
+
+from common.tracing import tracer
+
+
+logger = logging.getLogger(__name__)
+
+
+class NonRetryableError(Exception):
+    """ Raised by a polled function to stop polling at once """
+
+
+class Poller():
+    """
+    Calls a function until it returns a truthy value, an overall deadline
+    passes or the poll is cancelled. The wait between attempts starts at
+    initial_interval and is multiplied by multiplier after every miss, up to
+    max_interval, with +/- jitter (a fraction of the wait) applied. The last
+    wait is cut short at the deadline, so no time is spent sleeping after the
+    final attempt.
+
+    Exceptions listed in retry_on count as a failed attempt; any other
+    exception, including NonRetryableError, aborts the poll and propagates.
+    Every attempt is recorded in attempts with its start offset, latency and
+    outcome.
+    """
+
+    def __init__(self, deadline=300, initial_interval=1, max_interval=30,
+                 multiplier=2, jitter=0.1, retry_on=(), cancel_event=None):
+        self.deadline = deadline
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.retry_on = tuple(retry_on)
+        self.cancel_event = cancel_event or threading.Event()
+        self.attempts = list()
+
+    def cancel(self):
+        """ Stops the poll, waking it up if it is waiting """
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def _record(self, start, attempt_start, outcome):
+        self.attempts.append({
+            'started': attempt_start - start,
+            'latency': time.monotonic() - attempt_start,
+            'outcome': outcome,
+        })
+
+    def run(self, func, *args, **kwargs):
+        """
+        Polls func(*args, **kwargs). Returns its first truthy result, or False
+        if the deadline passed or the poll was cancelled first.
+        """
+        name = getattr(func, '__name__', func)
+        with tracer.span('poll {}'.format(name), category='poll', deadline=self.deadline):
+            return self._run(name, func, args, kwargs)
+
+    def _run(self, name, func, args, kwargs):
+        self.attempts = list()
+        start = time.monotonic()
+        deadline_at = start + self.deadline
+        interval = self.initial_interval
+
+        while not self.cancelled:
+            attempt_start = time.monotonic()
+            try:
+                with tracer.span('{} attempt {}'.format(name, len(self.attempts) + 1),
+                                 category='poll'):
+                    result = func(*args, **kwargs)
+            except NonRetryableError:
+                self._record(start, attempt_start, 'abort')
+                raise
+            except self.retry_on as e:
+                logger.debug("%s raised %r, retrying", name, e)
+                result = None
+                self._record(start, attempt_start, 'error')
+            except Exception:
+                self._record(start, attempt_start, 'abort')
+                raise
+            else:
+                self._record(start, attempt_start, 'pass' if result else 'fail')
+
+            if result:
+                return result
+
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                break
+            wait = interval * (1 + random.uniform(-self.jitter, self.jitter))
+            if self.cancel_event.wait(min(remaining, wait)):
+                break
+            interval = min(interval * self.multiplier, self.max_interval)
+
+        if self.cancelled:
+            logger.info("%s polling cancelled", name)
+        return False
@@ -0,0 +1,174 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import logging
+import threading
+import time
+
+from common.tracing import tracer
+
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+PASSED = 'passed'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+CANCELLED = 'cancelled'
+
+
+class Phase():
+    """ A named step of a run and the phases it depends on """
+
+    def __init__(self, name, func, deps=()):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.status = PENDING
+        self.cancel_event = threading.Event()
+        self.started = None
+        self.duration = None
+        self.error = None
+
+
+class PhaseScheduler():
+    """
+    Runs phases as a dependency graph on a thread pool: a phase starts as
+    soon as all the phases it depends on have passed, so independent phases
+    run concurrently. Each phase func is called with a threading.Event of
+    its own that is set when the phase is cancelled, and fails by raising.
+
+    When a phase fails its dependents are skipped. With fail_fast, running
+    phases that only feed skipped phases are cancelled as well, so they give
+    up waiting (e.g. in a Poller given their event) at once. Phases that do
+    not lead to the failed one's dependents keep running.
+    """
+
+    def __init__(self, max_workers=4, fail_fast=True):
+        self.max_workers = max_workers
+        self.fail_fast = fail_fast
+        self.phases = dict()
+        self.started = None
+        self.duration = None
+
+    def add(self, name, func, deps=()):
+        """ Adds a phase running func(cancel_event) after the phases in deps """
+        if name in self.phases:
+            raise ValueError("Phase {} already defined".format(name))
+        self.phases[name] = Phase(name, func, deps)
+
+    def _validate(self):
+        for phase in self.phases.values():
+            for dep in phase.deps:
+                if dep not in self.phases:
+                    raise ValueError("Phase {} depends on unknown phase {}".format(
+                        phase.name, dep))
+        visiting, done = set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError("Dependency cycle through phase {}".format(name))
+            visiting.add(name)
+            for dep in self.phases[name].deps:
+                visit(dep)
+            visiting.discard(name)
+            done.add(name)
+
+        for name in self.phases:
+            visit(name)
+
+    def _run_phase(self, phase, parent_span=None):
+        phase.started = time.monotonic() - self.started
+        start = time.monotonic()
+        try:
+            with tracer.span(phase.name, category='phase', parent=parent_span):
+                phase.func(phase.cancel_event)
+        finally:
+            phase.duration = time.monotonic() - start
+
+    def _settle_blocked(self):
+        """ Skips pending phases that can no longer run """
+        changed = True
+        while changed:
+            changed = False
+            for phase in self.phases.values():
+                if phase.status != PENDING:
+                    continue
+                if any(self.phases[dep].status in (FAILED, SKIPPED, CANCELLED)
+                         for dep in phase.deps):
+                    phase.status = SKIPPED
+                    changed = True
+
+    def _cancel_unneeded(self):
+        """ Cancels running phases whose dependents can no longer run """
+        for phase in self.phases.values():
+            if phase.status != RUNNING or phase.cancel_event.is_set():
+                continue
+            dependents = [other for other in self.phases.values() if phase.name in other.deps]
+            if dependents and all(other.status in (FAILED, SKIPPED, CANCELLED)
+                                  for other in dependents):
+                logger.info("Cancelling phase %s, no phase depending on it can run", phase.name)
+                phase.cancel_event.set()
+
+    def run(self):
+        """ Runs all phases and returns True if every phase passed """
+        self._validate()
+        self.started = time.monotonic()
+        running = dict()
+        with tracer.span('phases', category='phase') as root, \
+                ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                self._settle_blocked()
+                if self.fail_fast:
+                    self._cancel_unneeded()
+                for phase in self.phases.values():
+                    if phase.status == PENDING and all(
+                            self.phases[dep].status == PASSED for dep in phase.deps):
+                        phase.status = RUNNING
+                        logger.info("Phase %s started", phase.name)
+                        running[executor.submit(self._run_phase, phase, root)] = phase
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    phase = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        phase.status = PASSED
+                        logger.info("Phase %s passed in %.1f s", phase.name, phase.duration)
+                        continue
+                    phase.error = error
+                    if phase.cancel_event.is_set():
+                        phase.status = CANCELLED
+                        logger.info("Phase %s cancelled: %s", phase.name, error)
+                        continue
+                    phase.status = FAILED
+                    logger.error("Phase %s failed in %.1f s: %r",
+                                 phase.name, phase.duration, error)
+        self.duration = time.monotonic() - self.started
+        return all(phase.status == PASSED for phase in self.phases.values())
+
+    def report(self):
+        """ Returns the status and timing of every phase """
+        return [{
+            'phase': phase.name,
+            'deps': list(phase.deps),
+            'status': phase.status,
+            'started': phase.started,
+            'duration': phase.duration,
+            'error': None if phase.error is None else repr(phase.error),
+        } for phase in self.phases.values()]
+
+    def format_report(self):
+        """ Returns the phase timing report as a printable table """
+        lines = ["{:<28} {:<10} {:>10} {:>10}".format(
+            'phase', 'status', 'start (s)', 'took (s)')]
+        for entry in self.report():
+            lines.append("{:<28} {:<10} {:>10} {:>10}".format(
+                entry['phase'], entry['status'],
+                '-' if entry['started'] is None else '{:.1f}'.format(entry['started']),
+                '-' if entry['duration'] is None else '{:.1f}'.format(entry['duration'])))
+        lines.append("total {:.1f} s".format(self.duration or 0))
+        return "\n".join(lines)
@@ -0,0 +1,172 @@
+import atexit
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import socket
+import threading
+import time
+
+import paramiko
+
+from common.tracing import tracer
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between keepalive packets on idle transports
+DEFAULT_KEEPALIVE = 30
+DEFAULT_CONNECT_TIMEOUT = 30
+DEFAULT_COMMAND_TIMEOUT = 60
+
+CommandResult = namedtuple(
+    'CommandResult', ['host', 'command', 'exit_status', 'stdout', 'stderr', 'duration'])
+
+
+class SshConnection():
+    """ Handle on a pooled SSH transport, see SshPool.connect """
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+
+    @property
+    def host(self):
+        return self.key[0]
+
+    def run(self, command, timeout=DEFAULT_COMMAND_TIMEOUT):
+        return self.pool.run(self.key, command, timeout=timeout)
+
+
+class SshPool():
+    """
+    Keeps one keepalive-enabled SSH transport per (host, port, user) and runs
+    every command on its own channel of that transport, so repeated commands
+    (e.g. polling loops) skip key exchange and authentication and several
+    commands can run on one host at the same time. A transport that died is
+    reconnected on next use.
+    """
+
+    def __init__(self, keepalive=DEFAULT_KEEPALIVE, connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self._clients = dict()
+        self._connect_kwargs = dict()
+        self._locks = dict()
+        self._lock = threading.Lock()
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def connect(self, host, port=22, username=None, password=None, pkey=None):
+        """ Returns a connection to the host, reusing the pooled transport if any """
+        port = int(port or 22)
+        key = (host, port, username)
+        self._connect_kwargs[key] = {
+            'hostname': host, 'port': port, 'username': username,
+            'password': password, 'pkey': pkey,
+        }
+        self._transport(key)
+        return SshConnection(self, key)
+
+    def _transport(self, key):
+        with self._key_lock(key):
+            client = self._clients.get(key)
+            if client is not None:
+                transport = client.get_transport()
+                if transport is not None and transport.is_active():
+                    return transport
+                logger.info("SSH transport to %s:%s is down, reconnecting", key[0], key[1])
+                client.close()
+
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.connect(timeout=self.connect_timeout, **self._connect_kwargs[key])
+            transport = client.get_transport()
+            transport.set_keepalive(self.keepalive)
+            self._clients[key] = client
+            return transport
+
+    def run(self, key, command, timeout=DEFAULT_COMMAND_TIMEOUT):
+        """
+        Runs command on a new channel of the pooled transport and returns a
+        CommandResult. Raises socket.timeout if it does not finish in time.
+        """
+        with tracer.span(command, category='ssh', host=key[0]):
+            return self._run(key, command, timeout)
+
+    def _run(self, key, command, timeout):
+        start = time.monotonic()
+        deadline = start + timeout
+        channel = self._transport(key).open_session()
+        stdout, stderr = list(), list()
+        try:
+            channel.exec_command(command)
+            while True:
+                received = False
+                if channel.recv_ready():
+                    stdout.append(channel.recv(32768))
+                    received = True
+                if channel.recv_stderr_ready():
+                    stderr.append(channel.recv_stderr(32768))
+                    received = True
+                if received:
+                    continue
+                if channel.exit_status_ready():
+                    break
+                if time.monotonic() > deadline:
+                    raise socket.timeout("'{}' on {} took more than {} seconds".format(
+                        command, key[0], timeout))
+                time.sleep(0.01)
+            exit_status = channel.recv_exit_status()
+            # the last output can arrive along with the exit status, after the
+            # ready checks above: read both streams to the end
+            channel.settimeout(max(deadline - time.monotonic(), 1))
+            for recv, chunks in ((channel.recv, stdout), (channel.recv_stderr, stderr)):
+                data = recv(32768)
+                while data:
+                    chunks.append(data)
+                    data = recv(32768)
+        finally:
+            channel.close()
+
+        result = CommandResult(
+            key[0], command, exit_status,
+            b''.join(stdout).decode(errors='replace'),
+            b''.join(stderr).decode(errors='replace'),
+            time.monotonic() - start)
+        logger.debug("%s: '%s' exited %s in %.2f s", key[0], command,
+                     exit_status, result.duration)
+        return result
+
+    def run_many(self, jobs, max_workers=8, timeout=DEFAULT_COMMAND_TIMEOUT):
+        """
+        Runs (connection, command) jobs concurrently and returns, in order,
+        a CommandResult or the exception raised for each job
+        """
+        def run_job(job):
+            connection, command = job
+            try:
+                return connection.run(command, timeout=timeout)
+            except Exception as e:
+                return e
+
+        jobs = list(jobs)
+        if not jobs:
+            return []
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+            return list(executor.map(run_job, jobs))
+
+    def close(self, key):
+        with self._key_lock(key):
+            client = self._clients.pop(key, None)
+            if client is not None:
+                client.close()
+
+    def close_all(self):
+        for key in list(self._clients):
+            self.close(key)
+
+
+ssh_pool = SshPool()
+atexit.register(ssh_pool.close_all)
@@ -0,0 +1,201 @@
+import fcntl
+import json
+import logging
+import os
+import time
+
+from common.tracing import tracer
+
+
+# File the phase durations of every run are appended to, one JSON record per line
+DEFAULT_HISTORY_FILE = os.environ.get("AVX_TIMING_HISTORY", "timing_history.jsonl")
+DEFAULT_PERCENTILES = (50, 90, 99)
+
+logger = logging.getLogger(__name__)
+
+
+class TimingHistory():
+    """
+    Append-only JSONL store of run timings. Each record holds the script,
+    device, software version, result and the duration and status of every
+    phase of one run. Appends are serialized with a file lock so runs of a
+    fleet can share one history file.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or DEFAULT_HISTORY_FILE
+
+    def append(self, record):
+        line = json.dumps(record) + '\n'
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(line)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load(self, script=None, device=None):
+        """ Returns the stored records, oldest first, optionally filtered """
+        records = list()
+        try:
+            with open(self.path, 'r') as f:
+                for number, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning("Skipping corrupt line %s of %s", number, self.path)
+                        continue
+                    if script and record.get('script') != script:
+                        continue
+                    if device and record.get('device') != device:
+                        continue
+                    records.append(record)
+        except FileNotFoundError:
+            pass
+        return records
+
+
+class PhaseTimer():
+    """
+    Context manager timing one phase of a TimingRun. It wraps the span
+    context of the phase and, like tracing.SpanContext, lets exceptions
+    pass through untouched.
+    """
+
+    def __init__(self, run, name):
+        self.run = run
+        self.name = name
+        self.span = tracer.span(name, category='step', script=run.script, device=run.device)
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        self.span.__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.span.__exit__(exc_type, exc, tb)
+        self.run.add(self.name, time.monotonic() - self.start,
+                     'passed' if exc_type is None else 'failed')
+        return False
+
+
+class TimingRun():
+    """
+    Collects the phase durations of one run of a script and appends them to
+    a TimingHistory with save(). Phases are timed with the phase() context
+    manager or added from durations measured elsewhere with add().
+    """
+
+    def __init__(self, script, device=None, version=None, history=None):
+        self.script = script
+        self.device = device
+        self.version = version
+        self.history = history
+        self.started = time.time()
+        self.phases = dict()
+
+    def add(self, name, duration, status='passed'):
+        if duration is not None:
+            self.phases[name] = {'duration': duration, 'status': status}
+
+    def phase(self, name):
+        """ Returns a context manager timing the enclosed block as phase name """
+        return PhaseTimer(self, name)
+
+    def record(self, result):
+        return {
+            'timestamp': self.started,
+            'script': self.script,
+            'device': self.device,
+            'version': self.version,
+            'result': result,
+            'duration': time.time() - self.started,
+            'phases': self.phases,
+        }
+
+    def save(self, result):
+        """ Appends the run to the history; a failing write never fails the run """
+        if self.history is None:
+            return
+        try:
+            self.history.append(self.record(result))
+        except OSError as e:
+            logger.warning("Cannot write timing history %s: %s", self.history.path, e)
+
+
+def percentile(values, pct):
+    """ Returns the pct percentile of values, interpolating between ranks """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = (len(values) - 1) * pct / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def versions_in_order(records):
+    """ Returns the software versions of the records in order of first appearance """
+    versions = list()
+    for record in sorted(records, key=lambda r: r.get('timestamp') or 0):
+        if record.get('version') not in versions:
+            versions.append(record.get('version'))
+    return versions
+
+
+def phase_durations(records, version):
+    """ Returns the durations of the passed phases of a version, keyed by phase """
+    durations = dict()
+    for record in records:
+        if record.get('version') != version:
+            continue
+        for name, phase in record.get('phases', {}).items():
+            if phase.get('status') == 'passed' and phase.get('duration') is not None:
+                durations.setdefault(name, []).append(phase['duration'])
+    return durations
+
+
+def summarize(records, percentiles=DEFAULT_PERCENTILES):
+    """ Returns {version: {phase: {'count', 'p50', ..., 'max'}}} """
+    summary = dict()
+    for version in versions_in_order(records):
+        summary[version] = dict()
+        for name, values in sorted(phase_durations(records, version).items()):
+            stats = {'count': len(values)}
+            for pct in percentiles:
+                stats['p{}'.format(pct)] = percentile(values, pct)
+            stats['max'] = max(values)
+            summary[version][name] = stats
+    return summary
+
+
+def find_regressions(records, baseline, candidate, pct=50, max_increase=30, max_ratio=0.2,
+                     min_samples=1):
+    """
+    Compares the pct percentile duration of every phase of the candidate
+    version with the baseline version. A phase regresses when it got slower
+    by more than max_increase seconds and by more than max_ratio of the
+    baseline, so noise on short phases is not flagged.
+    :return: list of dicts, one per compared phase, with a 'regression' flag
+    """
+    base = phase_durations(records, baseline)
+    cand = phase_durations(records, candidate)
+    comparisons = list()
+    for name in sorted(set(base) & set(cand)):
+        if len(base[name]) < min_samples or len(cand[name]) < min_samples:
+            continue
+        before = percentile(base[name], pct)
+        after = percentile(cand[name], pct)
+        increase = after - before
+        ratio = increase / before if before else float('inf') if increase > 0 else 0.0
+        comparisons.append({
+            'phase': name,
+            'baseline': before,
+            'candidate': after,
+            'increase': increase,
+            'ratio': ratio,
+            'regression': increase > max_increase and ratio > max_ratio,
+        })
+    return comparisons
@@ -0,0 +1,198 @@
+import atexit
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class Span():
+    """ One timed operation; spans nest through their parent id """
+
+    __slots__ = ('id', 'parent_id', 'name', 'category', 'thread', 'start', 'end',
+                 'attrs', 'error')
+
+    def __init__(self, id, parent_id, name, category, attrs):
+        self.id = id
+        self.parent_id = parent_id
+        self.name = name
+        self.category = category
+        self.thread = threading.current_thread().name
+        self.start = time.perf_counter()
+        self.end = None
+        self.attrs = attrs
+        self.error = None
+
+    @property
+    def duration(self):
+        return None if self.end is None else self.end - self.start
+
+
+class SpanContext():
+    """
+    Context manager of one span. A class rather than a generator, so
+    exceptions pass through untouched (contextlib sets __traceback__ on
+    them, which pyVmomi faults do not allow).
+    """
+
+    __slots__ = ('tracer', 'name', 'category', 'parent', 'attrs', 'span')
+
+    def __init__(self, tracer, name, category, parent, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.attrs = attrs
+        self.span = None
+
+    def __enter__(self):
+        self.span = self.tracer._open(self.name, self.category, self.parent, self.attrs)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        self.tracer._close(self.span, None if exc is None else repr(exc))
+        return False
+
+
+class NullSpanContext():
+    """ Context manager handed out while tracing is disabled """
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = NullSpanContext()
+
+
+class Tracer():
+    """
+    Collects nested spans of a run. Each thread keeps its own stack of open
+    spans, so a span's parent is the innermost span open on the same thread.
+    Work handed to another thread passes parent= explicitly (see
+    current_span()). While disabled, span() costs a flag check.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.spans = list()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._ids = itertools.count(1)
+        self._origin = time.perf_counter()
+        self._exit_hook = False
+
+    def enable(self, path=None):
+        """ Starts recording; with a path, the trace is written there at exit """
+        self.enabled = True
+        if path:
+            self.path = path
+            if not self._exit_hook:
+                atexit.register(self.export_on_exit)
+                self._exit_hook = True
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = list()
+        return stack
+
+    def current_span(self):
+        """ Returns the innermost span open on this thread, or None """
+        stack = self._stack() if self.enabled else None
+        return stack[-1] if stack else None
+
+    def span(self, name, category='run', parent=None, **attrs):
+        """ Returns a context manager timing the enclosed block as a span """
+        if not self.enabled:
+            return NULL_SPAN
+        return SpanContext(self, name, category, parent, attrs)
+
+    def _open(self, name, category, parent, attrs):
+        stack = self._stack()
+        if parent is None and stack:
+            parent = stack[-1]
+        span = Span(next(self._ids), parent.id if parent else None, name, category, attrs)
+        stack.append(span)
+        return span
+
+    def _close(self, span, error=None):
+        span.end = time.perf_counter()
+        span.error = error
+        self._stack().pop()
+        with self._lock:
+            self.spans.append(span)
+
+    def span_tree(self):
+        """ Returns the finished spans as nested dicts, roots first by start time """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        nodes = dict()
+        roots = list()
+        for span in spans:
+            nodes[span.id] = {
+                'name': span.name,
+                'category': span.category,
+                'thread': span.thread,
+                'start': span.start - self._origin,
+                'duration': span.duration,
+                'attrs': span.attrs,
+                'error': span.error,
+                'children': [],
+            }
+        for span in spans:
+            parent = nodes.get(span.parent_id)
+            (parent['children'] if parent else roots).append(nodes[span.id])
+        return roots
+
+    def chrome_trace(self):
+        """ Returns the spans as Chrome trace_event JSON (complete "X" events) """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        threads = dict()
+        events = list()
+        for span in spans:
+            tid = threads.setdefault(span.thread, len(threads) + 1)
+            args = {key: str(value) for key, value in span.attrs.items()}
+            args.update(span_id=span.id, parent_id=span.parent_id)
+            if span.error:
+                args['error'] = span.error
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': (span.start - self._origin) * 1e6,
+                'dur': span.duration * 1e6,
+                'pid': os.getpid(),
+                'tid': tid,
+                'args': args,
+            })
+        for thread, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                           'tid': tid, 'args': {'name': thread}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'span_tree': self.span_tree()}}
+
+    def export(self, path=None):
+        path = path or self.path
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        logger.info("Trace with %s spans written to %s", len(self.spans), path)
+
+    def export_on_exit(self):
+        try:
+            self.export()
+        except Exception as e:
+            logger.warning("Cannot write trace %s: %s", self.path, e)
+
+
+tracer = Tracer()
+if os.environ.get("AVX_TRACE_FILE"):
+    tracer.enable(os.environ["AVX_TRACE_FILE"])
@@ -1,4 +1,5 @@
-from vmware.inventory import Inventory
+from vmware.inventory import AllocationError, DEFAULT_LEASE_SECONDS, Inventory
+from vmware.state_cache import DEFAULT_CACHE_TTL, StateCache
 import json
 import sys
 
@@ -10,21 +11,24 @@ if __name__ == '__main__':
         input_dict = json.loads(input_json)
         controller_hostname = input_dict.get('controller_hostname')
 
-        inv = Inventory()
+        cache_ttl = float(input_dict.get('cache_ttl') or DEFAULT_CACHE_TTL)
+        inv = Inventory(state_cache=StateCache(
+            path=input_dict.get('cache_file'), ttl=cache_ttl))
+        if input_dict.get('host_timeout'):
+            inv.host_timeout = float(input_dict.get('host_timeout'))
+        if input_dict.get('refresh_workers'):
+            inv.refresh_workers = int(input_dict.get('refresh_workers'))
         inv.initialize_inventory()
-        inv.refresh_inventory_state()
 
-        for vm in inv.vms:
-            # find the vcn already registed to controller 
-            if controller_hostname in str(vm.state.in_ci_use):
-                output = json.dumps({str(key): str(value) for key, value in vm.spec.items()})
-                sys.stdout.write(output)
-                break
-        else:
-            # find a free cloudn 
-            free_vm = inv.get_available_vms()[0]
-            output = json.dumps({str(key): str(value) for key, value in free_vm.spec.items()})
-            sys.stdout.write(output)
+        # reuse the vcn already leased to this controller, which may come from
+        # the state cache; leasing a free one always reads fresh state
+        inv.refresh_inventory_state()
+        vm = inv.find_leased_vm(controller_hostname)
+        if vm is None or vm.is_free():
+            lease_seconds = float(input_dict.get('lease_seconds') or DEFAULT_LEASE_SECONDS)
+            vm = inv.allocate_vm(controller_hostname, lease_seconds=lease_seconds)
+        output = json.dumps({str(key): str(value) for key, value in vm.spec.items()})
+        sys.stdout.write(output)
 
-    except ValueError as e:
+    except (ValueError, AllocationError) as e:
         sys.exit(e)
\ No newline at end of file
@@ -0,0 +1,99 @@
+"""
+Lease races against the in-process vSphere simulator (vmware/simulator.py).
+
+Run from the cloudn_setup directory:
+    python3 -m pytest tests
+"""
+from pathlib import Path
+import sys
+
+import pytest
+
+pytest.importorskip("pyVmomi")
+yaml = pytest.importorskip("yaml")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from vmware.inventory import AllocationError, Inventory
+from vmware.simulator import VsphereSimulator
+
+
+@pytest.fixture
+def lab(tmp_path):
+    """ A simulator with a single VM and the inventory yaml describing it """
+    sim = VsphereSimulator()
+    spec = sim.build(1, 1)
+    inventory_file = tmp_path / 'inventory.yaml'
+    inventory_file.write_text(yaml.safe_dump(spec))
+    with sim:
+        yield sim, str(inventory_file)
+
+
+def load(inventory_file, tag_backend):
+    inv = Inventory(tag_backend=tag_backend)
+    inv.initialize_inventory(inventory_file)
+    return inv
+
+
+@pytest.mark.parametrize('tag_backend', ['annotation', 'custom_fields'])
+def test_claim_between_reconfigure_and_set_field(lab, tag_backend):
+    """
+    Caller B allocates right after caller A's compare-and-swap reconfigure,
+    before A's custom field writes: B must not get the VM A is leasing.
+    """
+    sim, inventory_file = lab
+    # lease and release once, so a custom field VM already has its fields
+    load(inventory_file, tag_backend).allocate_vm('setup').release()
+    inv_a = load(inventory_file, tag_backend)
+    inv_b = load(inventory_file, tag_backend)
+    annotation = inv_a.tags if tag_backend == 'annotation' else inv_a.tags.annotation
+    write = annotation.write
+    outcome = dict()
+
+    def write_then_allocate(vm, previous=None, change_version=None):
+        change_version = write(vm, previous, change_version)
+        if 'b' not in outcome:
+            try:
+                outcome['b'] = inv_b.allocate_vm('owner-b').name
+            except AllocationError as e:
+                outcome['b'] = e
+        return change_version
+
+    annotation.write = write_then_allocate
+    vm = inv_a.allocate_vm('owner-a')
+
+    assert vm.name == 'vcn-1-1'
+    assert isinstance(outcome['b'], AllocationError)
+    check = load(inventory_file, tag_backend)
+    check.refresh_inventory_state()
+    assert check.find_leased_vm('owner-a').name == 'vcn-1-1'
+    assert check.find_leased_vm('owner-b') is None
+
+
+def test_release_is_seen_by_other_callers(lab):
+    """ A release through the custom field backend frees the VM for others """
+    sim, inventory_file = lab
+    inv_a = load(inventory_file, 'custom_fields')
+    inv_b = load(inventory_file, 'custom_fields')
+    vm = inv_a.allocate_vm('owner-a')
+    vm.set_tags(software_version='7.1.2')
+    vm.release()
+
+    assert inv_b.allocate_vm('owner-b').name == vm.name
+    assert inv_b.vms[0].state.software_version == '7.1.2'
+
+
+def test_claim_only_free_or_own_or_expired_lease(lab):
+    """ A VM leased until released is only claimable again by its owner """
+    sim, inventory_file = lab
+    load(inventory_file, 'annotation').allocate_vm('owner-a').claim('owner-a', lease_seconds=None)
+    inv = load(inventory_file, 'annotation')
+    inv.refresh_inventory_state()
+    vm = inv.vms[0]
+
+    assert not vm.can_claim('owner-b')
+    assert vm.can_claim('owner-a')
+    vm.state.lease_expiry = 1
+    assert vm.can_claim('owner-b')
+    vm.release()
+    assert vm.can_claim('owner-b')
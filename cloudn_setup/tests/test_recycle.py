@@ -0,0 +1,140 @@
+"""
+Inventory.recycle_vms against the in-process vSphere simulator
+(vmware/simulator.py).
+
+Run from the cloudn_setup directory:
+    python3 -m pytest tests
+"""
+from pathlib import Path
+import sys
+
+import pytest
+
+pytest.importorskip("pyVmomi")
+yaml = pytest.importorskip("yaml")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from vmware.inventory import AllocationError, Inventory, RECYCLE_OWNER
+from vmware.simulator import VsphereSimulator
+import vmware.utils as utils
+
+
+@pytest.fixture
+def inventory_file(tmp_path):
+    """ A simulator with two VMs and the inventory yaml describing them """
+    sim = VsphereSimulator()
+    spec = sim.build(1, 2)
+    inventory_file = tmp_path / 'inventory.yaml'
+    inventory_file.write_text(yaml.safe_dump(spec))
+    with sim:
+        yield str(inventory_file)
+
+
+def load(inventory_file, tag_backend='annotation'):
+    inv = Inventory(tag_backend=tag_backend)
+    inv.initialize_inventory(inventory_file)
+    inv.refresh_inventory_state()
+    return inv
+
+
+@pytest.mark.parametrize('tag_backend', ['annotation', 'custom_fields'])
+def test_recycle_skips_leased_vms(inventory_file, tag_backend):
+    leased = load(inventory_file, tag_backend).allocate_vm('owner-a')
+    inv = load(inventory_file, tag_backend)
+
+    results = inv.recycle_vms('golden', vms=inv.vms)
+
+    statuses = {result.vm.name: result.status for result in results}
+    assert statuses[leased.name] == 'skipped'
+    assert sorted(statuses.values()) == ['reverted', 'skipped']
+    check = load(inventory_file, tag_backend)
+    assert check.find_leased_vm('owner-a').name == leased.name
+    assert check.find_leased_vm(RECYCLE_OWNER) is None
+    recycled = check.get_inventory_object('vm', [
+        name for name, status in statuses.items() if status == 'reverted'][0])
+    assert recycled.is_free() and recycled.state.last_reset is not None
+
+
+def test_vm_is_not_allocated_while_reverted(inventory_file, monkeypatch):
+    inv = load(inventory_file)
+    other = load(inventory_file)
+    revert = utils._revert
+    outcome = dict()
+
+    def allocate_then_revert(vm, snapshot_name):
+        try:
+            outcome[vm.name] = other.allocate_vm('owner-b').name
+        except AllocationError as e:
+            outcome[vm.name] = e
+        revert(vm, snapshot_name)
+
+    monkeypatch.setattr(utils, '_revert', allocate_then_revert)
+    inv.recycle_vms('golden', max_concurrent=1)
+
+    first, second = [vm.name for vm in inv.vms]
+    # the VM being reverted is leased, the other one is still free
+    assert outcome[first] == second
+    assert second not in outcome
+
+
+def test_lease_taken_after_the_revert_is_kept(inventory_file, monkeypatch):
+    """ The revert restores a free annotation, which someone may lease at once """
+    inv = load(inventory_file)
+    other = load(inventory_file)
+    vm = inv.vms[0]
+    # only the recycled VM is left for owner-b
+    other.get_inventory_object('vm', inv.vms[1].name).claim('owner-c')
+    revert = utils._revert
+    outcome = dict()
+
+    def revert_then_allocate(vm, snapshot_name):
+        revert(vm, snapshot_name)
+        outcome['after'] = other.allocate_vm('owner-b').name
+
+    monkeypatch.setattr(utils, '_revert', revert_then_allocate)
+    results = inv.recycle_vms('golden', vms=[vm])
+
+    assert results[0].status == 'reverted'
+    assert outcome['after'] == vm.name
+    check = load(inventory_file)
+    assert check.find_leased_vm('owner-b').name == vm.name
+
+
+def test_reset_keeps_the_lease_through_the_revert(inventory_file, monkeypatch):
+    """ The cloudn_setup.py reset path: revert while leased, then release """
+    inv = load(inventory_file)
+    other = load(inventory_file)
+    vm, spare = inv.vms
+    vm.claim('ctrl-1', lease_seconds=None)
+    spare.claim('owner-c')
+    revert = utils._revert
+    outcome = dict()
+
+    def revert_between_allocations(vm, snapshot_name):
+        try:
+            outcome['before'] = other.allocate_vm('ctrl-2').name
+        except AllocationError as e:
+            outcome['before'] = e
+        revert(vm, snapshot_name)
+        outcome['after'] = other.allocate_vm('ctrl-2').name
+
+    monkeypatch.setattr(utils, '_revert', revert_between_allocations)
+    assert utils.revert_vm_to_snapshot(vm, 'golden')
+
+    assert isinstance(outcome['before'], AllocationError)
+    assert outcome['after'] == vm.name
+    assert not vm.release_reverted('ctrl-1', last_reset=1)
+    check = load(inventory_file)
+    assert check.find_leased_vm('ctrl-2').name == vm.name
+
+
+def test_reset_without_snapshot_records_no_reset(inventory_file):
+    inv = load(inventory_file)
+    vm = inv.vms[0]
+    vm.claim('ctrl-1', lease_seconds=None)
+
+    assert not utils.revert_vm_to_snapshot(vm, 'missing')
+    assert vm.release_reverted('ctrl-1')
+    check = load(inventory_file).get_inventory_object('vm', vm.name)
+    assert check.state.in_ci_use is False and check.state.last_reset is None
@@ -1,40 +1,175 @@
-import copy
+import importlib.util
+import json
+import logging
+import os
 from pathlib import Path
+import random
 import re
-import yaml
+import sys
+import tempfile
+import threading
+import time
 
-import vmware.utils as utils
+from vmware.tags import DEFAULT_TAG_BACKEND, AnnotationTags, get_tag_backend, parse_annotation
 
-from pyVim.task import WaitForTasks
-from pyVmomi import vim
+
+def _lazy_import(name):
+    """
+    Returns a module that is only executed on first attribute access, so the
+    vSphere SDK is not loaded by callers that never talk to vSphere (e.g.
+    get_vcn.py answering from the state cache)
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+utils = _lazy_import('vmware.utils')
 
 
 BASE_DIRECTORY = (Path.cwd() / Path(__file__)).parent
 DEFAULT_INVENTORY_FILE = "inventory_data.yaml"
+# Number of hosts refreshed in parallel and seconds allowed per host
+DEFAULT_REFRESH_WORKERS = 8
+DEFAULT_HOST_TIMEOUT = 30
+# Seconds a VM handed out by allocate_vm stays leased unless it is renewed
+DEFAULT_LEASE_SECONDS = 3600
+# Owner VMs are leased to while recycle_vms reverts them, and for how long
+RECYCLE_OWNER = "recycle"
+RECYCLE_LEASE_SECONDS = 1800
+
+logger = logging.getLogger(__name__)
+
+# Number in the index keys of the inventory yaml, e.g. '[12]'
+INDEX_RE = re.compile(r'\d+')
+
+
+def load_inventory_spec(file):
+    """
+    Returns the parsed inventory yaml. The parse result is cached as JSON
+    next to the file, keyed by its size and mtime, so only the first load
+    after an edit pays for the YAML parser (the C one when available).
+    """
+    path = Path(file)
+    stat = path.stat()
+    key = [stat.st_size, stat.st_mtime_ns]
+    cache_path = path.with_name('.' + path.name + '.cache.json')
+    try:
+        with open(str(cache_path), 'r') as f:
+            cached = json.load(f)
+        if cached.get('key') == key:
+            return cached['data']
+    except (OSError, ValueError):
+        pass
+
+    import yaml
+    with open(file, 'r') as f:
+        data = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+    tmp_path = None
+    try:
+        payload = json.dumps({'key': key, 'data': data})
+        # only cache what survives the JSON round trip unchanged
+        if json.loads(payload)['data'] == data:
+            fd, tmp_path = tempfile.mkstemp(
+                dir=str(path.parent), prefix=cache_path.name, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                f.write(payload)
+            os.replace(tmp_path, str(cache_path))
+            tmp_path = None
+    except (OSError, TypeError, ValueError) as e:
+        logger.debug("Not caching inventory %s: %s", file, e)
+    finally:
+        if tmp_path is not None:
+            os.unlink(tmp_path)
+    return data
+
+
+def _call_with_timeout(func, arg, timeout):
+    """
+    Calls func(arg) in a daemon thread and waits at most timeout seconds for
+    it, so a hung vSphere call can neither stall the caller nor keep the
+    interpreter from exiting
+    """
+    result = dict()
+
+    def target():
+        try:
+            result['value'] = func(arg)
+        except Exception as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise TimeoutError("no answer after {} seconds".format(timeout))
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
+
+class LeaseConflictError(RuntimeError):
+    """ Raised when a VM was modified by someone else since it was last read """
+
+
+class AllocationError(RuntimeError):
+    """ Raised when no VM could be leased """
 
 
 class State():
     """ Class to store all CI-related state of VMs """
 
+    __slots__ = ('power_state', 'in_ci_use', 'lease_expiry', 'last_reset', 'software_version')
+
     def __init__(self):
         self.power_state = None
+        # False when free, otherwise the owner of the lease
         self.in_ci_use = False
+        # Epoch seconds after which the lease can be reclaimed, None if the
+        # lease does not expire
+        self.lease_expiry = None
+        # Epoch seconds of the last reset to the golden snapshot
+        self.last_reset = None
+        # Software version the VM was last upgraded to
+        self.software_version = None
+
+    def as_dict(self):
+        """ Returns the state as a dict, in declaration order """
+        return {prop: getattr(self, prop) for prop in self.__slots__}
 
 
 class Inventory():
 
-    def __init__(self):
+    def __init__(self, refresh_workers=DEFAULT_REFRESH_WORKERS,
+                 host_timeout=DEFAULT_HOST_TIMEOUT, state_cache=None,
+                 tag_backend=DEFAULT_TAG_BACKEND):
         self.vms = list()
         self.hosts = list()
         self.vcs = list()
         self.spec = None
+        self.refresh_workers = refresh_workers
+        self.host_timeout = host_timeout
+        self.refresh_errors = dict()
+        # Optional vmware.state_cache.StateCache shared with the VMs
+        self.state_cache = state_cache
+        # vmware.tags backend the VMs store their state with
+        self.tags = get_tag_backend(tag_backend)
+        # Objects keyed by type, then by name, and VMs by host
+        self._by_name = {type: dict() for type in INVENTORY_CLASSES}
+        self._vms_by_host = dict()
 
     def initialize_inventory(self, file=None):
         """ Reads inventory data from user yaml and initializes objects """
         file = file or str(BASE_DIRECTORY / DEFAULT_INVENTORY_FILE)
-        with open(file, 'r') as f:
-            data = yaml.safe_load(f)
-        
+        data = load_inventory_spec(file)
+
         self.spec = data["inventory"]
         self._configure_vcs()
         self._configure_hosts()
@@ -50,11 +185,10 @@ class Inventory():
         self._add_objs_to_inventory(type)
 
         for host in self.hosts:
-            kwargs = copy.deepcopy(host.spec)
-            if 'vc' in host.spec:
-                obj = self.get_inventory_object('vc', host.spec.get('vc'))
-                kwargs['vc'] = obj
-            host.init(**kwargs)               
+            kwargs = dict(host.spec)
+            if 'vc' in kwargs:
+                kwargs['vc'] = self.get_inventory_object('vc', kwargs['vc'])
+            host.init(**kwargs)
 
     def _configure_vms(self):
         """ Initializes all VMs from the inventory yaml """
@@ -62,50 +196,210 @@ class Inventory():
         self._add_objs_to_inventory(type)
 
         for vm in self.vms:
-            kwargs = copy.deepcopy(vm.spec)
-            if 'host' in vm.spec:
-                obj = self.get_inventory_object('host', vm.spec.get('host'))
-                kwargs['host'] = obj
+            kwargs = dict(vm.spec)
+            if 'host' in kwargs:
+                kwargs['host'] = self.get_inventory_object('host', kwargs['host'])
             vm.init(**kwargs)
+            vm.state_cache = self.state_cache
+            vm.tags = self.tags
+            self._vms_by_host.setdefault(vm.host, []).append(vm)
 
     def _add_objs_to_inventory(self, type):
         """
         Instantiates an object based on its type (e.g. host or vm) and adds it
         to the corresponding collection in the inventory
         """
-        klasses = globals()
-        for index, spec in self.spec.get(type).items():
-            cls = klasses[type.title()]
+        cls = INVENTORY_CLASSES[type]
+        collection = getattr(self, type + "s")
+        by_name = self._by_name[type]
+        for index, spec in (self.spec.get(type) or {}).items():
             id = spec.get("id")
-            name = spec.get("name") or (type + re.search(r'\d+', index).group())
+            name = spec.get("name") or (type + INDEX_RE.search(index).group())
             obj = cls(spec=spec, name=name, id=id)
-            collection = getattr(self, type + "s")
             collection.append(obj)
-    
+            by_name.setdefault(name, obj)
+
     def get_inventory_object(self, type, name):
         """ Returns inventory object matching the type and name """
-        objs = getattr(self, type + 's')
-        obj = [x for x in objs if x.name == name][0]
-        return obj
+        try:
+            return self._by_name[type][name]
+        except KeyError:
+            raise IndexError("No {} named {} in the inventory".format(type, name))
 
-    def refresh_inventory_state(self):
-        """ Scans all VMs and gets their current tags """
-        for vm in self.vms:
-            vm.refresh_tags()
+    def refresh_inventory_state(self, max_age=None):
+        """
+        Gets the current tags of all VMs. Hosts are refreshed in parallel,
+        fetching the properties of every VM on a host in a single round trip.
+        A host that fails or does not answer within host_timeout does not
+        stop the refresh: its VMs are left without a power state, so they are
+        never handed out, and the error is returned keyed by host name.
+
+        If the inventory has a state cache, hosts whose cached state is at
+        most max_age seconds old (the cache ttl by default) are answered from
+        the cache. Pass max_age=0 to force a fresh read.
+        """
+        vms_by_host = {host: list(vms) for host, vms in self._vms_by_host.items()}
+
+        if self.state_cache is not None:
+            for host in list(vms_by_host):
+                cached = self.state_cache.load_host(host.name, max_age=max_age)
+                if cached is None:
+                    continue
+                if all(vm.name in cached for vm in vms_by_host[host]):
+                    for vm in vms_by_host.pop(host):
+                        vm.load_cache_entry(cached[vm.name])
+        if not vms_by_host:
+            self.refresh_errors = dict()
+            return self.refresh_errors
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        properties = utils.VM_PROPERTIES + list(self.tags.properties)
+
+        def refresh_host(host):
+            return _call_with_timeout(
+                lambda host: utils.retrieve_vm_properties(host, properties), host,
+                self.host_timeout)
+
+        errors = dict()
+        workers = max(1, min(self.refresh_workers, len(vms_by_host)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {host: executor.submit(refresh_host, host)
+                       for host in vms_by_host}
+            for host, future in futures.items():
+                try:
+                    vm_props = future.result()
+                except Exception as e:
+                    logger.error("Failed to refresh host %s: %s", host.ip, e)
+                    errors[host.name] = e
+                    for vm in vms_by_host[host]:
+                        vm.state.power_state = None
+                    continue
+
+                found = True
+                for vm in vms_by_host[host]:
+                    props = vm_props.get(vm.name)
+                    if props is None:
+                        logger.warning("VM %s not found on host %s", vm.name, host.ip)
+                        found = False
+                        continue
+                    vm.apply_properties(props)
+                if self.state_cache is not None and found:
+                    self.state_cache.store_host(host.name, {
+                        vm.name: vm.cache_entry() for vm in vms_by_host[host]})
+
+        self.refresh_errors = errors
+        return errors
 
     def get_available_vms(self):
         """ Returns a list of VMs available for CI to use """
-        return [vm for vm in self.vms if (
-                vm.state.power_state == 'poweredOn' and vm.state.in_ci_use == False)]
+        now = time.time()
+        return [vm for vm in self.vms if vm.is_free(now)]
+
+    def find_leased_vm(self, owner):
+        """ Returns the VM leased by owner, or None """
+        for vm in self.vms:
+            if vm.state.in_ci_use and str(vm.state.in_ci_use) == owner:
+                return vm
+        return None
+
+    def allocate_vm(self, owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """
+        Leases a free VM to owner and returns it. The state is always read
+        fresh, and each claim is a compare-and-swap on the VM's changeVersion,
+        so concurrent callers never get the same VM. A VM already leased by
+        owner is returned as is, and renewed if its lease has expired.
+        """
+        self.refresh_inventory_state(max_age=0)
+        vm = self.find_leased_vm(owner)
+        if vm is not None:
+            if vm.state.lease_expiry is not None and vm.state.lease_expiry < time.time():
+                vm.claim(owner, lease_seconds)
+            return vm
+
+        for vm in self._allocation_order():
+            try:
+                vm.claim(owner, lease_seconds)
+            except LeaseConflictError:
+                logger.info("VM %s was claimed concurrently, trying the next one", vm.name)
+                continue
+            logger.info("Leased VM %s to %s", vm.name, owner)
+            return vm
+        raise AllocationError("No free VM to lease to {}".format(owner))
+
+    def _allocation_order(self):
+        """
+        Returns the free VMs, least loaded hosts first. VMs are shuffled within
+        a host so concurrent callers start from different candidates.
+        """
+        now = time.time()
+        load = dict()
+        for vm in self.vms:
+            if not vm.is_free(now) and vm.state.in_ci_use:
+                load[vm.host] = load.get(vm.host, 0) + 1
+
+        candidates = self.get_available_vms()
+        random.shuffle(candidates)
+        return sorted(candidates, key=lambda vm: load.get(vm.host, 0))
+
+    def recycle_vms(self, snapshot_name, vms=None, max_concurrent=None):
+        """
+        Reverts VMs to snapshot_name in parallel and records the reset time
+        on every reverted VM. By default all VMs that are not leased are
+        recycled. Each VM is leased to RECYCLE_OWNER with a compare-and-swap
+        while it is reverted, so a VM leased by someone else, or allocated
+        meanwhile, is skipped and never reverted under its owner.
+        :return: list of utils.RevertResult, in the order of vms
+        """
+        self.refresh_inventory_state(max_age=0)
+        if vms is None:
+            vms = self.get_available_vms()
+
+        def claim(vm):
+            if not vm.can_claim(RECYCLE_OWNER):
+                logger.info("VM %s is leased to %s, not recycling it", vm.name, vm.state.in_ci_use)
+                return False
+            try:
+                vm.claim(RECYCLE_OWNER, RECYCLE_LEASE_SECONDS)
+            except LeaseConflictError:
+                logger.info("VM %s was claimed concurrently, not recycling it", vm.name)
+                return False
+            return True
+
+        def record_reset(vm):
+            vm.release_reverted(RECYCLE_OWNER, last_reset=time.time())
+
+        results = utils.revert_vms_to_snapshot(
+            vms, snapshot_name, max_concurrent=max_concurrent or utils.DEFAULT_REVERT_CONCURRENCY,
+            before_revert=claim, on_reverted=record_reset)
+        for result in results:
+            if result.status in ('not_found', 'failed') and result.vm.state.in_ci_use == RECYCLE_OWNER:
+                try:
+                    result.vm.release_reverted(RECYCLE_OWNER)
+                except Exception as e:
+                    logger.warning("Cannot release VM %s after a failed revert: %s",
+                                   result.vm.name, e)
+        if self.state_cache is not None:
+            for host in set(result.vm.host for result in results):
+                self.state_cache.invalidate(host.name)
+        reverted = len([result for result in results if result.status == 'reverted'])
+        skipped = len([result for result in results if result.status == 'skipped'])
+        logger.info("Recycled %s of %s VMs to snapshot %s, %s skipped as leased",
+                    reverted, len(results), snapshot_name, skipped)
+        return results
 
 
 class InventoryObj(object):
+    __slots__ = ('spec', 'id')
+
     def __init__(self, spec=None, id=None):
         self.spec = spec
         self.id = id
 
 
 class Vc(InventoryObj):
+    __slots__ = ('name', 'ip', 'username', 'password')
+
     def __init__(self, spec=None, name=None, **kwargs):
         super(Vc, self).__init__(spec=spec)
         self.name = name
@@ -117,6 +411,7 @@ class Vc(InventoryObj):
 
 
 class Host(InventoryObj):
+    __slots__ = ('name', 'vc', 'ip', 'username', 'password', 'state')
 
     def __init__(self, spec=None, name=None, id=None):
         super(Host, self).__init__(spec=spec, id=id)
@@ -131,10 +426,21 @@ class Host(InventoryObj):
 
 
 class Vm(InventoryObj):
+    __slots__ = ('name', 'change_version', 'state_cache', 'tags', 'tag_schema', '_mobj',
+                 'snapshot_index', 'host', 'ip', 'state')
 
     def __init__(self, spec=None, name=None, id=None):
         super(Vm, self).__init__(spec=spec, id=id)
         self.name = name
+        self.change_version = None
+        self.state_cache = None
+        # vmware.tags backend, shared by the VMs of an inventory, and the
+        # schema version of the tags last read (None for an annotation)
+        self.tags = AnnotationTags()
+        self.tag_schema = None
+        self._mobj = None
+        # (moId, {snapshot name: moId}), see utils.get_vm_snapshot_index
+        self.snapshot_index = None
 
     def init(self, name=None, host=None, ip=None, **kwargs):
         self.host = host
@@ -143,35 +449,191 @@ class Vm(InventoryObj):
         # and ssh is available
         self.state = State()
 
+    def get_mobj(self):
+        """
+        Returns the vim.VirtualMachine for this VM. The managed object is
+        cached after the first lookup and only resolved again, by moId first
+        and by name as a fallback, once it is no longer valid.
+        """
+        if self._mobj is not None and utils.is_vm_mobj_valid(
+                self._mobj, self.host, self.name):
+            return self._mobj
+
+        vm_mobj = None
+        if self.id:
+            vm_mobj = utils.get_vm_by_moid(self.host, self.id)
+            if not utils.is_vm_mobj_valid(vm_mobj, self.host, self.name):
+                vm_mobj = None
+        if vm_mobj is None:
+            predicate = lambda x: x.name == self.name
+            vm_mobj = utils.get_vm_from_host(self.host, predicate=predicate)[0]
+        self._mobj = vm_mobj
+        self.id = vm_mobj._moId
+        return vm_mobj
+
     def refresh_tags(self):
         """ Gets the runtime annotations of the VM from its host/VC """
-        predicate = lambda x: x.name == self.name
-        vm_mobj = utils.get_vm_from_host(self.host, predicate=predicate)[0]
-        self.id = vm_mobj._moId
-        annotations = vm_mobj.config.annotation.split(",")
-        for annotation in annotations:
-            if not annotation:
-                continue
-            prop, value = annotation.split(":")
+        vm_mobj = self.get_mobj()
+        props = {
+            'obj': vm_mobj,
+            'config.annotation': vm_mobj.config.annotation,
+            'config.changeVersion': vm_mobj.config.changeVersion,
+            'runtime.powerState': vm_mobj.runtime.powerState,
+        }
+        if 'customValue' in self.tags.properties:
+            props['customValue'] = vm_mobj.customValue
+        self.apply_properties(props)
+
+    def apply_properties(self, props):
+        """
+        Updates the VM state from properties retrieved from its host/VC, as
+        returned by utils.retrieve_vm_properties
+        """
+        self._mobj = props['obj']
+        self.id = self._mobj._moId
+        values, self.tag_schema = self.tags.read(self, props)
+        # values missing from the tags, e.g. after a revert to an untagged
+        # snapshot, are back to their defaults rather than kept from before
+        for prop, value in State().as_dict().items():
+            setattr(self.state, prop, values.get(prop, value))
+        self.state.power_state = props.get('runtime.powerState')
+        self.change_version = props.get('config.changeVersion')
+
+    def cache_entry(self):
+        """ Returns the VM state as stored in the state cache """
+        return {'id': self.id, 'change_version': self.change_version,
+                'tag_schema': self.tag_schema, 'state': self.state.as_dict()}
+
+    def load_cache_entry(self, entry):
+        """ Restores the VM state from a state cache entry """
+        self.id = entry.get('id')
+        self.change_version = entry.get('change_version')
+        self.tag_schema = entry.get('tag_schema')
+        for prop, value in entry.get('state', {}).items():
             if hasattr(self.state, prop):
-                if value in ('True', 'False'):
-                    value = eval(value)
                 setattr(self.state, prop, value)
-        self.state.power_state = vm_mobj.runtime.powerState
 
-    def update_tags(self):
-        """ Read state and update annotations on the VM """
-        current_state = ",".join(
-            [(prop + ':' + str(value)) for prop, value in vars(self.state).items()])
-        predicate = lambda x: x.name == self.name
-        vm_mobj = utils.get_vm_from_host(self.host, predicate=predicate)[0]
-        spec = vim.vm.ConfigSpec()
-        spec.annotation = current_state
-        task = vm_mobj.ReconfigVM_Task(spec)
-        WaitForTasks([task])
+    def is_free(self, now=None):
+        """ Returns True if the VM is powered on and not leased or its lease expired """
+        if self.state.power_state != 'poweredOn':
+            return False
+        if not self.state.in_ci_use:
+            return True
+        expiry = self.state.lease_expiry
+        return expiry is not None and expiry < (now or time.time())
+
+    def can_claim(self, owner, now=None):
+        """ Returns True if the VM is not leased, leased to owner, or its lease expired """
+        if not self.state.in_ci_use or self.state.in_ci_use == owner:
+            return True
+        expiry = self.state.lease_expiry
+        return expiry is not None and expiry < (now or time.time())
+
+    def claim(self, owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """
+        Leases the VM to owner for lease_seconds, or until released if
+        lease_seconds is None. Raises LeaseConflictError if the VM changed
+        since its state was last read.
+        """
+        expiry = time.time() + lease_seconds if lease_seconds else None
+        self._set_state(dict(in_ci_use=owner, lease_expiry=expiry), self.change_version)
+
+    def release(self, change_version=None, **values):
+        """
+        Ends the lease of the VM, also setting the state values given. With
+        change_version, the release is a compare-and-swap like claim.
+        """
+        values.update(in_ci_use=False, lease_expiry=None)
+        self._set_state(values, change_version)
+
+    def release_reverted(self, owner, **values):
+        """
+        Ends the lease owner held while the VM was reverted, also setting the
+        state values given. The revert restored the annotation of the
+        snapshot, which may show the VM free, so the VM is only released if
+        nobody else leased it since, compared against its configuration as
+        it is now. Returns True if the VM was released.
+        """
+        config = self.get_mobj().config
+        lease = parse_annotation(config.annotation)
+        holder, expiry = lease.get('in_ci_use'), lease.get('lease_expiry')
+        if holder and holder != owner and (expiry is None or expiry > time.time()):
+            logger.info("VM %s was leased to %s while it was reverted", self.name, holder)
+            return False
+        try:
+            self.release(change_version=config.changeVersion, **values)
+        except LeaseConflictError:
+            logger.info("VM %s was leased while it was reverted", self.name)
+            return False
+        return True
+
+    def set_tags(self, **values):
+        """ Sets state values of the VM, e.g. last_reset or software_version """
+        self._set_state(values)
+
+    def _set_state(self, values, change_version=None):
+        """ Sets and writes state values, restoring them if the write conflicts """
+        previous = self.state.as_dict()
+        for prop, value in values.items():
+            if not hasattr(self.state, prop):
+                raise AttributeError("VM state has no {}".format(prop))
+            setattr(self.state, prop, value)
+        try:
+            self.update_tags(change_version=change_version, previous=previous)
+        except LeaseConflictError:
+            for prop, value in previous.items():
+                setattr(self.state, prop, value)
+            raise
+
+    def update_tags(self, change_version=None, previous=None):
+        """
+        Writes the state to the VM through its tag backend. previous is the
+        state as last written, so backends can write only what changed. If
+        change_version is given, the update only succeeds if the VM
+        configuration has not changed since then, otherwise
+        LeaseConflictError is raised.
+        """
+        try:
+            self.change_version = self.tags.write(
+                self, previous, change_version=change_version)
+            self.tag_schema = self.tags.schema_version
+        except utils.ConcurrentModificationError as e:
+            raise LeaseConflictError(
+                "VM {} was modified concurrently: {}".format(self.name, e))
+        if self.state_cache is not None:
+            self.state_cache.invalidate(self.host.name)
+
+
+# Inventory yaml section -> class of its objects
+INVENTORY_CLASSES = {'vc': Vc, 'host': Host, 'vm': Vm}
 
 
 if __name__ == '__main__':
-    inventory = Inventory()
-    inventory.initialize_inventory()
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='vCloudN VM inventory',
+        epilog='run from the cloudn_setup directory: python3 -m vmware.inventory')
+    parser.add_argument('--inventory', help='inventory yaml, {} by default'.format(
+        DEFAULT_INVENTORY_FILE))
+    parser.add_argument('--tag_backend', default=DEFAULT_TAG_BACKEND,
+                        help='backend VM state is stored with: annotation or custom_fields')
+    parser.add_argument('--recycle', metavar='SNAPSHOT',
+                        help='revert VMs to this snapshot, all VMs not leased by default')
+    parser.add_argument('--vms', help='comma separated names of the VMs to recycle')
+    parser.add_argument('--max_concurrent', type=int, default=None,
+                        help='VMs reverted at the same time')
+    args = parser.parse_args()
+
+    inventory = Inventory(tag_backend=args.tag_backend)
+    inventory.initialize_inventory(args.inventory)
     inventory.refresh_inventory_state()
+    if args.recycle:
+        vms = None
+        if args.vms:
+            vms = [inventory.get_inventory_object('vm', name) for name in args.vms.split(',')]
+        results = inventory.recycle_vms(args.recycle, vms=vms, max_concurrent=args.max_concurrent)
+        for result in results:
+            print("{:<24} {:<10} {:>8.1f}s {}".format(
+                result.vm.name, result.status, result.duration, result.error or ""))
+        if any(result.status in ('not_found', 'failed') for result in results):
+            sys.exit(1)
@@ -0,0 +1,467 @@
+import itertools
+import logging
+import threading
+import time
+
+from pyVmomi import vim, vmodl
+
+import vmware.utils as utils
+
+
+logger = logging.getLogger(__name__)
+
+# Objects returned per RetrievePropertiesEx / ContinueRetrievePropertiesEx page
+DEFAULT_PAGE_SIZE = 100
+# Round trips pyVim's WaitForTasks makes: CreateFilter, WaitForUpdatesEx, DestroyPropertyFilter
+WAIT_ROUND_TRIPS = 3
+
+
+class SimulatedVm():
+    """ Server-side state of one simulated VM """
+
+    def __init__(self, moid, name, annotation="", power_state='poweredOn'):
+        self.moid = moid
+        self.name = name
+        self.annotation = annotation
+        self.power_state = power_state
+        self.change_version = 1
+        # custom field values by field key
+        self.custom_values = dict()
+        # snapshot trees: {'moid', 'name', 'power_state', 'children'}
+        self.snapshots = list()
+        self.current_snapshot = None
+
+    def revert(self, node):
+        """ Restores the power state and the configuration saved in a snapshot """
+        self.power_state = node['power_state']
+        self.annotation = node['annotation']
+        self.change_version += 1
+
+    def find_snapshot(self, moid):
+        stack = list(self.snapshots)
+        while stack:
+            node = stack.pop()
+            if node['moid'] == moid:
+                return node
+            stack.extend(node['children'])
+        return None
+
+    def remove_snapshot(self, moid, remove_children):
+        def remove(nodes):
+            for index, node in enumerate(nodes):
+                if node['moid'] == moid:
+                    nodes[index:index + 1] = [] if remove_children else node['children']
+                    return True
+                if remove(node['children']):
+                    return True
+            return False
+        return remove(self.snapshots)
+
+
+class SimulatedHost():
+    """ Server-side state of one simulated ESXi host """
+
+    def __init__(self, ip, username, password):
+        self.ip = ip
+        self.username = username
+        self.password = password
+        self.vms = dict()
+        # custom field keys by name
+        self.custom_fields = dict()
+
+
+class SimulatorStub():
+    """
+    Stands in for the SOAP stub of one vSphere session: pyVmomi managed
+    objects bound to it send every method call and property read here
+    instead of over the network. Each call counts as one round trip and
+    takes the configured latency.
+    """
+
+    def __init__(self, simulator, host, session_key):
+        self.simulator = simulator
+        self.host = host
+        self.session_key = session_key
+        self.logged_in = time.monotonic()
+        self.logged_out = False
+
+    def InvokeMethod(self, mo, info, args):
+        return self.simulator.invoke(self, mo, info.wsdlName,
+                                     dict(zip([param.name for param in info.params], args)))
+
+    def InvokeAccessor(self, mo, info):
+        return self.simulator.invoke(self, mo, info.name, None)
+
+
+class VsphereSimulator():
+    """
+    In-process stand-in for the part of the vSphere API used by vmware.utils
+    and vmware.inventory: session login/logout, container views, the
+    PropertyCollector (with paging), VM properties and annotations, custom
+    fields (CustomFieldsManager field definitions and SetField),
+    ReconfigVM_Task with changeVersion checks, snapshot trees, revert and
+    power tasks. Calls return real pyVmomi objects, so the code under test
+    runs unchanged.
+
+    install() points utils.session_manager and utils.WaitForTasks at the
+    simulator; use it as a context manager to restore them afterwards.
+
+    latency is the time in seconds each round trip takes, method_latency
+    overrides it per method or property name, and task_durations sets how
+    long tasks take to complete, per task method name.
+    """
+
+    def __init__(self, latency=0.0, method_latency=None, task_durations=None,
+                 page_size=DEFAULT_PAGE_SIZE, session_ttl=None):
+        self.latency = latency
+        self.method_latency = method_latency or dict()
+        self.task_durations = task_durations or dict()
+        self.page_size = page_size
+        self.session_ttl = session_ttl
+        self.hosts = dict()
+        self.stats = {'round_trips': 0, 'logins': 0, 'logouts': 0, 'calls': dict()}
+        self._lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self._tasks = dict()
+        self._views = dict()
+        self._pages = dict()
+        self._saved = None
+
+    # -- inventory ---------------------------------------------------------
+
+    def add_host(self, ip, username='root', password='Aviatrix123#'):
+        host = SimulatedHost(ip, username, password)
+        self.hosts[ip] = host
+        return host
+
+    def add_vm(self, host_ip, name, annotation="", power_state='poweredOn', snapshots=()):
+        """ Adds a VM with a chain of snapshots (each the child of the one before) """
+        vm = SimulatedVm('vm-{}'.format(next(self._ids)), name, annotation, power_state)
+        self.hosts[host_ip].vms[vm.moid] = vm
+        nodes = vm.snapshots
+        for snapshot_name in snapshots:
+            node = self._new_snapshot(vm, snapshot_name, memory=False)
+            nodes.append(node)
+            nodes = node['children']
+        return vm
+
+    def build(self, hosts, vms_per_host, snapshots=('golden',), name_format='vcn-{}-{}'):
+        """
+        Creates hosts x vms_per_host VMs and returns the matching inventory
+        yaml spec ({'inventory': {'host': ..., 'vm': ...}})
+        """
+        spec = {'host': dict(), 'vm': dict()}
+        for h in range(1, hosts + 1):
+            ip = '10.{}.{}.{}'.format(h // 65536, (h // 256) % 256, h % 256)
+            self.add_host(ip)
+            spec['host']['[{}]'.format(h)] = {'ip': ip}
+            for v in range(1, vms_per_host + 1):
+                name = name_format.format(h, v)
+                self.add_vm(ip, name, snapshots=snapshots)
+                spec['vm']['[{}]'.format(len(spec['vm']) + 1)] = {
+                    'name': name, 'host': 'host{}'.format(h)}
+        return {'inventory': spec}
+
+    def _new_snapshot(self, vm, name, memory):
+        node = {'moid': 'snapshot-{}'.format(next(self._ids)), 'name': name,
+                'power_state': vm.power_state if memory else 'poweredOff',
+                'annotation': vm.annotation, 'children': []}
+        vm.current_snapshot = node['moid']
+        return node
+
+    # -- installation ------------------------------------------------------
+
+    def install(self):
+        """ Routes vmware.utils sessions and task waits to the simulator """
+        utils.session_manager.logout_all()
+        self._saved = (utils.session_manager.connect, utils.WaitForTasks)
+        utils.session_manager.connect = self.connect
+        utils.WaitForTasks = self.wait_for_tasks
+        return self
+
+    def uninstall(self):
+        utils.session_manager.logout_all()
+        utils.session_manager.connect, utils.WaitForTasks = self._saved
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {'round_trips': 0, 'logins': 0, 'logouts': 0, 'calls': dict()}
+
+    def snapshot_stats(self):
+        with self._lock:
+            return dict(self.stats, calls=dict(self.stats['calls']))
+
+    # -- connection --------------------------------------------------------
+
+    def connect(self, host, user, pwd, **kwargs):
+        """ Same signature as SmartConnectNoSSL; returns a ServiceInstance """
+        self._round_trip('Login')
+        server = self.hosts.get(host)
+        if server is None:
+            raise vim.fault.HostConnectFault(msg="Cannot connect to {}".format(host))
+        if user != server.username or pwd != server.password:
+            raise vim.fault.InvalidLogin(msg="Cannot complete login due to an incorrect user name or password.")
+        with self._lock:
+            self.stats['logins'] += 1
+        stub = SimulatorStub(self, server, 'session-{}'.format(next(self._ids)))
+        return vim.ServiceInstance('ServiceInstance', stub)
+
+    def wait_for_tasks(self, tasks, **kwargs):
+        """ Replaces pyVim.task.WaitForTasks: waits for the tasks, raises a task error """
+        for _ in range(WAIT_ROUND_TRIPS):
+            self._round_trip('WaitForTasks')
+        for task in tasks:
+            with self._lock:
+                finish, error = self._tasks[task._moId]
+            remaining = finish - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+            if error is not None:
+                raise error
+
+    # -- dispatch ----------------------------------------------------------
+
+    def _round_trip(self, name):
+        delay = self.method_latency.get(name, self.latency)
+        if delay:
+            time.sleep(delay)
+        with self._lock:
+            self.stats['round_trips'] += 1
+            self.stats['calls'][name] = self.stats['calls'].get(name, 0) + 1
+
+    def invoke(self, stub, mo, name, args):
+        self._round_trip(name)
+        with self._lock:
+            if stub.logged_out or (self.session_ttl is not None and
+                                   time.monotonic() - stub.logged_in > self.session_ttl):
+                if name == 'currentSession':
+                    return None
+                raise vim.fault.NotAuthenticated(object=mo, privilegeId='System.View')
+            handler = getattr(self, '_{}_{}'.format(type(mo).__name__.split('.')[-1], name), None)
+            if handler is None:
+                raise vmodl.fault.NotSupported(msg="Simulator does not implement {}.{}".format(
+                    type(mo).__name__, name))
+            return handler(stub, mo, args)
+
+    def _task(self, stub, method, error=None):
+        task = vim.Task('task-{}'.format(next(self._ids)), stub)
+        self._tasks[task._moId] = (time.monotonic() + self.task_durations.get(method, 0), error)
+        return task
+
+    def _vm(self, stub, mo):
+        vm = stub.host.vms.get(mo._moId)
+        if vm is None:
+            raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+        return vm
+
+    # ServiceInstance, SessionManager, views
+
+    def _ServiceInstance_content(self, stub, mo, args):
+        return vim.ServiceInstanceContent(
+            rootFolder=vim.Folder('ha-folder-root', stub),
+            propertyCollector=vmodl.query.PropertyCollector('ha-property-collector', stub),
+            viewManager=vim.view.ViewManager('ViewManager', stub),
+            sessionManager=vim.SessionManager('ha-sessionmgr', stub),
+            customFieldsManager=vim.CustomFieldsManager('ha-custom-fields-manager', stub),
+            about=vim.AboutInfo(name='VMware ESXi (simulated)', apiType='HostAgent'))
+
+    _ServiceInstance_RetrieveServiceContent = _ServiceInstance_content
+
+    def _ServiceInstance_CurrentTime(self, stub, mo, args):
+        import datetime
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    def _SessionManager_currentSession(self, stub, mo, args):
+        return vim.UserSession(key=stub.session_key, userName=stub.host.username)
+
+    def _SessionManager_Logout(self, stub, mo, args):
+        stub.logged_out = True
+        self.stats['logouts'] += 1
+
+    def _ViewManager_CreateContainerView(self, stub, mo, args):
+        view = vim.view.ContainerView('session[{}]view-{}'.format(
+            stub.session_key, next(self._ids)), stub)
+        self._views[view._moId] = [vim.VirtualMachine(vm.moid, stub)
+                                   for vm in stub.host.vms.values()]
+        return view
+
+    def _ContainerView_view(self, stub, mo, args):
+        return list(self._views[mo._moId])
+
+    def _ContainerView_DestroyView(self, stub, mo, args):
+        self._views.pop(mo._moId, None)
+
+    # CustomFieldsManager
+
+    def _field_defs(self, stub):
+        return [vim.CustomFieldsManager.FieldDef(key=key, name=name,
+                                                 managedObjectType=vim.VirtualMachine)
+                for name, key in stub.host.custom_fields.items()]
+
+    def _CustomFieldsManager_field(self, stub, mo, args):
+        return self._field_defs(stub)
+
+    def _CustomFieldsManager_AddCustomFieldDef(self, stub, mo, args):
+        fields = stub.host.custom_fields
+        if args['name'] in fields:
+            raise vim.fault.DuplicateName(name=args['name'], object=mo)
+        fields[args['name']] = len(fields) + 100
+        return [x for x in self._field_defs(stub) if x.name == args['name']][0]
+
+    def _CustomFieldsManager_SetField(self, stub, mo, args):
+        if args['key'] not in stub.host.custom_fields.values():
+            raise vmodl.fault.InvalidArgument(invalidProperty='key')
+        self._vm(stub, args['entity']).custom_values[args['key']] = args['value']
+
+    # PropertyCollector
+
+    def _object_content(self, stub, vm, path_set):
+        props = list()
+        for path in path_set:
+            value = self._read_path(stub, vm, path)
+            props.append(vmodl.DynamicProperty(name=path, val=value))
+        return vmodl.query.PropertyCollector.ObjectContent(
+            obj=vim.VirtualMachine(vm.moid, stub), propSet=props)
+
+    def _read_path(self, stub, vm, path):
+        if path == 'name':
+            return vm.name
+        if path == 'config.annotation':
+            return vm.annotation
+        if path == 'config.changeVersion':
+            return str(vm.change_version)
+        if path == 'runtime.powerState':
+            return vm.power_state
+        value = getattr(self, '_VirtualMachine_' + path.split('.')[0])(stub, vim.VirtualMachine(vm.moid, stub), None)
+        for part in path.split('.')[1:]:
+            value = getattr(value, part)
+        return value
+
+    def _page(self, stub, objects):
+        token = None
+        if len(objects) > self.page_size:
+            token = 'token-{}'.format(next(self._ids))
+            self._pages[token] = objects[self.page_size:]
+            objects = objects[:self.page_size]
+        return vmodl.query.PropertyCollector.RetrieveResult(token=token, objects=objects)
+
+    def _PropertyCollector_RetrievePropertiesEx(self, stub, mo, args):
+        objects = list()
+        for spec in args['specSet']:
+            path_set = [path for prop in spec.propSet for path in prop.pathSet]
+            for obj_spec in spec.objectSet:
+                if isinstance(obj_spec.obj, vim.view.ContainerView):
+                    targets = self._views[obj_spec.obj._moId]
+                else:
+                    targets = [obj_spec.obj]
+                for target in targets:
+                    vm = stub.host.vms.get(target._moId)
+                    if vm is not None:
+                        objects.append(self._object_content(stub, vm, path_set))
+        return self._page(stub, objects)
+
+    def _PropertyCollector_ContinueRetrievePropertiesEx(self, stub, mo, args):
+        objects = self._pages.pop(args['token'], None)
+        if objects is None:
+            raise vmodl.fault.InvalidArgument(invalidProperty='token')
+        return self._page(stub, objects)
+
+    # VirtualMachine
+
+    def _VirtualMachine_name(self, stub, mo, args):
+        return self._vm(stub, mo).name
+
+    def _VirtualMachine_config(self, stub, mo, args):
+        vm = self._vm(stub, mo)
+        return vim.vm.ConfigInfo(name=vm.name, annotation=vm.annotation,
+                                 changeVersion=str(vm.change_version))
+
+    def _VirtualMachine_customValue(self, stub, mo, args):
+        return vim.CustomFieldsManager.Value.Array([
+            vim.CustomFieldsManager.StringValue(key=key, value=value)
+            for key, value in sorted(self._vm(stub, mo).custom_values.items())])
+
+    def _VirtualMachine_runtime(self, stub, mo, args):
+        return vim.vm.RuntimeInfo(powerState=self._vm(stub, mo).power_state)
+
+    def _VirtualMachine_snapshot(self, stub, mo, args):
+        vm = self._vm(stub, mo)
+        if not vm.snapshots:
+            return None
+
+        def tree(node):
+            return vim.vm.SnapshotTree(
+                name=node['name'], snapshot=vim.vm.Snapshot(node['moid'], stub),
+                vm=mo, state=node['power_state'],
+                childSnapshotList=[tree(child) for child in node['children']])
+
+        return vim.vm.SnapshotInfo(
+            currentSnapshot=vim.vm.Snapshot(vm.current_snapshot, stub) if vm.current_snapshot else None,
+            rootSnapshotList=[tree(node) for node in vm.snapshots])
+
+    def _VirtualMachine_ReconfigVM_Task(self, stub, mo, args):
+        vm = self._vm(stub, mo)
+        spec = args['spec']
+        if spec.changeVersion and spec.changeVersion != str(vm.change_version):
+            return self._task(stub, 'ReconfigVM_Task', vim.fault.ConcurrentAccess(
+                msg="The object has already been updated or deleted."))
+        if spec.annotation is not None:
+            vm.annotation = spec.annotation
+        vm.change_version += 1
+        return self._task(stub, 'ReconfigVM_Task')
+
+    def _VirtualMachine_CreateSnapshot_Task(self, stub, mo, args):
+        vm = self._vm(stub, mo)
+        parent = vm.find_snapshot(vm.current_snapshot) if vm.current_snapshot else None
+        node = self._new_snapshot(vm, args['name'], args.get('memory'))
+        (parent['children'] if parent else vm.snapshots).append(node)
+        return self._task(stub, 'CreateSnapshot_Task')
+
+    def _VirtualMachine_RevertToCurrentSnapshot_Task(self, stub, mo, args):
+        vm = self._vm(stub, mo)
+        node = vm.find_snapshot(vm.current_snapshot) if vm.current_snapshot else None
+        if node is None:
+            return self._task(stub, 'RevertToCurrentSnapshot_Task', vim.fault.NotFound(
+                msg="The operation is not supported on the object."))
+        vm.revert(node)
+        return self._task(stub, 'RevertToCurrentSnapshot_Task')
+
+    def _VirtualMachine_PowerOnVM_Task(self, stub, mo, args):
+        vm = self._vm(stub, mo)
+        if vm.power_state == 'poweredOn':
+            return self._task(stub, 'PowerOnVM_Task', vim.fault.InvalidPowerState(
+                requestedState='poweredOn', existingState='poweredOn'))
+        vm.power_state = 'poweredOn'
+        return self._task(stub, 'PowerOnVM_Task')
+
+    def _VirtualMachine_PowerOffVM_Task(self, stub, mo, args):
+        self._vm(stub, mo).power_state = 'poweredOff'
+        return self._task(stub, 'PowerOffVM_Task')
+
+    # Snapshot (vim.vm.Snapshot)
+
+    def _snapshot_owner(self, stub, mo):
+        for vm in stub.host.vms.values():
+            node = vm.find_snapshot(mo._moId)
+            if node is not None:
+                return vm, node
+        raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+
+    def _Snapshot_RevertToSnapshot_Task(self, stub, mo, args):
+        vm, node = self._snapshot_owner(stub, mo)
+        vm.revert(node)
+        vm.current_snapshot = node['moid']
+        return self._task(stub, 'RevertToSnapshot_Task')
+
+    def _Snapshot_RemoveSnapshot_Task(self, stub, mo, args):
+        vm, node = self._snapshot_owner(stub, mo)
+        vm.remove_snapshot(node['moid'], args.get('removeChildren'))
+        if vm.current_snapshot and vm.find_snapshot(vm.current_snapshot) is None:
+            vm.current_snapshot = None
+        return self._task(stub, 'RemoveSnapshot_Task')
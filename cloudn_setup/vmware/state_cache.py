@@ -0,0 +1,92 @@
+import fcntl
+import json
+import logging
+import os
+from contextlib import contextmanager
+from pathlib import Path
+import tempfile
+import time
+
+
+BASE_DIRECTORY = (Path.cwd() / Path(__file__)).parent
+DEFAULT_CACHE_FILE = ".inventory_state.json"
+# Seconds a cached host state is served before the host is read again
+DEFAULT_CACHE_TTL = 60
+
+logger = logging.getLogger(__name__)
+
+
+class StateCache():
+    """
+    JSON file holding the last refreshed state of the VMs of each host, so
+    processes started in quick succession (e.g. every terraform plan) do not
+    all have to scan vSphere. Entries are keyed by host name and expire after
+    ttl seconds. Writers hold an exclusive lock and replace the file
+    atomically, so concurrent processes never read a partial file.
+    """
+
+    def __init__(self, path=None, ttl=DEFAULT_CACHE_TTL):
+        self.path = Path(path or BASE_DIRECTORY / DEFAULT_CACHE_FILE)
+        self.ttl = ttl
+
+    @contextmanager
+    def _locked(self):
+        lock_path = str(self.path) + ".lock"
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"hosts": {}}
+        except ValueError as e:
+            logger.warning("Ignoring corrupt state cache %s: %s", self.path, e)
+            return {"hosts": {}}
+
+    def _write(self, data):
+        fd, tmp_path = tempfile.mkstemp(
+            dir=str(self.path.parent), prefix=self.path.name, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, str(self.path))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def load_host(self, host_name, max_age=None):
+        """
+        Returns the cached VM entries of a host keyed by VM name, or None if
+        the host is not cached or its entry is older than max_age seconds
+        (the cache ttl by default)
+        """
+        max_age = self.ttl if max_age is None else max_age
+        if max_age <= 0:
+            return None
+        entry = self._read()["hosts"].get(host_name)
+        if not entry or time.time() - entry["refreshed_at"] > max_age:
+            return None
+        return entry["vms"]
+
+    def store_host(self, host_name, vms):
+        """ Stores the VM entries of a host, keyed by VM name """
+        with self._locked():
+            data = self._read()
+            data["hosts"][host_name] = {"refreshed_at": time.time(), "vms": vms}
+            self._write(data)
+
+    def invalidate(self, host_name=None):
+        """ Drops the cached entry of a host, or of all hosts """
+        with self._locked():
+            data = self._read()
+            if host_name is None:
+                data["hosts"] = {}
+            else:
+                data["hosts"].pop(host_name, None)
+            self._write(data)
@@ -0,0 +1,230 @@
+"""
+Backends storing the CI state of a VM (owner, lease, last reset, software
+version) on the VM itself.
+
+The annotation backend keeps the whole state in config.annotation as
+"prop:value,prop:value", and every write is a ReconfigVM_Task. The custom
+field backend keeps one vSphere custom field per state value, written with
+CustomFieldsManager.SetField, so a write only touches the keys that changed
+and needs no reconfigure task. Custom values are not part of the VM config,
+so they also survive a snapshot revert.
+
+A VM without the schema field is read from its annotation, so labs can move
+to custom fields VM by VM: the first write adds the fields. The lease (owner
+and expiry) stays authoritative in the annotation: it is only changed by a
+ReconfigVM_Task, for claims with the changeVersion the state was read at,
+and that compare-and-swap is what keeps two callers from leasing the same
+VM. SetField has no such check, so the owner and lease fields are a copy for
+display and are never read back. Servers without a CustomFieldsManager use
+the annotation.
+"""
+import logging
+import os
+import threading
+
+from common.tracing import tracer
+
+
+# Tag backend of new inventories, see TAG_BACKENDS
+DEFAULT_TAG_BACKEND = os.environ.get("AVX_TAG_BACKEND", "annotation")
+
+# Version of the custom field layout, stored in SCHEMA_FIELD of every VM
+SCHEMA_VERSION = 1
+FIELD_PREFIX = "avx."
+SCHEMA_FIELD = FIELD_PREFIX + "schema"
+# Custom field -> State attribute it stores
+FIELDS = {
+    FIELD_PREFIX + "owner": "in_ci_use",
+    FIELD_PREFIX + "lease_expiry": "lease_expiry",
+    FIELD_PREFIX + "last_reset": "last_reset",
+    FIELD_PREFIX + "software_version": "software_version",
+}
+# State attributes holding epoch seconds
+FLOAT_PROPS = ("lease_expiry", "last_reset")
+# State attributes of the lease, always read from and written to the annotation
+LEASE_PROPS = ("in_ci_use", "lease_expiry")
+
+logger = logging.getLogger(__name__)
+
+
+def parse_annotation(annotation):
+    """ Returns the state values of a "prop:value,..." annotation """
+    values = dict()
+    for entry in (annotation or "").split(","):
+        prop, sep, value = entry.partition(":")
+        if not sep:
+            continue
+        if value in ('True', 'False'):
+            value = value == 'True'
+        elif value == 'None':
+            value = None
+        elif prop in FLOAT_PROPS:
+            try:
+                value = float(value)
+            except ValueError:
+                logger.warning("Ignoring %s with invalid value %r", prop, value)
+                continue
+        values[prop] = value
+    return values
+
+
+def format_annotation(state):
+    """ Returns the "prop:value,..." annotation of a state dict """
+    return ",".join([(prop + ':' + str(value)) for prop, value in state.items()])
+
+
+def encode_field(prop, value):
+    """ Returns the custom field value of a state value; unset is '' """
+    if value is None or value is False:
+        return ""
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def decode_field(prop, value):
+    """ Returns the state value of a custom field value """
+    if not value:
+        return False if prop == 'in_ci_use' else None
+    if prop in FLOAT_PROPS:
+        return float(value)
+    return value
+
+
+class AnnotationTags():
+    """ Stores the whole state of a VM in its annotation """
+
+    # VM properties read() needs beyond utils.VM_PROPERTIES
+    properties = ()
+    schema_version = None
+
+    def read(self, vm, props):
+        """
+        Returns (state values, schema version) of a VM from properties
+        returned by utils.retrieve_vm_properties
+        """
+        return parse_annotation(props.get('config.annotation')), None
+
+    def write(self, vm, previous=None, change_version=None):
+        """
+        Writes the state of the VM and returns its changeVersion. previous
+        is the state as last written, if known. If change_version is given,
+        the write is rejected with utils.ConcurrentModificationError when
+        the VM changed since then.
+        """
+        import vmware.utils as utils
+        return utils.update_vm_annotation(
+            vm.get_mobj(), format_annotation(vm.state.as_dict()), change_version=change_version)
+
+
+class CustomFieldTags():
+    """ Stores the state of a VM in one custom field per value """
+
+    properties = ('customValue',)
+    schema_version = SCHEMA_VERSION
+
+    def __init__(self):
+        self.annotation = AnnotationTags()
+        # Field keys per server name, None if the server has no custom fields
+        self._keys = dict()
+        self._lock = threading.Lock()
+
+    def _manager(self, server):
+        import vmware.utils as utils
+        return utils.init_vsphere_client(server).content.customFieldsManager
+
+    def field_keys(self, server, create=False):
+        """
+        Returns the custom field keys of the server by field name, or None if
+        it does not support custom fields. With create, missing fields are
+        defined first. Keys are cached once all fields are defined.
+        """
+        with self._lock:
+            keys = self._keys.get(server.name, {})
+            if keys is None or len(keys) > len(FIELDS):
+                return keys
+            manager = self._manager(server)
+            if manager is None:
+                self._keys[server.name] = None
+                return None
+            keys = {field.name: field.key for field in manager.field or []
+                    if field.name.startswith(FIELD_PREFIX)}
+            missing = [name for name in [SCHEMA_FIELD] + list(FIELDS) if name not in keys]
+            if create and missing:
+                from pyVmomi import vim
+                for name in missing:
+                    try:
+                        field = manager.AddCustomFieldDef(name=name, moType=vim.VirtualMachine)
+                    except vim.fault.DuplicateName:
+                        # defined concurrently by another caller
+                        field = [x for x in manager.field if x.name == name][0]
+                    keys[name] = field.key
+                logger.info("Defined custom fields %s on %s", missing, server.name)
+            self._keys[server.name] = keys
+            return keys
+
+    def read(self, vm, props):
+        values = {value.key: value.value for value in props.get('customValue') or []}
+        keys = self.field_keys(vm.host) if values else None
+        schema = values.get(keys.get(SCHEMA_FIELD)) if keys else None
+        try:
+            schema = int(schema) if schema else None
+        except ValueError:
+            logger.warning("VM %s has invalid tag schema %r", vm.name, schema)
+            schema = None
+        if schema is None:
+            return self.annotation.read(vm, props)
+        if schema > SCHEMA_VERSION:
+            logger.warning("VM %s has tag schema %s, newer than %s", vm.name, schema,
+                           SCHEMA_VERSION)
+        state = {prop: decode_field(prop, values.get(keys.get(name)))
+                 for name, prop in FIELDS.items() if prop not in LEASE_PROPS}
+        lease = parse_annotation(props.get('config.annotation'))
+        state['in_ci_use'] = lease.get('in_ci_use', False)
+        state['lease_expiry'] = lease.get('lease_expiry')
+        return state, schema
+
+    def write(self, vm, previous=None, change_version=None):
+        keys = self.field_keys(vm.host, create=True)
+        if keys is None:
+            return self.annotation.write(vm, previous, change_version)
+        state = vm.state.as_dict()
+        lease_changed = previous is None or any(
+            previous.get(prop) != state[prop] for prop in LEASE_PROPS)
+        if change_version is not None or lease_changed:
+            change_version = self.annotation.write(vm, previous, change_version)
+        else:
+            change_version = vm.change_version
+
+        changes = list()
+        if vm.tag_schema != SCHEMA_VERSION:
+            # first write since the VM was tagged by an annotation
+            previous = None
+            changes.append((SCHEMA_FIELD, str(SCHEMA_VERSION)))
+        for name, prop in FIELDS.items():
+            value = encode_field(prop, state[prop])
+            if previous is None or encode_field(prop, previous.get(prop)) != value:
+                changes.append((name, value))
+        if changes:
+            vm_mobj = vm.get_mobj()
+            manager = self._manager(vm.host)
+            with tracer.span('SetField', category='vsphere', vm=vm.name, fields=len(changes)):
+                for name, value in changes:
+                    manager.SetField(entity=vm_mobj, key=keys[name], value=value)
+        return change_version
+
+
+# Tag backend name -> class
+TAG_BACKENDS = {
+    'annotation': AnnotationTags,
+    'custom_fields': CustomFieldTags,
+}
+
+
+def get_tag_backend(name=None):
+    """ Returns a new tag backend by name (DEFAULT_TAG_BACKEND if not given) """
+    name = name or DEFAULT_TAG_BACKEND
+    if name not in TAG_BACKENDS:
+        raise ValueError("Unknown tag backend {}, expected one of {}".format(
+            name, ", ".join(sorted(TAG_BACKENDS))))
+    return TAG_BACKENDS[name]()
@@ -1,14 +1,145 @@
-from collections import deque
+import atexit
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
 
-from pyVim.connect import SmartConnectNoSSL
+from pyVim.connect import Disconnect, SmartConnectNoSSL
 from pyVim.task import WaitForTasks
-from pyVmomi import vim
+from pyVmomi import vim, vmodl
+
+from common.tracing import tracer
+
+
+logger = logging.getLogger(__name__)
+
+# VM properties fetched in bulk when refreshing the inventory state
+VM_PROPERTIES = [
+    'name', 'config.annotation', 'config.changeVersion', 'runtime.powerState']
+
+# Minimum number of seconds between two liveness checks of a cached session
+SESSION_CHECK_INTERVAL = 60
+# Number of VMs revert_vms_to_snapshot reverts at the same time
+DEFAULT_REVERT_CONCURRENCY = 8
+
+# Outcome of reverting one VM: status is 'reverted', 'skipped', 'not_found' or 'failed'
+RevertResult = namedtuple('RevertResult', ['vm', 'snapshot', 'status', 'duration', 'error'])
+
+
+class ConcurrentModificationError(RuntimeError):
+    """ Raised when a VM configuration changed since its changeVersion was read """
+
+
+class SnapshotNotFoundError(RuntimeError):
+    """ Raised when a VM has no snapshot with the requested name """
+
+
+class SessionManager():
+    """
+    Keeps one vSphere ServiceInstance per server (host or VC) and hands it out
+    to every caller instead of logging in again. A cached session is checked
+    for liveness before reuse and re-authenticated if it has expired.
+    Sessions are opened with connect (SmartConnectNoSSL unless replaced,
+    e.g. by vmware.simulator).
+    """
+
+    def __init__(self, check_interval=SESSION_CHECK_INTERVAL, connect=None):
+        self.check_interval = check_interval
+        self.connect = connect
+        self.stats = {'logins': 0, 'reuses': 0, 'relogins': 0, 'logouts': 0}
+        self._sessions = dict()
+        self._last_checked = dict()
+        self._locks = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(server):
+        return (server.ip, server.username)
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _count(self, counter):
+        with self._lock:
+            self.stats[counter] += 1
+
+    @staticmethod
+    def _is_alive(si):
+        try:
+            return si.content.sessionManager.currentSession is not None
+        except Exception:
+            return False
+
+    def get(self, server):
+        """ Returns a logged-in ServiceInstance for the server """
+        key = self._key(server)
+        with self._key_lock(key):
+            si = self._sessions.get(key)
+            if si is not None:
+                now = time.monotonic()
+                if now - self._last_checked[key] < self.check_interval:
+                    self._count('reuses')
+                    return si
+                if self._is_alive(si):
+                    self._last_checked[key] = now
+                    self._count('reuses')
+                    return si
+                logger.info("vSphere session to %s expired, logging in again", server.ip)
+                self._count('relogins')
+
+            si = (self.connect or SmartConnectNoSSL)(
+                host=server.ip, user=server.username, pwd=server.password)
+            self._count('logins')
+            self._sessions[key] = si
+            self._last_checked[key] = time.monotonic()
+            return si
+
+    def logout(self, server):
+        """ Logs out of the cached session for the server, if there is one """
+        key = self._key(server)
+        with self._key_lock(key):
+            self._disconnect(key)
+
+    def logout_all(self):
+        """ Logs out of every cached session """
+        for key in list(self._sessions):
+            # A session still held by a hung call is skipped rather than
+            # waited for, so exiting never blocks on an unreachable server
+            lock = self._key_lock(key)
+            if not lock.acquire(timeout=1):
+                logger.warning("vSphere session to %s is busy, not logging out", key[0])
+                continue
+            try:
+                self._disconnect(key)
+            finally:
+                lock.release()
+        logger.debug("vSphere session stats: %s", self.stats)
+
+    def _disconnect(self, key):
+        si = self._sessions.pop(key, None)
+        self._last_checked.pop(key, None)
+        if si is None:
+            return
+        try:
+            Disconnect(si)
+            self._count('logouts')
+        except Exception as e:
+            logger.warning("Failed to log out of vSphere server %s: %s", key[0], e)
+
+
+session_manager = SessionManager()
+atexit.register(session_manager.logout_all)
 
 
 def init_vsphere_client(server):
-    si = SmartConnectNoSSL(
-        host=server.ip, user=server.username, pwd=server.password)
-    return si
+    return session_manager.get(server)
+
+
+def get_session_stats():
+    """ Returns the login/reuse counters of the shared session manager """
+    return dict(session_manager.stats)
 
 
 def get_all_vms_from_host(host):
@@ -27,10 +158,98 @@ def get_vm_from_host(host, predicate=None):
     return list(filter(predicate, all_vms))
 
 
+def get_vm_by_moid(server, moid):
+    """
+    Returns the VM managed object with the given moId, bound to the current
+    session of the server, without listing the host inventory
+    """
+    si = init_vsphere_client(server)
+    return vim.VirtualMachine(moid, si._stub)
+
+
+def is_vm_mobj_valid(vm_mobj, server, name):
+    """
+    Checks that a VM managed object belongs to the current session of the
+    server and still refers to the VM with the given name
+    """
+    if vm_mobj._stub is not init_vsphere_client(server)._stub:
+        return False
+    try:
+        return vm_mobj.name == name
+    except (vmodl.fault.ManagedObjectNotFound, vim.fault.NotAuthenticated):
+        return False
+
+
+def retrieve_vm_properties(host, properties=None):
+    """
+    Fetches the given properties of every VM on the host with a single
+    PropertyCollector call. Returns a dict keyed by VM name whose values map
+    property paths to values, plus 'obj' for the VM managed object.
+    """
+    properties = properties or VM_PROPERTIES
+    si = init_vsphere_client(host)
+    content = si.content
+    container = content.viewManager.CreateContainerView(
+        content.rootFolder, [vim.VirtualMachine], True)
+    collector = content.propertyCollector
+
+    traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+        name='traverseEntities', path='view', skip=False,
+        type=vim.view.ContainerView)
+    obj_spec = vmodl.query.PropertyCollector.ObjectSpec(
+        obj=container, skip=True, selectSet=[traversal_spec])
+    prop_spec = vmodl.query.PropertyCollector.PropertySpec(
+        type=vim.VirtualMachine, pathSet=list(properties), all=False)
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=[obj_spec], propSet=[prop_spec])
+
+    objects = []
+    try:
+        result = collector.RetrievePropertiesEx(
+            [filter_spec], vmodl.query.PropertyCollector.RetrieveOptions())
+        while result:
+            objects.extend(result.objects)
+            if not result.token:
+                break
+            result = collector.ContinueRetrievePropertiesEx(result.token)
+    finally:
+        container.Destroy()
+
+    vms = dict()
+    for obj in objects:
+        props = {prop.name: prop.val for prop in obj.propSet}
+        props['obj'] = obj.obj
+        vms[props.get('name')] = props
+    return vms
+
+
+def wait_for_tasks(tasks, name):
+    """ Waits for vSphere tasks to complete, traced as one span named name """
+    with tracer.span(name, category='vsphere', tasks=len(tasks)):
+        WaitForTasks(tasks)
+
+
+def update_vm_annotation(vm_mobj, annotation, change_version=None):
+    """
+    Rewrites the annotation of a VM and returns its new changeVersion. If
+    change_version is given, the reconfigure is rejected with
+    ConcurrentModificationError when the VM changed since then.
+    """
+    spec = vim.vm.ConfigSpec()
+    spec.annotation = annotation
+    if change_version:
+        spec.changeVersion = change_version
+    task = vm_mobj.ReconfigVM_Task(spec)
+    try:
+        wait_for_tasks([task], 'ReconfigVM_Task')
+    except vim.fault.ConcurrentAccess as e:
+        raise ConcurrentModificationError(e.msg)
+    return vm_mobj.config.changeVersion
+
+
 def get_all_vm_snapshots(vm):
     """ Returns a list of all VM snapshots """
-    predicate = lambda x: x.name == vm.name
-    vm_mobj = get_vm_from_host(vm.host, predicate=predicate)[0]
+    vm_mobj = vm.get_mobj()
     all_snapshots = []
 
     def collect_snapshots_recursively(snapshotTree):
@@ -45,58 +264,136 @@ def get_all_vm_snapshots(vm):
     return all_snapshots
 
 
-def get_vm_snapshot_by_name(vm, snapshot_name):
-    """ Returns a VM snapshot matching the specified name """
-    predicate = lambda x: x.name == vm.name
-    vm_mobj = get_vm_from_host(vm.host, predicate=predicate)[0]
-    queue = deque()
-
-    if not hasattr(vm_mobj.snapshot, 'rootSnapshotList'):
-        return None
-    queue.extend(vm_mobj.snapshot.rootSnapshotList)
+def get_vm_snapshot_index(vm, refresh=False):
+    """
+    Returns {snapshot name: snapshot moId} of a VM, the first match in
+    breadth-first order for duplicate names. The index is cached on the VM
+    and rebuilt when its moId changed, when refresh is set, or after a
+    snapshot was created or removed through this module.
+    """
+    vm_mobj = vm.get_mobj()
+    cached = vm.snapshot_index
+    if not refresh and cached is not None and cached[0] == vm_mobj._moId:
+        return cached[1]
 
+    index = dict()
+    queue = deque()
+    if hasattr(vm_mobj.snapshot, 'rootSnapshotList'):
+        queue.extend(vm_mobj.snapshot.rootSnapshotList)
     while queue:
         root = queue.popleft()
-        if root.name == snapshot_name:
-            return root.snapshot
+        index.setdefault(root.name, root.snapshot._moId)
         queue.extend(root.childSnapshotList)
+    vm.snapshot_index = (vm_mobj._moId, index)
+    return index
 
-    return None
+
+def get_vm_snapshot_by_name(vm, snapshot_name, refresh=False):
+    """ Returns a VM snapshot matching the specified name """
+    moid = get_vm_snapshot_index(vm, refresh=refresh).get(snapshot_name)
+    if moid is None:
+        return None
+    return vim.vm.Snapshot(moid, vm.get_mobj()._stub)
 
 
 def create_vm_snapshot(vm, snapshot_name):
     """ Takes a snapshot of a VM """
-    predicate = lambda x: x.name == vm.name
-    vm_mobj = get_vm_from_host(vm.host, predicate=predicate)[0]
+    vm_mobj = vm.get_mobj()
     dump_memory = False
     quiesce = False
     task = vm_mobj.CreateSnapshot(
         snapshot_name, snapshot_name, dump_memory, quiesce)
-    WaitForTasks([task])
+    vm.snapshot_index = None
+    wait_for_tasks([task], 'CreateSnapshot')
 
 
-def revert_vm_to_snapshot(vm, snapshot_name=None):
+def _revert(vm, snapshot_name):
     """
-    Restores the VM to the specified snapshot. If snapshot_name is None,
-    restores the VM to the current snapshot
+    Reverts the VM to the named snapshot, or the current one if no name is
+    given, and powers it back on if the snapshot left it off
     """
-    if not snapshot_name:
-        predicate = lambda x: x.name == vm.name
-        vm_mobj = get_vm_from_host(vm.host, predicate=predicate)[0]
-        task = vm_mobj.RevertToCurrentSnapshot_Task()
-        WaitForTasks([task])
+    if snapshot_name:
+        snapshot = get_vm_snapshot_by_name(vm, snapshot_name)
+        if snapshot is None:
+            raise SnapshotNotFoundError(
+                "VM {} has no snapshot {}".format(vm.name, snapshot_name))
+        try:
+            task = snapshot.RevertToSnapshot_Task()
+        except vmodl.fault.ManagedObjectNotFound:
+            # the cached index is stale, e.g. the snapshot was removed elsewhere
+            snapshot = get_vm_snapshot_by_name(vm, snapshot_name, refresh=True)
+            if snapshot is None:
+                raise SnapshotNotFoundError(
+                    "VM {} has no snapshot {}".format(vm.name, snapshot_name))
+            task = snapshot.RevertToSnapshot_Task()
+        wait_for_tasks([task], 'RevertToSnapshot_Task')
+    else:
+        task = vm.get_mobj().RevertToCurrentSnapshot_Task()
+        wait_for_tasks([task], 'RevertToCurrentSnapshot_Task')
 
-    snapshot = get_vm_snapshot_by_name(vm, snapshot_name)
-    if not snapshot:
-        # TODO(pvichare): Raise error instead of returning quietly
-        return
-    task = snapshot.RevertToSnapshot_Task()
-    WaitForTasks([task])
     # If VM is powered off, then power it back on
-    vm_mobj = get_vm_from_host(
-        vm.host, predicate=lambda x: x.name == vm.name)[0]
+    vm_mobj = vm.get_mobj()
     if vm_mobj.runtime.powerState == "poweredOff":
-        WaitForTasks([vm_mobj.PowerOnVM_Task()])
+        wait_for_tasks([vm_mobj.PowerOnVM_Task()], 'PowerOnVM_Task')
+
+
+def revert_vm_to_snapshot(vm, snapshot_name=None):
+    """
+    Restores the VM to the specified snapshot. If snapshot_name is None,
+    restores the VM to the current snapshot. Returns False if the VM has
+    no such snapshot.
+    """
+    try:
+        _revert(vm, snapshot_name)
+    except SnapshotNotFoundError as e:
+        # TODO(pvichare): Raise error instead of returning quietly
+        logger.warning(e)
+        return False
+    return True
+
+
+def revert_vms_to_snapshot(vms, snapshot_name=None, max_concurrent=DEFAULT_REVERT_CONCURRENCY,
+                           before_revert=None, on_reverted=None):
+    """
+    Reverts many VMs to the named snapshot (the current one if no name is
+    given), max_concurrent at a time, and powers them back on. A failing VM
+    does not stop the others. before_revert(vm), if given, is called from the
+    worker first, and a VM it returns False for is skipped. on_reverted(vm),
+    if given, is called from the worker for every reverted VM; its errors
+    are only logged.
+    :return: list of RevertResult, in the order of vms
+    """
+    parent = tracer.current_span()
+
+    def revert(vm):
+        start = time.monotonic()
+        with tracer.span('revert ' + vm.name, category='vsphere', parent=parent,
+                         snapshot=snapshot_name):
+            try:
+                if before_revert is not None and not before_revert(vm):
+                    return RevertResult(vm, snapshot_name, 'skipped',
+                                        time.monotonic() - start, None)
+                _revert(vm, snapshot_name)
+            except SnapshotNotFoundError as e:
+                return RevertResult(vm, snapshot_name, 'not_found',
+                                    time.monotonic() - start, str(e))
+            except Exception as e:
+                logger.error("Failed to revert VM %s: %s", vm.name, e)
+                return RevertResult(vm, snapshot_name, 'failed',
+                                    time.monotonic() - start, str(e))
+            if on_reverted is not None:
+                try:
+                    on_reverted(vm)
+                except Exception as e:
+                    logger.warning("VM %s reverted, but %s failed: %s", vm.name,
+                                   getattr(on_reverted, '__name__', on_reverted), e)
+        return RevertResult(vm, snapshot_name, 'reverted', time.monotonic() - start, None)
+
+    vms = list(vms)
+    if not vms:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrent, len(vms)))) as executor:
+        return list(executor.map(revert, vms))
 
 
 def remove_vm_snapshot(vm, snapshot_name):
@@ -105,4 +402,5 @@ def remove_vm_snapshot(vm, snapshot_name):
     if not snapshot:
         return
     task = snapshot.RemoveSnapshot_Task(removeChildren=True)
-    WaitForTasks([task])
+    vm.snapshot_index = None
+    wait_for_tasks([task], 'RemoveSnapshot_Task')
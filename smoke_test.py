@@ -1,15 +1,29 @@
 import argparse
 import ipaddress
+import json
 import logging
+import os
 import paramiko
 import requests
 import sys
 import time
 import unittest
 
+from concurrent.futures import ThreadPoolExecutor
 from requests.exceptions import Timeout, URLRequired
 
-requests.packages.urllib3.disable_warnings()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cloudn_setup'))
+
+from common.api_client import cid_cache, get_client, log_metrics
+from common.fping import Slo, format_matrix, parse_targets, run_matrix
+from common.gw_watcher import get_watcher
+from common.iperf import ThroughputBaseline, run_throughput
+from common.ipsec import TunnelConvergenceTracker, select_collector
+from common.polling import NonRetryableError, Poller
+from common.scheduler import PhaseScheduler
+from common.ssh_pool import ssh_pool
+from common.timing_history import TimingHistory, TimingRun
+from common.tracing import tracer
 
 logging.basicConfig(
     filename='smoke_test.log',
@@ -26,18 +40,33 @@ class UseLoopDec(object):
     """
     This Decorator is used to extend the existing function and add loop logic for verification
     EX use:
-    @UseLoopDec(3, 30)
+    @UseLoopDec(deadline=300, initial_interval=5, max_interval=30)
     def verify_xxx()
-    func verify_xxx() will run max 3 times upon failure and wait 30 second in between
+    func verify_xxx() will be retried upon failure until it passes or 300 second have passed,
+    waiting 5 second after the first failure and doubling the wait up to 30 second.
+    The legacy form @UseLoopDec(3, 30) keeps the same overall budget (3*30 second).
+    The wrapped func accepts an extra cancel_event keyword (threading.Event) to stop waiting from outside,
+    and raising NonRetryableError from func stops the loop at once.
     """
 
-    def __init__(self, count=10, wait=30):
+    def __init__(self, count=None, wait=None, deadline=None, initial_interval=5,
+                 max_interval=None, multiplier=2, retry_on=()):
         """
-        :param count: Max number of loop to verify the func
-        :param wait: Wait time between each func run
+        :param count: Legacy max number of loop, converted to a deadline of count*wait
+        :param wait: Legacy wait time between each func run, used as max_interval
+        :param deadline: Max number of second to keep verifying the func
+        :param initial_interval: Wait time after the first failure
+        :param max_interval: Max wait time between each func run
+        :param multiplier: Factor the wait time grows by after each failure
+        :param retry_on: Exception types that count as a failure instead of aborting
         """
-        self.count = count
-        self.wait = wait
+        count = 10 if count is None else count
+        wait = 30 if wait is None else wait
+        self.deadline = deadline if deadline is not None else count * wait
+        self.initial_interval = min(initial_interval, wait)
+        self.max_interval = max_interval if max_interval is not None else wait
+        self.multiplier = multiplier
+        self.retry_on = retry_on
 
     def __call__(self, func):
         """
@@ -45,19 +74,28 @@ class UseLoopDec(object):
         """
         decorator_self = self
 
-        def wrapper(*args, **kwargs):
+        def wrapper(*args, cancel_event=None, **kwargs):
             logger.info("%s is running" % func.__name__)
-            for i in range(decorator_self.count):
-                if func(*args, **kwargs):
-                    logger.info("%s Pass" % func.__name__)
-                    return True
-                else:
-                    logger.error("%s Fail, wait to retry" % func.__name__)
-                    time.sleep(decorator_self.wait)
-            else:
-                logger.error("%s still Fail after %s second" % (
-                    func.__name__, decorator_self.count*decorator_self.wait))
-                return False
+            poller = Poller(
+                deadline=decorator_self.deadline,
+                initial_interval=decorator_self.initial_interval,
+                max_interval=decorator_self.max_interval,
+                multiplier=decorator_self.multiplier,
+                retry_on=decorator_self.retry_on,
+                cancel_event=cancel_event)
+            wrapper.last_poller = poller
+            try:
+                passed = bool(poller.run(func, *args, **kwargs))
+            finally:
+                logger.debug("%s attempts: %s" % (func.__name__, poller.attempts))
+            if passed:
+                logger.info("%s Pass after %s attempts" % (func.__name__, len(poller.attempts)))
+                return True
+            logger.error("%s still Fail after %s attempts in %s second" % (
+                func.__name__, len(poller.attempts), decorator_self.deadline))
+            return False
+        wrapper.__name__ = func.__name__
+        wrapper.last_poller = None
         return wrapper
 
 
@@ -90,67 +128,41 @@ def get_aviatrix_api_endpoint_url(controller_ip=None, api_version="v1", path="ap
         return api_endpoint_url, backend_endpoint_url
 
 
-def get_cid(api_url=None, user=None, passwd=None):
+def get_aviatrix_api_client(controller_ip=None):
     """
-    get CID.
-    :return: CID
+    Get the shared aviatrix api client of a controller or CloudN.
+    :param controller_ip <str>: controller ip, optionally with port
+    :return: AviatrixApiClient
     """
-    payload = {
-        "action": "login",
-        "username": user,
-        "password": passwd
-    }
-    response = requests.get(api_url,
-                            params=payload,
-                            verify=False)
-    avx_api_login_dict = response.json()
-
-    if (response.status_code not in range(200, 207)) or (avx_api_login_dict.get("return") is False):
-        raise RuntimeError("Cannot acquire CID.")
-    else:
-        cid = avx_api_login_dict.get("CID")
-        # logger.debug("Acquired CID: %s." % cid)
-        return cid
-
+    get_aviatrix_api_endpoint_url(controller_ip=controller_ip)
+    return get_client(controller_ip)
 
-@UseLoopDec(20, 15)
-def gw_status_checker(api_url, cid, device_name):
 
-    payload = {'action': 'list_gateway_upgrade_status'}
-    payload["CID"] = cid
-    try:
-        response = requests.get(
-            url=api_url, params=payload, timeout=5, verify=False)
+def get_cid(client=None, user=None, passwd=None):
+    """
+    get CID.
+    :return: CID
+    """
+    return client.login(user, passwd)
 
-        if response.status_code not in range(200, 207):
-            raise RuntimeError("HTTP status code not 200")
-
-        rsp_dict = response.json()
-        if not rsp_dict['return']:
-            raise Exception(rsp_dict)
-
-        for gw_info in rsp_dict['results']['gw_info']:
-            if gw_info['name'] == device_name:
-                logger.debug('{} : VPA_state: {}, update_status: {}'.format(
-                    gw_info['name'], gw_info['vpc_state'], gw_info['update_status']))
-                if gw_info['vpc_state'] != 'up' or gw_info['update_status'] != 'complete':
-                    return False
-                return True
-        else:
-            logger.debug(rsp_dict)
-            raise Exception('{} not exists in the data'.format(device_name))
 
-    except requests.exceptions.Timeout as e:
-        return False
+def gw_status_checker(client, device_name, deadline=300, cancel_event=None):
+    """
+    Wait until device_name is up with its upgrade complete. The controller is
+    polled by a watcher shared with every other waiter on it.
+    :return: True, or False after deadline second or when cancel_event is set
+    """
+    logger.info("gw_status_checker is running for %s" % device_name)
+    if get_watcher(client).wait_for(device_name, deadline=deadline, cancel_event=cancel_event):
+        logger.info("gw_status_checker Pass for %s" % device_name)
+        return True
+    logger.error("gw_status_checker still Fail for %s after %s second" % (device_name, deadline))
+    return False
 
 
-def get_kernel_version(api_url, CID):
+def get_kernel_version(client):
     try:
-        payload = {
-            'action': 'list_version_info',
-            'CID': CID,
-        }
-        response = requests.get(url=api_url, params=payload, verify=False)
+        response = client.request('list_version_info', method='get')
         if response.status_code not in range(200, 207):
             raise Exception("HTTP status code not 200")
 
@@ -163,87 +175,49 @@ def get_kernel_version(api_url, CID):
         return False
 
 
-def remove_new_line_characters(string=""):
-    if "\n" in string:
-        string = string.replace("\n", "")
-
-    return string
-
-
-@UseLoopDec(8, 60)
-def tunnelchecker(sshclient, CloudN_kernel_version, cn_num, expect_tunn):
-
-    if "4.15" in CloudN_kernel_version:
-        logger.info('    {} Kernel Version {}, Is Racoon'.format(
-            cn_num, CloudN_kernel_version)
-        )
-
-        # Ph2CountIs0 = avx_ping_test.execute_command("sudo racoonctl -ll ss isakmp | grep -c \'[^a-zA-Z]0 *$\'")
-        command = "sudo racoonctl -ll ss isakmp | grep -c \'[^a-zA-Z][1-9] *$\'"
-        stdin, stdout, stderr = sshclient.exec_command(command=command)
-
-        results = list()
-        # Print Result
-        for line in stdout.readlines():
-            line = remove_new_line_characters(line)
-            results.append(line)
-            # logger.debug(line)
-
-        # established tunnles need reached 90% is pass, ,
-        logger.info('    {} Currently S2C Tunnels {}'.format(
-            cn_num, results[0]
-        ))
-
-        if eval(results[0]) >= eval(expect_tunn)*0.9:
-            return True
-
-        logger.error(
-            'Failed Established tunnels not enough required {}/{}, Currently {}/{}'.format(
-                eval(expect_tunn)*0.9,
-                expect_tunn,
-                int(results[0]),
-                expect_tunn
-            ))
-        return False
-
-    if "5.4" in CloudN_kernel_version:
-        logger.info('    {} Kernel Version {}, Is StrongSwan'.format(
-            cn_num, CloudN_kernel_version)
-        )
-        # result = sshclient.execute_command("sudo swanctl -l | grep -c INSTALL")
-        command = "sudo swanctl -l | grep -c INSTALL"
-        stdin, stdout, stderr = sshclient.exec_command(command=command)
-
-        results = list()
-        # Print Result
-        for line in stdout.readlines():
-            line = remove_new_line_characters(line)
-            results.append(line)
-            # logger.debug(line)
-
-        logger.info('    {} Currently S2C Tunnels {}'.format(
-            cn_num, results[0]
+@UseLoopDec(deadline=480, initial_interval=10, max_interval=60)
+def tunnelchecker(sshclient, CloudN_kernel_version, cn_num, expect_tunn, tracker=None):
+
+    collector = select_collector(CloudN_kernel_version)
+    logger.info('    {} Kernel Version {}, Is {}'.format(
+        cn_num, CloudN_kernel_version, collector.name)
+    )
+
+    records = collector.collect(sshclient)
+    if tracker is None:
+        tracker = TunnelConvergenceTracker()
+    tracker.update(records)
+
+    expect_tunn = int(expect_tunn)
+    required = collector.required(expect_tunn)
+    established = tracker.up_count()
+    logger.info('    {} Currently S2C Tunnels {}/{}'.format(
+        cn_num, established, len(records)
+    ))
+
+    if established >= required:
+        return True
+
+    logger.error(
+        'Failed Established tunnels not enough required {}/{}, Currently {}/{}, not up: {}'.format(
+            required,
+            expect_tunn,
+            established,
+            expect_tunn,
+            ', '.join(tracker.stragglers())
         ))
-
-        if int(results[0]) >= expect_tunn-2:
-            return True
-
-        logger.error(
-            'Failed Established tunnels not enough required {}/{}, Currently {}/{}'.format(
-                expect_tunn-2,
-                expect_tunn,
-                int(results[0]),
-                expect_tunn
-            ))
-        return False
+    return False
 
 
 class Test(object):
-    # def __init__(self):
-    #     super().__init__()
-    def __init__(self, args):
-        self.__write_result("PASS")
+    """
+    Smoke test of one CloudN. The steps are declared as phases of a
+    dependency graph (see phases()) so independent steps run concurrently.
+    A failed step skips the steps depending on it and cancels running steps
+    that only fed those; the other steps go on.
+    """
 
+    def __init__(self, args):
         self.controller_ip = args.controller_hostname
         self.controller_username = args.controller_username
         self.controller_password = args.controller_passwd
@@ -260,28 +234,153 @@ class Test(object):
         self.cn_ssh_prot = args.cn_ssh_prot
         self.cn_api_prot = args.cn_api_prot
         self.onprem_ip = args.onprem_ip
+        self.ping_count = getattr(args, 'ping_count', None) or 20
+        self.ping_period = getattr(args, 'ping_period', None) or 100
+        self.ping_slo = Slo(
+            max_loss=None if getattr(args, 'slo_max_loss', None) is None else args.slo_max_loss / 100.0,
+            max_avg=getattr(args, 'slo_max_avg_rtt', None),
+            max_p99=getattr(args, 'slo_max_p99_rtt', None),
+            max_jitter=getattr(args, 'slo_max_jitter', None))
+        self.throughput = getattr(args, 'throughput', False)
+        self.onprem_ssh_host = getattr(args, 'onprem_ssh_host', None)
+        self.onprem_ssh_username = getattr(args, 'onprem_ssh_username', None)
+        self.onprem_ssh_password = getattr(args, 'onprem_ssh_passwd', None)
+        self.onprem_pem_path = getattr(args, 'onprem_pem_path', None)
+        self.iperf_server_ip = getattr(args, 'iperf_server_ip', None)
+        self.iperf_streams = getattr(args, 'iperf_streams', None) or 4
+        self.iperf_duration = getattr(args, 'iperf_duration', None) or 10
+        self.iperf_lengths = getattr(args, 'iperf_lengths', None) or [None]
+        self.throughput_baseline = getattr(args, 'throughput_baseline', None)
+        self.throughput_tolerance = getattr(args, 'throughput_tolerance', None) or 10
+        self.update_throughput_baseline = getattr(args, 'update_throughput_baseline', False)
         self.vpc_id = args.vpc_id
-
+        self.max_workers = getattr(args, 'max_workers', None) or 4
+        self.timing_report = getattr(args, 'timing_report', None)
+        self.result_file = getattr(args, 'result_file', 'result.txt')
+        self.timing_history = getattr(args, 'timing_history', None)
+        self.software_version = getattr(args, 'software_version', None)
+
+        self.controller = None
+        self.cid = None
+        self.cn_client = None
+        self.cn_cid = None
+        self.cn_kernel_ver = None
+        self.cn_ssh_client = None
+        self.spoke_ssh_client = None
+        self.onprem_ssh_client = None
+        self.scheduler = None
+        self.metrics = dict()
+        # durations measured inside phases, e.g. gateway and tunnel convergence
+        self.durations = dict()
+
+    def phases(self):
+        """ Returns the scheduler holding the test phases and their dependencies """
+        scheduler = PhaseScheduler(max_workers=self.max_workers)
+        scheduler.add('controller_login', self.login_controller)
+        scheduler.add('cloudn_login', self.login_cloudn)
+        scheduler.add('cloudn_ssh', self.connect_cloudn_ssh)
+        scheduler.add('spoke_ssh', self.connect_spoke_ssh)
+        scheduler.add('cloudn_kernel_version', self.get_cloudn_kernel_version,
+                      deps=['cloudn_login'])
+        scheduler.add('test_01_upgrade_cloudn', self.test_01_upgrade_cloudn,
+                      deps=['controller_login'])
+        scheduler.add('test_02_run_diag', self.test_02_run_diag,
+                      deps=['test_01_upgrade_cloudn'])
+        scheduler.add('test_03_ping', self.test_03_ping,
+                      deps=['test_01_upgrade_cloudn', 'cloudn_kernel_version',
+                            'cloudn_ssh', 'spoke_ssh'])
+        if self.throughput:
+            scheduler.add('onprem_ssh', self.connect_onprem_ssh)
+            scheduler.add('test_04_throughput', self.test_04_throughput,
+                          deps=['test_03_ping', 'onprem_ssh'])
+        return scheduler
+
+    def run(self):
+        """ Runs all phases, writes result.txt and returns True on PASS """
+        self.__write_result("FAIL")
+        self.scheduler = self.phases()
+        passed = self.scheduler.run()
+        logger.info("Phase timing report\n{}".format(self.scheduler.format_report()))
+        log_metrics()
+        if self.timing_report:
+            with open(self.timing_report, 'w') as report_file:
+                json.dump(self.scheduler.report(), report_file, indent=2)
+        self.record_timing("PASS" if passed else "FAIL")
+        self.__write_result("PASS" if passed else "FAIL")
+        return passed
+
+    def get_software_version(self):
+        """ Returns the CloudN software version the run tested, None if unknown """
+        if self.software_version or self.cn_client is None:
+            return self.software_version
         try:
-            self.api_endpoint_url, self.backend_endpoint_url = get_aviatrix_api_endpoint_url(
-                controller_ip=self.controller_ip)
-            self.cid = get_cid(api_url=self.api_endpoint_url,
-                               user=self.controller_username, passwd=self.controller_password)
-            logger.info('api url: {}'.format(self.api_endpoint_url))
-            logger.info('CID: {}'.format(self.cid))
+            response = self.cn_client.request('list_version_info', method='get', timeout=30)
+            return response.json()['results'].get('current_version')
         except Exception as e:
-            logger.exception(str(e))
-            logger.error("Failed to login to controller IP {}}",
-                         format(self.controller_ip))
-            self.result = "FAIL"
+            logger.warning('Cannot get CloudN software version: {}'.format(e))
+            return None
+
+    def record_timing(self, result):
+        """ Appends the phase durations of this run to the timing history """
+        if self.timing_history == "":
+            return
+        timing = TimingRun('smoke_test', device=self.cloudn, version=self.get_software_version(),
+                           history=TimingHistory(self.timing_history))
+        for entry in self.scheduler.report():
+            timing.add(entry['phase'], entry['duration'], entry['status'])
+        for name, duration in self.durations.items():
+            timing.add(name, duration)
+        timing.save(result)
+
+    def login_controller(self, cancel_event=None):
+        self.controller = get_aviatrix_api_client(controller_ip=self.controller_ip)
+        self.cid = get_cid(client=self.controller,
+                           user=self.controller_username, passwd=self.controller_password)
+        logger.info('api url: {}'.format(self.controller.api_url))
+        logger.info('CID: {}'.format(self.cid))
+
+    def login_cloudn(self, cancel_event=None):
+        self.cn_client = get_aviatrix_api_client(
+            controller_ip="{}:{}".format(self.cn_hostname, self.cn_api_prot) if bool(self.cn_api_prot) else self.cn_hostname)
+        self.cn_cid = get_cid(client=self.cn_client,
+                              user=self.cn_username, passwd=self.cn_password)
+        logger.info('api url: {}'.format(self.cn_client.api_url))
+        logger.info('CID: {}'.format(self.cn_cid))
+
+    def connect_cloudn_ssh(self, cancel_event=None):
+        self.cn_ssh_client = ssh_pool.connect(
+            self.cn_hostname,
+            port=self.cn_ssh_prot,
+            username=self.cn_ssh_username,
+            password=self.cn_ssh_password
+        )
+
+    def connect_spoke_ssh(self, cancel_event=None):
+        pem_key = paramiko.RSAKey.from_private_key_file(self.pem_path)
+        self.spoke_ssh_client = ssh_pool.connect(
+            self.spoke_vm,
+            username='ubuntu',
+            pkey=pem_key
+        )
+
+    def connect_onprem_ssh(self, cancel_event=None):
+        pem_key = None
+        if self.onprem_pem_path:
+            pem_key = paramiko.RSAKey.from_private_key_file(self.onprem_pem_path)
+        self.onprem_ssh_client = ssh_pool.connect(
+            self.onprem_ssh_host or parse_targets(self.onprem_ip)[0],
+            username=self.onprem_ssh_username or 'ubuntu',
+            password=self.onprem_ssh_password,
+            pkey=pem_key
+        )
 
-    # def __exit__(self, exc_type, exc_val, exc_tb):
-    #     # self.__write_result(self.result)
-    #     print ("__exit__")
-    # def __del__(self):
-    #     print ("__del__")
+    def get_cloudn_kernel_version(self, cancel_event=None):
+        cn_kernel_ver = get_kernel_version(self.cn_client)
+        if not isinstance(cn_kernel_ver, str):
+            raise Exception('Cannot get CloudN kernel version: {}'.format(cn_kernel_ver))
+        self.cn_kernel_ver = cn_kernel_ver
 
-    def test_01_upgrade_cloudn(self):
+    def test_01_upgrade_cloudn(self, cancel_event=None):
         logger.info('Start test_01_upgrade_cloudn')
         payload = {"action": "upgrade_selected_gateway",
                    "software_version": 'latest',
@@ -289,32 +388,25 @@ class Test(object):
                    "async": True
                    }
         payload["gateway_list"] = self.cloudn
-        payload["CID"] = self.cid
 
-        try:
-            response = requests.post(self.api_endpoint_url,
-                                     data=payload,
-                                     verify=False)
-
-            if response.status_code not in range(200, 207):
-                raise RuntimeError("Call upgrade api failed")
-
-            if not (
-                gw_status_checker(
-                    api_url=self.api_endpoint_url,
-                    cid=self.cid,
-                    device_name=self.cloudn
-                )
-            ):
-                raise Exception(
-                    '{} status check failed after upgrade.'.format(self.cloudn))
+        response = self.controller.request(payload.pop("action"), **payload)
 
-        except Exception as e:
-            logger.exception(str(e))
-            logger.error(e)
-            self.__write_result("FAIL")
+        if response.status_code not in range(200, 207):
+            raise RuntimeError("Call upgrade api failed")
+
+        start = time.monotonic()
+        if not (
+            gw_status_checker(
+                client=self.controller,
+                device_name=self.cloudn,
+                cancel_event=cancel_event
+            )
+        ):
+            raise Exception(
+                '{} status check failed after upgrade.'.format(self.cloudn))
+        self.durations['gateway_convergence'] = time.monotonic() - start
 
-    def test_02_run_diag(self):
+    def test_02_run_diag(self, cancel_event=None):
         logger.info('Start test_02_run_diag')
         payload = {"action": "run_site2cloud_diag",
                    "vpc_id": self.vpc_id,
@@ -322,83 +414,174 @@ class Test(object):
                    "action_name": "run_analysis",
                    "connection_name": self.conn_name
                    }
-        payload["CID"] = self.cid
-
-        try:
-            response = requests.post(self.api_endpoint_url,
-                                     data=payload,
-                                     verify=False)
 
-            if response.status_code not in range(200, 207):
-                raise RuntimeError("Call run_site2cloud_diag api failed")
-            logger.debug('response :{}'.format(response.json()))
-            if not response.json()['return']:
-                raise Exception(response.json())
+        response = self.controller.request(payload.pop("action"), **payload)
 
-            if '{} is UP'.format(self.conn_name) not in response.json()['results']:
-                raise Exception('Run Diagnosic show connection not up. \'{}\''.format(
-                    response.json()))
+        if response.status_code not in range(200, 207):
+            raise RuntimeError("Call run_site2cloud_diag api failed")
+        logger.debug('response :{}'.format(response.json()))
+        if not response.json()['return']:
+            raise Exception(response.json())
 
-        except Exception as e:
-            logger.exception(str(e))
-            logger.error(e)
-            self.__write_result("FAIL")
+        if '{} is UP'.format(self.conn_name) not in response.json()['results']:
+            raise Exception('Run Diagnosic show connection not up. \'{}\''.format(
+                response.json()))
 
-    def test_03_ping(self):
+    def test_03_ping(self, cancel_event=None):
         logger.info('test_03_ping')
-        try:
 
-            # Check CloudN s2c tunnel countting.
-            cn_api_endpoint_url, cn_backend_endpoint_url = get_aviatrix_api_endpoint_url(
-                controller_ip="{}:{}".format(self.cn_hostname, self.cn_api_prot) if bool(self.cn_api_prot) else self.cn_hostname)
-            cn_cid = get_cid(api_url=cn_api_endpoint_url,
-                             user=self.cn_username, passwd=self.cn_password)
-            logger.info('api url: {}'.format(cn_api_endpoint_url))
-            logger.info('CID: {}'.format(cn_cid))
-
-            cn_ssh_client = paramiko.SSHClient()
-            cn_ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            cn_ssh_client.connect(
-                hostname=self.cn_hostname,
-                username=self.cn_ssh_username,
-                password=self.cn_ssh_password,
-                port=self.cn_ssh_prot
-            )
-            cn_kernel_ver = get_kernel_version(cn_api_endpoint_url, cn_cid)
-            if not (tunnelchecker(
-                cn_ssh_client,
-                cn_kernel_ver,
-                self.cloudn,
-                self.expt_tunnel
-            )
-            ):
-                raise Exception()
-
-            # ip_str = " ".join([self.onprem_ip])
-            cmd = "fping {} -q -i 1 -r 3 -u -x {}".format(self.onprem_ip, 1)
-
-            ssh_client = paramiko.SSHClient()
-            pem_key = paramiko.RSAKey.from_private_key_file(self.pem_path)
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh_client.connect(
-                hostname=self.spoke_vm,
-                username='ubuntu',
-                pkey=pem_key
-            )
-            stdin, stdout, stderr = ssh_client.exec_command(cmd, timeout=60)
-            r_stdout = stdout.readlines()[0]
-            logger.info(r_stdout)
-            if 'Target IP Unreachable' in r_stdout:
-                raise Exception()
+        # Check CloudN s2c tunnel convergence.
+        tracker = TunnelConvergenceTracker()
+        start = time.monotonic()
+        established = tunnelchecker(
+            self.cn_ssh_client,
+            self.cn_kernel_ver,
+            self.cloudn,
+            self.expt_tunnel,
+            tracker=tracker,
+            cancel_event=cancel_event
+        )
+        self.metrics['tunnels'] = tracker.report()
+        logger.info('{} tunnel convergence: median {} s, max {} s, stragglers {}'.format(
+            self.cloudn, self.metrics['tunnels']['convergence_median'],
+            self.metrics['tunnels']['convergence_max'], self.metrics['tunnels']['stragglers']))
+        if not established:
+            raise Exception('{} tunnels not established.'.format(self.cloudn))
+        self.durations['tunnel_establishment'] = time.monotonic() - start
+
+        # Ping every on-prem target from the spoke VM and check the data-plane SLO.
+        targets = parse_targets(self.onprem_ip)
+        matrix = run_matrix(self.spoke_ssh_client, targets, count=self.ping_count,
+                            period=self.ping_period, slo=self.ping_slo)
+        self.metrics['latency'] = matrix
+        logger.info('Latency from spoke VM\n{}'.format(format_matrix(matrix)))
+        failed = [target for target, entry in matrix.items() if entry['violations']]
+        if failed:
+            raise Exception('{} of {} on-prem targets miss the SLO from spoke VM: {}'.format(
+                len(failed), len(targets), ', '.join(
+                    '{} ({})'.format(target, '; '.join(matrix[target]['violations']))
+                    for target in failed)))
+
+    def test_04_throughput(self, cancel_event=None):
+        logger.info('test_04_throughput')
+
+        # iperf3 client on the spoke VM, server on the on-prem host
+        server_ip = self.iperf_server_ip or parse_targets(self.onprem_ip)[0]
+        results = run_throughput(
+            self.spoke_ssh_client, self.onprem_ssh_client, server_ip,
+            streams=self.iperf_streams, duration=self.iperf_duration,
+            lengths=self.iperf_lengths)
+        self.metrics['throughput'] = [result._asdict() for result in results]
+
+        if not self.throughput_baseline:
+            return
+        baseline = ThroughputBaseline(self.throughput_baseline)
+        version = self.get_software_version()
+        reference = baseline.reference_version(version)
+        if self.update_throughput_baseline and version:
+            baseline.store(version, results)
+        if reference is None:
+            logger.info('No throughput baseline to compare {} with'.format(version))
+            return
+        comparisons = baseline.compare(reference, results,
+                                       tolerance=self.throughput_tolerance / 100.0)
+        self.metrics['throughput_baseline'] = {'version': reference, 'comparisons': comparisons}
+        for entry in comparisons:
+            logger.info('goodput length {}: {:.1f} -> {:.1f} Mbit/s ({:+.0%}) vs {}'.format(
+                entry['length'] or 'default', entry['baseline_bps'] / 1e6,
+                entry['goodput_bps'] / 1e6, entry['change'], reference))
+        regressions = [entry for entry in comparisons if entry['regression']]
+        if regressions:
+            raise Exception('Throughput dropped more than {}% below {} for lengths {}'.format(
+                self.throughput_tolerance, reference,
+                ', '.join(str(entry['length'] or 'default') for entry in regressions)))
+
+    def __write_result(self, result):
+        if not self.result_file:
+            return
+        with open(self.result_file, 'w') as result_file:
+            result_file.write(result+'\n')
+
 
+def load_fleet_targets(manifest=None, inventory_file=None, devices=None):
+    """
+    Returns the per-device argument overrides of a fleet run, read from a
+    JSON/YAML manifest (a list of objects keyed by argument name, or an
+    object with such a list under "devices") or from the vCloudN inventory.
+    :param devices: Optional list of device names to keep
+    """
+    if manifest:
+        with open(manifest, 'r') as manifest_file:
+            if manifest.endswith(('.yaml', '.yml')):
+                import yaml
+                data = yaml.safe_load(manifest_file)
+            else:
+                data = json.load(manifest_file)
+        targets = data.get('devices', []) if isinstance(data, dict) else data
+    else:
+        from vmware.inventory import Inventory
+        inv = Inventory()
+        inv.initialize_inventory(inventory_file or None)
+        targets = list()
+        for vm in inv.vms:
+            target = {key: value for key, value in vm.spec.items()
+                      if key.startswith(('cn_', 'conn_', 'expt_', 'onprem_'))}
+            target.update({
+                'cn_name': vm.name,
+                'cn_hostname': vm.ip,
+                'cn_username': vm.spec.get('username'),
+                'cn_passwd': vm.spec.get('passwd'),
+            })
+            targets.append(target)
+
+    if devices:
+        targets = [target for target in targets if target.get('cn_name') in devices]
+    return targets
+
+
+def run_fleet(args, targets):
+    """
+    Runs the Test phases of every target device concurrently, at most
+    args.fleet_concurrency devices at a time, and writes the per-device,
+    per-phase results to args.fleet_result. Returns True if every device passed.
+    """
+    def run_device(overrides):
+        name = overrides.get('cn_name', args.cn_name)
+        logger.info('Fleet: start {}'.format(name))
+        test = None
+        start = time.monotonic()
+        try:
+            # devices write their results to the fleet result only
+            device_args = dict(vars(args), **overrides)
+            device_args.update(result_file=None, timing_report=None)
+            test = Test(argparse.Namespace(**device_args))
+            passed = test.run()
         except Exception as e:
             logger.exception(str(e))
-            logger.error(e)
-            self.__write_result("FAIL")
+            passed = False
+        logger.info('Fleet: {} {}'.format(name, 'PASS' if passed else 'FAIL'))
+        return {
+            'device': name,
+            'result': 'PASS' if passed else 'FAIL',
+            'duration': time.monotonic() - start,
+            'phases': test.scheduler.report() if test and test.scheduler else [],
+            'metrics': test.metrics if test else {},
+        }
 
-    def __write_result(self, result):
-        with open('result.txt', 'w') as result_file:
-            result_file.write(result+'\n')
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, args.fleet_concurrency)) as executor:
+        results = list(executor.map(run_device, targets))
+    passed = bool(results) and all(result['result'] == 'PASS' for result in results)
+
+    with open(args.fleet_result, 'w') as result_file:
+        json.dump({
+            'result': 'PASS' if passed else 'FAIL',
+            'duration': time.monotonic() - start,
+            'devices': results,
+        }, result_file, indent=2)
+    with open('result.txt', 'w') as result_file:
+        result_file.write(('PASS' if passed else 'FAIL') + '\n')
+    return passed
 
 
 if __name__ == "__main__":
@@ -419,16 +602,80 @@ if __name__ == "__main__":
     parser.add_argument('--cn_api_prot', help='Access ClounN API port number')
     parser.add_argument('--cn_ssh_prot', help='Access ClounN SSH port number')
     parser.add_argument('--spoke_vm', help='Spoke VM IP address')
-    parser.add_argument('--onprem_ip', help='On-Prem IP address')
+    parser.add_argument('--onprem_ip',
+                        help='On-Prem IP addresses to ping: comma separated list and/or CIDRs')
+    parser.add_argument('--ping_count', type=int, default=20,
+                        help='Pings sent to every on-prem target')
+    parser.add_argument('--ping_period', type=int, default=100,
+                        help='Milliseconds between two pings to the same target')
+    parser.add_argument('--slo_max_loss', type=float,
+                        help='SLO: max packet loss per target in percent')
+    parser.add_argument('--slo_max_avg_rtt', type=float,
+                        help='SLO: max average RTT per target in ms')
+    parser.add_argument('--slo_max_p99_rtt', type=float,
+                        help='SLO: max p99 RTT per target in ms')
+    parser.add_argument('--slo_max_jitter', type=float,
+                        help='SLO: max jitter (mean RTT difference of consecutive pings) in ms')
     parser.add_argument(
         '--expt_tunnel', help='The number of tunnel should expect')
     parser.add_argument('--spoke_pem_path', help='Spoke Pem file')
+    parser.add_argument('--throughput', action='store_true',
+                        help='Also measure spoke to on-prem throughput with iperf3')
+    parser.add_argument('--onprem_ssh_host', help='Throughput: On-Prem host to run the iperf3 server on (default: first --onprem_ip)')
+    parser.add_argument('--onprem_ssh_username', help='Throughput: On-Prem SSH username')
+    parser.add_argument('--onprem_ssh_passwd', help='Throughput: On-Prem SSH password')
+    parser.add_argument('--onprem_pem_path', help='Throughput: On-Prem Pem file')
+    parser.add_argument('--iperf_server_ip',
+                        help='Throughput: On-Prem IP the spoke VM sends to (default: first --onprem_ip)')
+    parser.add_argument('--iperf_streams', type=int, default=4,
+                        help='Throughput: parallel iperf3 streams')
+    parser.add_argument('--iperf_duration', type=int, default=10,
+                        help='Throughput: seconds each iperf3 test runs')
+    parser.add_argument('--iperf_lengths', type=lambda value: [int(length) for length in value.split(',')],
+                        help='Throughput: comma separated read/write sizes in bytes, one test each')
+    parser.add_argument('--throughput_baseline',
+                        help='Throughput: JSON file with the results of earlier versions')
+    parser.add_argument('--throughput_tolerance', type=float, default=10,
+                        help='Throughput: percent goodput may drop below the previous version')
+    parser.add_argument('--update_throughput_baseline', action='store_true',
+                        help='Throughput: store the results of this version in the baseline file')
     # parser.add_argument('--cn_pem_path',help='CloudN Pem file')
     parser.add_argument('--vpc_id', help='Transit VPC ID')
+    parser.add_argument('--max_workers', type=int, default=4,
+                        help='Number of test phases run at the same time')
+    parser.add_argument('--fleet_manifest',
+                        help='Fleet mode: JSON/YAML file listing the CloudNs to test')
+    parser.add_argument('--fleet_inventory', nargs='?', const='',
+                        help='Fleet mode: test the CloudNs of the vCloudN inventory (optional yaml path)')
+    parser.add_argument('--fleet_devices',
+                        help='Fleet mode: comma separated CloudN names to keep')
+    parser.add_argument('--fleet_concurrency', type=int, default=4,
+                        help='Fleet mode: number of CloudNs tested at the same time')
+    parser.add_argument('--fleet_result', default='fleet_result.json',
+                        help='Fleet mode: file the aggregated results are written to')
+    parser.add_argument('--cid_cache', help='File CIDs are cached in across runs')
+    parser.add_argument('--timing_report', default='phase_timing.json',
+                        help='File the per-phase timing report is written to')
+    parser.add_argument('--timing_history',
+                        help='File the phase durations of every run are appended to, "" to disable')
+    parser.add_argument('--trace_file',
+                        help='File a Chrome trace (chrome://tracing, Perfetto) of the run is written to')
+    parser.add_argument('--software_version',
+                        help='CloudN version recorded in the timing history (default: asked from the CloudN)')
 
     args = parser.parse_args()
-
-    test = Test(args)
-    test.test_01_upgrade_cloudn()
-    test.test_02_run_diag()
-    test.test_03_ping()
+    if args.cid_cache:
+        cid_cache.path = args.cid_cache
+    if args.trace_file:
+        tracer.enable(args.trace_file)
+
+    if args.fleet_manifest or args.fleet_inventory is not None:
+        targets = load_fleet_targets(
+            manifest=args.fleet_manifest,
+            inventory_file=args.fleet_inventory,
+            devices=args.fleet_devices.split(',') if args.fleet_devices else None)
+        run_fleet(args, targets)
+    else:
+        test = Test(args)
+        test.run()
+    ssh_pool.close_all()